@@ -1,62 +1,110 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
 from routes.audio import audio_routes
 from routes.image import image_routes
 from routes.transcribe import transcribe_routes
+from routes.jobs import job_routes
+from routes.uploads import upload_routes
+from urllib.parse import quote
+import logging
 import os
-import atexit
-import subprocess
 import storage
+import reaper
+import instrumentation
+from resources import get_governor
+from result_cache import get_result_cache
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
 
 app = Flask(__name__)
 app.register_blueprint(audio_routes, url_prefix='/audio')
 app.register_blueprint(image_routes, url_prefix='/image')
 app.register_blueprint(transcribe_routes, url_prefix='/transcribe')
-CORS(app, origins=["http://localhost:3000"], expose_headers=["Content-Disposition"], supports_credentials=True)
+app.register_blueprint(job_routes, url_prefix='/jobs')
+app.register_blueprint(upload_routes, url_prefix='/uploads')
+CORS(app, origins=["http://localhost:3000"], expose_headers=["Content-Disposition", "Content-Range", "Accept-Ranges", "ETag", "Server-Timing", "X-Request-ID", "X-Transcript-ID"], supports_credentials=True)
+instrumentation.init_app(app)
 
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'outputs'
+# hand downloads over to the front proxy: "x-accel" (nginx) or "x-sendfile" (Apache, lighttpd), empty to serve them here
+DOWNLOAD_OFFLOAD = os.environ.get('DOWNLOAD_OFFLOAD', '')
+# internal nginx location mapped to the outputs folder, for x-accel
+DOWNLOAD_OFFLOAD_PREFIX = os.environ.get('DOWNLOAD_OFFLOAD_PREFIX', '/protected-outputs/')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-file_mapping = storage.get_file_mapping()
-    
-# Endpoint to download converted file
+file_registry = storage.get_file_registry()
+
+def output_etag(output_id, stat):
+    '''
+    Strong ETag of an output: outputs are written once under their id, so id, size and mtime identify its bytes
+    '''
+    return f'{output_id}-{stat.st_size:x}-{stat.st_mtime_ns:x}'
+
+def offload_response(entry, download_filepath):
+    '''
+    Empty response telling the front proxy which file to send. The proxy also answers range and
+    conditional requests, so the worker is free as soon as the lookup is done.
+    '''
+    response = Response(mimetype=entry['content_type'])
+    if DOWNLOAD_OFFLOAD == 'x-accel':
+        relative_path = os.path.relpath(download_filepath, storage.OUTPUT_FOLDER).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = DOWNLOAD_OFFLOAD_PREFIX.rstrip('/') + '/' + relative_path
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(download_filepath)
+    download_name = entry['original_name']
+    fallback_name = download_name.encode('ascii', 'replace').decode().replace('?', '_')
+    options = {'filename': fallback_name}
+    if fallback_name != download_name:
+        options['filename*'] = "UTF-8''" + quote(download_name, safe="!#$&+^`|~")
+    response.headers.set('Content-Disposition', 'attachment', **options)
+    return response
+
+# Endpoint to download converted file, with byte ranges (Range, If-Range) and conditional requests (If-None-Match)
 @app.route('/download/<unique_filename>', methods=['GET'])
 def download_file(unique_filename):
-    print("Downloading...")
-    original_filename = file_mapping.get(unique_filename)
-    print(original_filename)
-    if not original_filename:
+    entry = file_registry.lookup(unique_filename)
+    if not entry:
         return jsonify({'error': 'File not found'}), 404
     
-    download_filepath = os.path.join(OUTPUT_FOLDER, unique_filename)
+    download_filepath = storage.output_path(unique_filename)
     if os.path.exists(download_filepath):
+        if DOWNLOAD_OFFLOAD in ['x-accel', 'x-sendfile']:
+            return offload_response(entry, download_filepath)
         try:
-            res = send_file(download_filepath, download_name=original_filename, as_attachment=True)
-            # os.remove(download_filepath) # remove the downloaded file
+            res = send_file(download_filepath, download_name=entry['original_name'], mimetype=entry['content_type'], as_attachment=True,
+                            conditional=True, etag=output_etag(unique_filename, os.stat(download_filepath)))
             return res
-        except Exception as e:
+        except OSError as e: # HTTP errors such as 416 for an unsatisfiable range propagate
             return jsonify({'error': f'Failed to download file: {str(e)}'}), 500
     
     return jsonify({'error': 'File not found'}), 404
 
+# Endpoint exposing the metrics of every worker in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    instrumentation.get_metrics().flush()
+    counters = storage.get_file_registry().get_counters() # where every process flushes its metrics
+    return Response(instrumentation.render_prometheus(counters), mimetype='text/plain; version=0.0.4')
 
-def cleanup():
-    '''
-    Clean up uploaded and output folders when the server is shutting down
-    '''
-    print("Server shutting down. Cleaning up...")
-    if os.path.exists(UPLOAD_FOLDER):
-        subprocess.run(['rm', '-rf', UPLOAD_FOLDER], check=True)
+# Endpoint to inspect the conversion result cache
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(get_result_cache().stats())
 
-    if os.path.exists(OUTPUT_FOLDER):
-        subprocess.run(['rm', '-rf', OUTPUT_FOLDER], check=True)
-    
-    print(f"Cleaned up {UPLOAD_FOLDER} and {OUTPUT_FOLDER}")
+# Endpoint to inspect output storage usage and reaper activity
+@app.route('/storage/stats', methods=['GET'])
+def storage_stats():
+    return jsonify(reaper.get_metrics())
+
+# Endpoint to inspect the CPU budget and the threads currently handed out
+@app.route('/resources', methods=['GET'])
+def resources_stats():
+    return jsonify(get_governor().stats())
 
-atexit.register(cleanup)
 
 if __name__ == '__main__':
+    reaper.start_reaper()
     app.run(debug=True)
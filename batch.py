@@ -0,0 +1,157 @@
+from flask import request
+from werkzeug.utils import secure_filename
+import io
+import os
+import uuid
+import zipfile
+import storage
+from job_queue import run_unordered, run_command
+
+UPLOAD_FOLDER = 'uploads'
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', 1000))
+# uncompressed size of all the files of one batch together, zip bombs included
+BATCH_MAX_BYTES = int(os.environ.get('BATCH_MAX_BYTES', 20 * 1024 ** 3))
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+class ZipStream(io.RawIOBase):
+    '''
+    Write-only, non seekable sink for zipfile: whatever is written is handed out by drain()
+    '''
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _unique_name(name, used_names):
+    base, extension = os.path.splitext(name)
+    candidate, counter = name, 1
+    while candidate in used_names:
+        candidate = f"{base}_{counter}{extension}"
+        counter += 1
+    used_names.add(candidate)
+    return candidate
+
+def _save_member(source, filename, budget):
+    '''
+    Copy one batch file to the uploads folder, at most budget bytes of it.
+    Returns the path and the number of bytes written, raises ValueError if the file does not fit.
+    '''
+    extension = filename.rsplit('.', 1)[1].lower()
+    filepath = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4().hex}.{extension}")
+    size = 0
+    try:
+        with open(filepath, 'wb') as f:
+            while True:
+                chunk = source.read(ZIP_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > budget:
+                    raise ValueError(f'The batch is too large, the limit is {BATCH_MAX_BYTES} bytes uncompressed.')
+                f.write(chunk)
+    except BaseException:
+        os.remove(filepath)
+        raise
+    return filepath, size
+
+def collect_batch_inputs(valid_extensions):
+    '''
+    Save the files of a batch request to the uploads folder, taken either from repeated "files" parts
+    or from the members of a single zip "archive" part. Files with unsupported extensions are skipped.
+    Returns a list of (filename, filepath), raises ValueError if there is nothing to convert
+    or if the batch exceeds BATCH_MAX_FILES or BATCH_MAX_BYTES; the files saved so far are removed then.
+    '''
+    inputs = []
+    total_bytes = 0
+
+    def accept(filename):
+        filename = secure_filename(os.path.basename(filename))
+        if '.' not in filename or filename.rsplit('.', 1)[1].lower() not in valid_extensions:
+            return None
+        if len(inputs) >= BATCH_MAX_FILES:
+            raise ValueError(f'Too many files in one batch, the limit is {BATCH_MAX_FILES}.')
+        return filename
+
+    def save(source, filename):
+        nonlocal total_bytes
+        filepath, size = _save_member(source, filename, BATCH_MAX_BYTES - total_bytes)
+        total_bytes += size
+        inputs.append((filename, filepath))
+
+    try:
+        archive = request.files.get('archive')
+        if archive and archive.filename:
+            try:
+                with zipfile.ZipFile(archive.stream) as zf:
+                    for member in zf.infolist():
+                        filename = None if member.is_dir() else accept(member.filename)
+                        if filename:
+                            if total_bytes + member.file_size > BATCH_MAX_BYTES:
+                                raise ValueError(f'The batch is too large, the limit is {BATCH_MAX_BYTES} bytes uncompressed.')
+                            with zf.open(member) as source:
+                                save(source, filename)
+            except zipfile.BadZipFile:
+                raise ValueError('The archive is not a valid zip file.')
+
+        for file in request.files.getlist('files'):
+            filename = accept(file.filename or '')
+            if filename:
+                save(file.stream, filename)
+
+        if not inputs:
+            raise ValueError('No supported files found in the batch.')
+    except BaseException:
+        for _, filepath in inputs:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        raise
+    return inputs
+
+def stream_batch_zip(inputs, output_format, build_command):
+    '''
+    Convert every (filename, filepath) of a batch in the batch process pool and stream a zip of the results.
+    Members are written to the archive as soon as their conversion finishes, so the archive is never held in memory;
+    a failed conversion is reported as a "<name>.error.txt" member.
+    '''
+    used_names = set()
+    output_filepaths = [storage.output_path(f"{uuid.uuid4().hex}.{output_format}", create=True) for _ in inputs]
+    args_list = [
+        (build_command(input_filepath, output_filepath), input_filepath, [output_filepath])
+        for (_, input_filepath), output_filepath in zip(inputs, output_filepaths)
+    ]
+
+    sink = ZipStream()
+    try:
+        with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for index, _, error in run_unordered('batch', run_command, args_list):
+                base_name = inputs[index][0].rsplit('.', 1)[0]
+                if error:
+                    archive.writestr(_unique_name(f"{base_name}.error.txt", used_names), str(error))
+                else:
+                    output_filepath = output_filepaths[index]
+                    arcname = _unique_name(f"{base_name}.{output_format}", used_names)
+                    force_zip64 = os.path.getsize(output_filepath) >= zipfile.ZIP64_LIMIT
+                    with open(output_filepath, 'rb') as source, archive.open(arcname, 'w', force_zip64=force_zip64) as target:
+                        while True:
+                            chunk = source.read(ZIP_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            target.write(chunk)
+                            yield sink.drain()
+                    os.remove(output_filepath)
+                yield sink.drain()
+        yield sink.drain() # central directory
+    finally:
+        for path in output_filepaths + [input_filepath for _, input_filepath in inputs]:
+            if os.path.exists(path):
+                os.remove(path)
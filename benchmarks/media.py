@@ -0,0 +1,52 @@
+import os
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# synthetic fixtures: file name -> ffmpeg arguments generating it from lavfi sources
+SYNTHETIC_MEDIA = {
+    'tone.mp3': ['-f', 'lavfi', '-i', 'sine=frequency=440:duration=30', '-ac', '2', '-b:a', '192k'],
+    'tone.wav': ['-f', 'lavfi', '-i', 'sine=frequency=440:duration=10'],
+    'tone.m4a': ['-f', 'lavfi', '-i', 'sine=frequency=440:duration=30', '-c:a', 'aac'],
+    'small.png': ['-f', 'lavfi', '-i', 'testsrc=size=320x240', '-frames:v', '1'],
+    'photo.jpg': ['-f', 'lavfi', '-i', 'testsrc2=size=1920x1080', '-frames:v', '1', '-q:v', '3'],
+}
+# recordings with speech shipped with the repo, used by the transcription scenarios when present
+BUNDLED_MEDIA = {
+    'speech.mp3': 'korean.mp3',
+    'speech.mp4': 'test.mp4',
+}
+
+def generate_media(directory):
+    '''
+    Generate the synthetic fixtures in a directory (offline, with ffmpeg only) and link the bundled recordings.
+    Returns {name: path} of every fixture available.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    media = {}
+    for name, arguments in SYNTHETIC_MEDIA.items():
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            subprocess.run(['ffmpeg', '-loglevel', 'error', '-y'] + arguments + [path], check=True)
+        media[name] = path
+
+    for name, bundled in BUNDLED_MEDIA.items():
+        path = os.path.join(REPO_DIR, bundled)
+        if os.path.exists(path):
+            media[name] = path
+    return media
+
+def synthetic_transcript(sentences=20000):
+    '''
+    A long transcript with recurring phrases, like the ones of a podcast, for the render and translate scenarios
+    '''
+    phrases = [
+        'Welcome back to the show.',
+        'Today we are talking about audio processing at scale.',
+        'This episode is brought to you by our listeners.',
+        'Let us get into it.',
+    ]
+    lines = []
+    for index in range(sentences):
+        lines.append(f'{phrases[index % len(phrases)]} This is sentence number {index}.')
+    return '\n'.join(lines)
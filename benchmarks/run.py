@@ -0,0 +1,257 @@
+'''
+Benchmark every endpoint through the Flask test client, with concurrent clients, and compare to a baseline.
+
+    python -m benchmarks.run                        # run everything, compare to benchmarks/baseline.json if present
+    python -m benchmarks.run -s convert_image_small -n 50 -c 8
+    python -m benchmarks.run --save-baseline        # store this run as the new baseline
+
+The app runs in a temporary working directory with the result cache and the transcript store disabled,
+so every request does the full work.
+Exits with status 1 when a scenario got slower than the baseline by more than the threshold, or started failing.
+'''
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+from benchmarks.media import generate_media, synthetic_transcript
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baseline.json')
+# relative slowdown of a metric tolerated before it counts as a regression
+REGRESSION_THRESHOLD = float(os.environ.get('BENCH_REGRESSION_THRESHOLD', 0.25))
+# slowdowns smaller than this many milliseconds are noise, whatever the relative change
+REGRESSION_MIN_MS = float(os.environ.get('BENCH_REGRESSION_MIN_MS', 5))
+COMPARED_METRICS = ['p50_ms', 'p95_ms']
+
+def _post_file(client, url, path, filename, **form):
+    with open(path, 'rb') as f:
+        data = dict(form, file=(BytesIO(f.read()), filename))
+    return client.post(url, data=data, content_type='multipart/form-data')
+
+# scenario name -> (fixtures needed, request function)
+SCENARIOS = {
+    'convert_audio_mp3_to_ogg': (['tone.mp3'], lambda client, media: _post_file(
+        client, '/audio/convert_audio', media['tone.mp3'], 'tone.mp3', output_format='ogg')),
+    'convert_audio_params': (['tone.wav'], lambda client, media: _post_file(
+        client, '/audio/convert_audio', media['tone.wav'], 'tone.wav', output_format='mp3',
+        bitrate='128k', sample_rate='22050', channels='1', volume='0.8')),
+    'convert_audio_remux': (['tone.m4a'], lambda client, media: _post_file(
+        client, '/audio/convert_audio', media['tone.m4a'], 'tone.m4a', output_format='aac')),
+    'convert_audio_renditions': (['tone.mp3'], lambda client, media: _post_file(
+        client, '/audio/convert_renditions', media['tone.mp3'], 'tone.mp3',
+        renditions='[{"output_format": "mp3", "bitrate": "128k"}, {"output_format": "mp3", "bitrate": "320k"}, {"output_format": "opus"}]')),
+    'stream_audio': (['tone.mp3'], lambda client, media: _post_file(
+        client, '/audio/stream_audio', media['tone.mp3'], 'tone.mp3', output_format='opus')),
+    'convert_image_small': (['small.png'], lambda client, media: _post_file(
+        client, '/image/convert_image', media['small.png'], 'small.png', output_format='webp', width='160', height='120')),
+    'convert_image_photo': (['photo.jpg'], lambda client, media: _post_file(
+        client, '/image/convert_image', media['photo.jpg'], 'photo.jpg', output_format='png',
+        rotate='90', grayscale='1')),
+    'image_renditions': (['photo.jpg'], lambda client, media: _post_file(
+        client, '/image/convert_renditions', media['photo.jpg'], 'photo.jpg',
+        renditions='[{"output_format": "webp", "width": 320}, {"output_format": "webp", "width": 640}, {"output_format": "jpg", "width": 1280}]')),
+    'transcribe_audio': (['speech.mp3'], lambda client, media: _post_file(
+        client, '/transcribe/transcribe_audio', media['speech.mp3'], 'speech.mp3', input_language='ko', output_language='ko')),
+    'transcribe_video': (['speech.mp4'], lambda client, media: _post_file(
+        client, '/transcribe/transcribe_video', media['speech.mp4'], 'speech.mp4', input_language='en', output_language='en')),
+    'save_transcription_pdf': ([], lambda client, media: client.post(
+        '/transcribe/save_transcription', json={'text': media['transcript'], 'format': 'pdf'})),
+    'save_transcription_docx': ([], lambda client, media: client.post(
+        '/transcribe/save_transcription', json={'text': media['transcript'], 'format': 'docx'})),
+    'translate_text': ([], lambda client, media: client.post(
+        '/transcribe/translate_text', json={'text': media['transcript'][:20000], 'from_code': 'en', 'to_code': 'es'})),
+}
+
+def percentile(values, fraction):
+    '''
+    Nearest-rank percentile of a list of numbers
+    '''
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def parse_server_timing(header):
+    '''
+    Parse a Server-Timing header into {stage: milliseconds}
+    '''
+    timings = {}
+    for metric in filter(None, (part.strip() for part in (header or '').split(','))):
+        name, _, params = metric.partition(';')
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'dur':
+                timings[name.strip()] = float(value)
+    return timings
+
+class StreamedTimings(logging.Handler):
+    '''
+    Collect the stage timings the app logs once a streamed body is sent (e.g. render), by request id,
+    as Server-Timing only holds the stages that ran before streaming started
+    '''
+    def __init__(self):
+        super().__init__()
+        self.timings = {}
+
+    def emit(self, record):
+        streamed = getattr(record, 'streamed_timings', None)
+        if streamed:
+            self.timings[record.request_id] = streamed
+
+    def pop(self, request_id):
+        '''
+        Stage timings in milliseconds of a request's streamed body, {} if nothing ran while it was streamed
+        '''
+        return {name: seconds * 1000 for name, seconds in self.timings.pop(request_id, {}).items()}
+
+streamed_timings = StreamedTimings()
+
+def _timed_request(app, request_fn, media):
+    client = app.test_client()
+    start = time.perf_counter()
+    response = request_fn(client, media)
+    body = response.get_data() # streamed responses are rendered while being read
+    latency = (time.perf_counter() - start) * 1000
+    if response.status_code >= 400:
+        raise RuntimeError(f'HTTP {response.status_code}: {body[:300].decode(errors="replace")}')
+    timings = parse_server_timing(response.headers.get('Server-Timing'))
+    for name, duration in streamed_timings.pop(response.headers.get('X-Request-ID')).items():
+        timings[name] = timings.get(name, 0.0) + duration
+    return latency, timings
+
+def run_scenario(app, request_fn, media, iterations, concurrency):
+    '''
+    Run one cold request (model loads, first ffmpeg spawn, ...) then `iterations` requests from `concurrency`
+    clients at once. Returns latency percentiles in milliseconds, throughput and the mean time of every stage.
+    '''
+    cold_ms, cold_stages = _timed_request(app, request_fn, media)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: _timed_request(app, request_fn, media), range(iterations)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, _ in results]
+    stages = {}
+    for _, timings in results:
+        for name, duration in timings.items():
+            stages[name] = stages.get(name, 0.0) + duration
+    return {
+        'iterations': iterations,
+        'concurrency': concurrency,
+        'cold_ms': round(cold_ms, 2),
+        'cold_stages_ms': {name: round(duration, 2) for name, duration in cold_stages.items()},
+        'mean_ms': round(sum(latencies) / len(latencies), 2),
+        'p50_ms': round(percentile(latencies, 0.50), 2),
+        'p95_ms': round(percentile(latencies, 0.95), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+        'throughput_rps': round(iterations / elapsed, 2),
+        'stages_ms': {name: round(total / len(results), 2) for name, total in sorted(stages.items())},
+    }
+
+def compare_to_baseline(results, baseline, threshold=REGRESSION_THRESHOLD, min_ms=REGRESSION_MIN_MS,
+                        metrics=COMPARED_METRICS):
+    '''
+    List the regressions of a run against a baseline, both {scenario: result}.
+    A metric regresses when it is more than `threshold` (relative) and `min_ms` slower than in the baseline;
+    a scenario that worked in the baseline but fails now is a regression too.
+    '''
+    regressions = []
+    for name, previous in baseline.items():
+        current = results.get(name)
+        if current is None or 'error' in previous:
+            continue
+        if 'error' in current:
+            regressions.append(f"{name}: failing ({current['error']})")
+            continue
+        for metric in metrics:
+            before, after = previous.get(metric), current.get(metric)
+            if before is None or after is None:
+                continue
+            if after > before * (1 + threshold) and after - before > min_ms:
+                regressions.append(f"{name}: {metric} {before:.1f} ms -> {after:.1f} ms (+{(after / before - 1) * 100:.0f}%)")
+    return regressions
+
+def print_report(results):
+    print(f"{'scenario':28} {'cold':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'req/s':>8}  stages (mean ms)")
+    for name, result in results.items():
+        if 'error' in result:
+            print(f"{name:28} error: {result['error']}")
+            continue
+        stages = ' '.join(f'{stage}={duration:.1f}' for stage, duration in result['stages_ms'].items())
+        print(f"{name:28} {result['cold_ms']:9.1f} {result['p50_ms']:9.1f} {result['p95_ms']:9.1f} "
+              f"{result['p99_ms']:9.1f} {result['throughput_rps']:8.1f}  {stages}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the FormatConverter endpoints.')
+    parser.add_argument('-s', '--scenarios', help='comma separated scenarios to run (default: all)')
+    parser.add_argument('-n', '--iterations', type=int, default=20, help='timed requests per scenario')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline to compare to')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help='tolerated relative slowdown')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--report', help='also write the results as JSON to this path')
+    args = parser.parse_args(argv)
+
+    names = args.scenarios.split(',') if args.scenarios else list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    baseline_path = os.path.abspath(args.baseline)
+    report_path = os.path.abspath(args.report) if args.report else None
+    workdir = tempfile.mkdtemp(prefix='formatconverter-bench-')
+    media = generate_media(os.path.join(workdir, 'media'))
+    media['transcript'] = synthetic_transcript()
+
+    # the app keeps its uploads, outputs and registry in the working directory, and reads its settings at import
+    os.environ.setdefault('RESULT_CACHE_BYTES', '0')
+    os.environ.setdefault('TRANSCRIPT_STORE', '0')
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+    from app import app
+    instrumentation_logger = logging.getLogger('instrumentation')
+    instrumentation_logger.setLevel(logging.INFO)
+    instrumentation_logger.addHandler(streamed_timings)
+
+    results = {}
+    for name in names:
+        fixtures, request_fn = SCENARIOS[name]
+        missing = [fixture for fixture in fixtures if fixture not in media]
+        if missing:
+            results[name] = {'error': f"missing fixture(s): {', '.join(missing)}"}
+            continue
+        print(f"Running {name}...", file=sys.stderr)
+        try:
+            results[name] = run_scenario(app, request_fn, media, args.iterations, args.concurrency)
+        except Exception as e:
+            results[name] = {'error': (str(e).splitlines()[0] if str(e) else type(e).__name__)[:200]}
+
+    print_report(results)
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {baseline_path}")
+        return 0
+
+    if not os.path.exists(baseline_path):
+        print("No baseline to compare to, run with --save-baseline to store one")
+        return 0
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = compare_to_baseline(results, {name: baseline[name] for name in names if name in baseline}, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+from flask import request, jsonify
+from werkzeug.utils import secure_filename
+import os
+import uuid
+import storage
+from instrumentation import stage
+
+UPLOAD_FOLDER = 'uploads'
+# largest file a chunked upload may announce
+CHUNKED_UPLOAD_MAX_BYTES = int(os.environ.get('CHUNKED_UPLOAD_MAX_BYTES', 20 * 1024 ** 3))
+
+def upload_path(upload_id):
+    return os.path.join(UPLOAD_FOLDER, f"{upload_id}.upload")
+
+def block_count(size):
+    return -(-size // storage.UPLOAD_BLOCK_SIZE)
+
+def create_upload(filename, size):
+    '''
+    Start a chunked upload of a file of `size` bytes, returns its upload id.
+    Raises ValueError if the name or size is invalid.
+    '''
+    filename = secure_filename(filename or '')
+    if not filename:
+        raise ValueError('Missing file name')
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        raise ValueError('Invalid size, it must be the number of bytes of the file')
+    if size > CHUNKED_UPLOAD_MAX_BYTES:
+        raise ValueError(f'File too large, the limit is {CHUNKED_UPLOAD_MAX_BYTES} bytes')
+
+    upload_id = uuid.uuid4().hex
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    with open(upload_path(upload_id), 'wb'):
+        pass
+    storage.get_file_registry().create_upload(upload_id, filename, size)
+    return upload_id
+
+def upload_status(upload):
+    '''
+    Progress of an upload: bytes received, and the offset to resume from (None once every block is in)
+    '''
+    digests = storage.get_file_registry().upload_block_digests(upload['upload_id'])
+    missing = [block for block in range(block_count(upload['size'])) if block not in digests]
+    received = sum(min(storage.UPLOAD_BLOCK_SIZE, upload['size'] - block * storage.UPLOAD_BLOCK_SIZE) for block in digests)
+    return {
+        'upload_id': upload['upload_id'],
+        'filename': upload['filename'],
+        'size': upload['size'],
+        'received': received,
+        'next_offset': missing[0] * storage.UPLOAD_BLOCK_SIZE if missing else None,
+        'complete': upload['digest'] is not None,
+    }
+
+def write_chunk(upload, offset, stream):
+    '''
+    Write a chunk read from stream at its offset in the upload file, hashing it block by block as it arrives.
+    Every block is recorded as soon as it is written, so a dropped connection only loses the block in flight.
+    A chunk must start on a block boundary; it may end anywhere, a trailing partial block is simply not recorded.
+    Raises ValueError if the chunk does not fit the upload.
+    '''
+    if upload['digest'] is not None:
+        raise ValueError('The upload is already complete')
+    if offset < 0 or offset % storage.UPLOAD_BLOCK_SIZE or offset > upload['size']:
+        raise ValueError(f'The offset must be a multiple of {storage.UPLOAD_BLOCK_SIZE} within the file')
+
+    registry = storage.get_file_registry()
+    first_block = offset // storage.UPLOAD_BLOCK_SIZE
+    hasher = storage.BlockHasher()
+    position = offset
+    blocks = first_block
+    fd = os.open(upload_path(upload['upload_id']), os.O_WRONLY)
+    try:
+        with stage('upload'):
+            while True:
+                chunk = stream.read(storage.UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if position + len(chunk) > upload['size']:
+                    raise ValueError('The chunk goes past the end of the file')
+                os.pwrite(fd, chunk, position)
+                position += len(chunk)
+                for digest in hasher.update(chunk):
+                    registry.save_upload_block(upload['upload_id'], blocks, digest)
+                    blocks += 1
+            if position == upload['size']:
+                # the last block of the file is shorter than the others
+                for digest in hasher.finish()[blocks - first_block:]:
+                    registry.save_upload_block(upload['upload_id'], blocks, digest)
+                    blocks += 1
+    finally:
+        os.close(fd)
+
+def complete_upload(upload):
+    '''
+    Check every block of an upload was received and record its content digest, the one save_upload
+    computes for the same content. Raises ValueError if blocks are missing.
+    '''
+    digests = storage.get_file_registry().upload_block_digests(upload['upload_id'])
+    missing = [block for block in range(block_count(upload['size'])) if block not in digests]
+    if missing:
+        raise ValueError(f'{len(missing)} block(s) missing, resume from offset {missing[0] * storage.UPLOAD_BLOCK_SIZE}')
+    digest = storage.combine_block_digests([digests[block] for block in range(block_count(upload['size']))])
+    storage.get_file_registry().complete_upload(upload['upload_id'], digest)
+    return digest
+
+def remove_upload(upload_id):
+    storage.get_file_registry().remove_upload(upload_id)
+    if os.path.exists(upload_path(upload_id)):
+        os.remove(upload_path(upload_id))
+
+def claim_upload(upload_id):
+    '''
+    Hard link a completed upload to a new file in the uploads folder, for one request to consume
+    (conversions remove their input when done): an upload can be converted many times while it lives.
+    Returns (filename, filepath, content_digest), raises LookupError if there is no such completed upload.
+    '''
+    registry = storage.get_file_registry()
+    upload = registry.get_upload(upload_id)
+    if upload is None or upload['digest'] is None or not os.path.exists(upload_path(upload_id)):
+        raise LookupError('Upload not found or not complete')
+    extension = upload['filename'].rsplit('.', 1)[1].lower() if '.' in upload['filename'] else ''
+    filepath = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4().hex}.{extension}")
+    os.link(upload_path(upload_id), filepath)
+    os.utime(filepath) # the reaper goes by modification time, keep it off the file while it is used
+    registry.touch_upload(upload_id) # and forgets chunked uploads by their last use
+    return upload['filename'], filepath, upload['digest']
+
+def read_request_upload():
+    '''
+    Get the input file of a request: the completed chunked upload named by the "upload_id" field,
+    or else the "file" part, saved to the uploads folder.
+    Returns (filename, filepath, content_digest, error_response), error_response being None if there is an input.
+    '''
+    upload_id = request.form.get('upload_id')
+    if upload_id:
+        try:
+            return (*claim_upload(upload_id), None)
+        except LookupError as e:
+            return None, None, None, (jsonify({'error': str(e)}), 404)
+
+    if 'file' not in request.files:
+        return None, None, None, (jsonify({'error': 'No file part in the request'}), 400)
+
+    file = request.files['file']
+    if file.filename == '':
+        return None, None, None, (jsonify({'error': 'No file selected for upload'}), 400)
+
+    filename = secure_filename(file.filename)
+    extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    filepath = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4().hex}.{extension}")
+    content_digest = storage.save_upload(file, filepath)
+    return filename, filepath, content_digest, None
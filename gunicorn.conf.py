@@ -0,0 +1,35 @@
+import os
+import instrumentation
+import model_pool
+import reaper
+import translation
+
+# threaded workers: a request waiting on ffmpeg or Whisper holds a thread, not a whole worker,
+# so one worker process oversees many conversions at once (up to resources.FFMPEG_MAX_CHILDREN ffmpeg children)
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+
+def on_starting(server):
+    '''
+    Install translation packages from a local directory once, before any worker starts
+    '''
+    if translation.ARGOS_PACKAGE_DIR:
+        installed = translation.provision_from_directory(translation.ARGOS_PACKAGE_DIR)
+        server.log.info(f"Provisioned {len(installed)} translation package(s) from {translation.ARGOS_PACKAGE_DIR}")
+
+def post_fork(server, worker):
+    '''
+    Give every worker its own Whisper model pool, optionally loading it before the first request,
+    and start the worker's output reaper
+    '''
+    reaper.start_reaper()
+    model_pool.reset_model_pool()
+    if model_pool.WHISPER_PRELOAD:
+        model_pool.get_model_pool().preload()
+        server.log.info(f"Worker {worker.pid} preloaded {model_pool.WHISPER_POOL_SIZE} Whisper model(s)")
+
+def worker_exit(server, worker):
+    '''
+    Flush the metrics the worker has not reported yet
+    '''
+    instrumentation.get_metrics().flush()
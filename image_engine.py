@@ -0,0 +1,160 @@
+import logging
+import os
+from instrumentation import stage
+from job_queue import remove_partial_output, run_command
+
+try:
+    from PIL import Image
+except ImportError: # Pillow not installed: every image goes through ffmpeg
+    Image = None
+
+# "auto" converts small images in process and the rest with ffmpeg, "ffmpeg" always uses ffmpeg
+IMAGE_ENGINE = os.environ.get('IMAGE_ENGINE', 'auto')
+# images above either limit are converted by ffmpeg, which streams them instead of holding them in memory
+IMAGE_ENGINE_MAX_BYTES = int(os.environ.get('IMAGE_ENGINE_MAX_BYTES', 8 * 1024 * 1024))
+IMAGE_ENGINE_MAX_PIXELS = int(os.environ.get('IMAGE_ENGINE_MAX_PIXELS', 4096 * 4096))
+
+# file extensions the in-process engine reads and writes, mapped to Pillow format names
+PILLOW_FORMATS = {
+    'jpg': 'JPEG',
+    'jpeg': 'JPEG',
+    'png': 'PNG',
+    'bmp': 'BMP',
+    'gif': 'GIF',
+    'tiff': 'TIFF',
+    'webp': 'WEBP',
+}
+# formats that cannot store an alpha channel
+OPAQUE_FORMATS = ['JPEG', 'BMP']
+logger = logging.getLogger(__name__)
+
+# JPEG decoders can decode at 1/2, 1/4 or 1/8 of the size by scaling the DCT, much cheaper than a full decode
+DCT_SCALES = [8, 4, 2, 1]
+
+def _transposes():
+    # the rotations match ffmpeg's transpose filters: 90 is clockwise, 270 counterclockwise
+    return {
+        'rotate': {90: Image.Transpose.ROTATE_270, 180: Image.Transpose.ROTATE_180, 270: Image.Transpose.ROTATE_90},
+        'flip': {
+            'h': [Image.Transpose.FLIP_LEFT_RIGHT],
+            'v': [Image.Transpose.FLIP_TOP_BOTTOM],
+            'hv': [Image.Transpose.FLIP_LEFT_RIGHT, Image.Transpose.FLIP_TOP_BOTTOM],
+            'vh': [Image.Transpose.FLIP_LEFT_RIGHT, Image.Transpose.FLIP_TOP_BOTTOM],
+        },
+    }
+
+def pillow_quality(quality):
+    '''
+    Map an ffmpeg -q:v value (1 best .. 31 worst) to a Pillow quality (95 best .. 1 worst)
+    '''
+    return max(1, min(95, round(100 - quality * 3.2)))
+
+def choose_engine(filepath, input_extension, output_format):
+    '''
+    Routing policy: 'pillow' for images small enough to convert in process, in formats Pillow
+    reads and writes, 'ffmpeg' for everything else (large or animated images, other formats)
+    '''
+    if Image is None or IMAGE_ENGINE != 'auto':
+        return 'ffmpeg'
+    if input_extension not in PILLOW_FORMATS or output_format.lower() not in PILLOW_FORMATS:
+        return 'ffmpeg'
+    if os.path.getsize(filepath) > IMAGE_ENGINE_MAX_BYTES:
+        return 'ffmpeg'
+    try:
+        # only reads the header
+        with Image.open(filepath) as image:
+            if image.width * image.height > IMAGE_ENGINE_MAX_PIXELS or getattr(image, 'n_frames', 1) > 1:
+                return 'ffmpeg'
+    except Exception:
+        return 'ffmpeg' # let ffmpeg try, and report the error if it cannot read it either
+    return 'pillow'
+
+def convert_in_process(input_filepath, output_filepath, output_format, params):
+    '''
+    Convert an image in memory with Pillow, applying the same modifications in the same order
+    as the ffmpeg filter chain: scale, rotate, flip, grayscale
+    '''
+    output_type = PILLOW_FORMATS[output_format.lower()]
+    transposes = _transposes()
+    with stage('pillow'), Image.open(input_filepath) as image:
+        image.load()
+        if params['width'] and params['height']:
+            image = image.resize((params['width'], params['height']), Image.Resampling.BICUBIC)
+        if params['rotate']:
+            image = image.transpose(transposes['rotate'][params['rotate']])
+        for flip in transposes['flip'][params['flip']] if params['flip'] else []:
+            image = image.transpose(flip)
+
+        _save(image, output_filepath, output_type, params['quality'], params['grayscale'])
+
+def _save(image, output_filepath, output_type, quality=None, grayscale=False):
+    has_alpha = image.mode in ['RGBA', 'LA', 'PA'] or 'transparency' in image.info
+    if grayscale:
+        image = image.convert('LA' if has_alpha and output_type not in OPAQUE_FORMATS else 'L')
+    elif output_type in OPAQUE_FORMATS and image.mode not in ['RGB', 'L']:
+        image = image.convert('RGB')
+    elif image.mode not in ['RGB', 'RGBA', 'L', 'LA', 'P']:
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    options = {}
+    if quality and output_type in ['JPEG', 'WEBP']:
+        options['quality'] = pillow_quality(quality)
+    image.save(output_filepath, format=output_type, **options)
+
+def dct_scale(source_width, source_height, width, height):
+    '''
+    Largest JPEG DCT scaling factor (1, 2, 4 or 8) whose decoded image still covers width x height
+    '''
+    for scale in DCT_SCALES:
+        if -(-source_width // scale) >= width and -(-source_height // scale) >= height:
+            return scale
+    return 1
+
+def choose_renditions_engine(filepath, input_extension, output_formats, width, height):
+    '''
+    Routing policy of rendition sets, whose largest rendition is width x height: 'pillow' when Pillow reads the
+    input and writes every output format, and the decoded image fits IMAGE_ENGINE_MAX_PIXELS. JPEG sources are
+    decoded in draft mode, so a large photo only needs to fit once scaled down. 'ffmpeg' for everything else.
+    '''
+    if Image is None or IMAGE_ENGINE != 'auto':
+        return 'ffmpeg'
+    if input_extension not in PILLOW_FORMATS or any(output_format.lower() not in PILLOW_FORMATS for output_format in output_formats):
+        return 'ffmpeg'
+    try:
+        with Image.open(filepath) as image:
+            scale = dct_scale(image.width, image.height, width, height) if image.format == 'JPEG' else 1
+            if (image.width // scale) * (image.height // scale) > IMAGE_ENGINE_MAX_PIXELS or getattr(image, 'n_frames', 1) > 1:
+                return 'ffmpeg'
+    except Exception:
+        return 'ffmpeg'
+    return 'pillow'
+
+def convert_renditions_in_process(input_filepath, outputs):
+    '''
+    Write several sizes of an image, [(output_filepath, output_format, width, height, quality)], from a single decode.
+    JPEG sources are decoded in draft mode, at the smallest DCT scale still covering the largest rendition.
+    '''
+    width = max(output[2] for output in outputs)
+    height = max(output[3] for output in outputs)
+    with stage('pillow'), Image.open(input_filepath) as image:
+        if image.format == 'JPEG':
+            image.draft(image.mode, (width, height))
+        image.load()
+        for output_filepath, output_format, width, height, quality in outputs:
+            rendition = image if image.size == (width, height) else image.resize((width, height), Image.Resampling.BICUBIC, reducing_gap=3.0)
+            _save(rendition, output_filepath, PILLOW_FORMATS[output_format.lower()], quality)
+
+def run_in_process(convert, args, command, input_filepath, output_filepaths):
+    '''
+    Job body: write images in process with convert(*args) (convert_in_process or convert_renditions_in_process),
+    falling back to the ffmpeg command when Pillow fails, as the synchronous routes do. Removes the input afterwards.
+    '''
+    try:
+        convert(*args)
+    except Exception as e:
+        logger.warning("In-process image conversion failed, falling back to ffmpeg: %s", e)
+        remove_partial_output(*output_filepaths) # ffmpeg does not overwrite what Pillow left
+        run_command(command, None, output_filepaths)
+    finally:
+        if os.path.exists(input_filepath):
+            os.remove(input_filepath)
@@ -0,0 +1,243 @@
+from contextlib import contextmanager
+from threading import Lock
+from flask import g, has_request_context, request
+import logging
+import os
+import time
+import uuid
+
+# metrics are accumulated in process and added to the shared registry counters at most this often
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))
+METRIC_PREFIX = 'formatconverter_'
+# upper bounds (seconds) of the stage duration histogram buckets
+STAGE_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+METRIC_HELP = {
+    'stage_seconds': ('histogram', 'Time spent in each stage of a request or job'),
+    'requests_total': ('counter', 'Requests handled, by endpoint and status'),
+    'request_bytes_total': ('counter', 'Bytes received in request bodies'),
+    'response_bytes_total': ('counter', 'Bytes sent in response bodies'),
+    'result_cache_total': ('counter', 'Conversion result cache lookups, by result'),
+    'failures_total': ('counter', 'Failed ffmpeg runs, jobs and requests, by kind'),
+    'reaper_sweeps_total': ('counter', 'Reaper sweeps run'),
+    'reaper_expired_files_total': ('counter', 'Outputs deleted by the reaper because their registry entry expired'),
+    'reaper_evicted_files_total': ('counter', 'Outputs evicted by the reaper to fit the byte budget'),
+    'reaper_evicted_bytes_total': ('counter', 'Bytes evicted by the reaper to fit the byte budget'),
+    'result_cache_evictions_total': ('counter', 'Entries dropped from the result cache to fit its byte budget'),
+}
+# plain registry counters that only ever grow, exported as Prometheus counters under their name + '_total'
+MONOTONIC_COUNTERS = ['reaper_sweeps', 'reaper_expired_files', 'reaper_evicted_files', 'reaper_evicted_bytes', 'result_cache_evictions']
+
+logger = logging.getLogger(__name__)
+
+def _series(name, labels):
+    if not labels:
+        return METRIC_PREFIX + name
+    return METRIC_PREFIX + name + '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
+
+class Metrics:
+    '''
+    Counters and histograms of the current process. Values are accumulated in memory and periodically
+    added to the counters of the shared registry, where every gunicorn worker and job process meets,
+    so /metrics reports totals for the whole machine. Series are stored under their Prometheus names.
+    '''
+    def __init__(self, flush_seconds=METRICS_FLUSH_SECONDS):
+        self.flush_seconds = flush_seconds
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._lock = Lock()
+
+    def inc(self, name, amount=1, **labels):
+        series = _series(name, labels)
+        with self._lock:
+            self._pending[series] = self._pending.get(series, 0) + amount
+        self.maybe_flush()
+
+    def observe(self, name, seconds, **labels):
+        '''
+        Record a duration in a histogram
+        '''
+        with self._lock:
+            for bound in STAGE_BUCKETS + ['+Inf']: # every bucket is written so the series all exist
+                series = _series(name + '_bucket', dict(labels, le=bound))
+                self._pending[series] = self._pending.get(series, 0) + (bound == '+Inf' or seconds <= bound)
+            for suffix, amount in [('_sum', seconds), ('_count', 1)]:
+                series = _series(name + suffix, labels)
+                self._pending[series] = self._pending.get(series, 0) + amount
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        import storage
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            storage.get_file_registry().bump_counters(pending)
+        except Exception:
+            logger.exception('Failed to flush metrics')
+            with self._lock: # keep them for the next flush
+                for series, amount in pending.items():
+                    self._pending[series] = self._pending.get(series, 0) + amount
+
+_metrics = None
+_metrics_lock = Lock()
+
+def get_metrics():
+    '''
+    Get the metrics of the current process
+    '''
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = Metrics()
+    return _metrics
+
+def record_stage(name, seconds):
+    '''
+    Record time spent in a stage: in the stage histogram, and in the timings of the current request if any
+    '''
+    get_metrics().observe('stage_seconds', seconds, stage=name)
+    if has_request_context():
+        timings = g.setdefault('stage_timings', {})
+        timings[name] = timings.get(name, 0.0) + seconds
+
+@contextmanager
+def stage(name):
+    '''
+    Time the with block as a stage (upload, ffmpeg, decode, ...).
+    Stages entered several times in one request add up.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+def timed_iter(name, iterable):
+    '''
+    Wrap a generator so the time spent producing its items is recorded as a stage once it is exhausted,
+    for work done while a response is streamed (see finish_request)
+    '''
+    elapsed = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        record_stage(name, elapsed)
+
+def stage_timings():
+    '''
+    Stage timings of the current request so far, {stage: seconds}
+    '''
+    return dict(g.get('stage_timings', {})) if has_request_context() else {}
+
+def server_timing_header(timings):
+    return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings.items())
+
+def _finish_stream(body, endpoint, request_id, timings, reported):
+    # count the bytes of a streamed body as they are sent, then log the stages that ran while it was streamed
+    # (timings, filled in as they end), which the Server-Timing header sent before the body could not report
+    sent = 0
+    try:
+        for chunk in body:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        get_metrics().inc('response_bytes_total', sent, endpoint=endpoint)
+        streamed = {name: seconds - reported.get(name, 0.0) for name, seconds in timings.items() if seconds > reported.get(name, 0.0)}
+        if streamed:
+            logger.info('%s streamed request_id=%s %s', endpoint, request_id,
+                        ' '.join(f'{name}={seconds * 1000:.1f}ms' for name, seconds in streamed.items()),
+                        extra={'request_id': request_id, 'streamed_timings': streamed})
+
+def start_request():
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.request_start = time.perf_counter()
+
+def finish_request(response):
+    '''
+    after_request hook: count the request and its bytes, report its stage timings in a Server-Timing header,
+    and log one line per request with its timings. Streamed responses only report the stages that ran before
+    streaming started, their bytes are counted as they are sent, and the stages that ran while streaming
+    are logged in a second line once the body is sent.
+    '''
+    endpoint = request.endpoint or 'unknown'
+    metrics = get_metrics()
+    metrics.inc('requests_total', endpoint=endpoint, status=response.status_code)
+    if request.content_length:
+        metrics.inc('request_bytes_total', request.content_length, endpoint=endpoint)
+    if response.status_code >= 500:
+        metrics.inc('failures_total', kind='request')
+    timings = stage_timings()
+    if response.is_streamed and not response.direct_passthrough:
+        response.response = _finish_stream(response.response, endpoint, g.get('request_id'),
+                                           g.setdefault('stage_timings', {}), timings)
+    elif response.content_length:
+        metrics.inc('response_bytes_total', response.content_length, endpoint=endpoint)
+
+    if timings:
+        response.headers['Server-Timing'] = server_timing_header(timings)
+    response.headers['X-Request-ID'] = g.get('request_id', '')
+
+    elapsed = (time.perf_counter() - g.get('request_start', time.perf_counter())) * 1000
+    logger.info('%s %s %s %.1fms request_id=%s %s', request.method, request.path, response.status_code, elapsed,
+                g.get('request_id'), ' '.join(f'{name}={seconds * 1000:.1f}ms' for name, seconds in timings.items()))
+    return response
+
+def render_prometheus(counters):
+    '''
+    Render registry counters holding metric series (and the plain storage counters) in the Prometheus text format
+    '''
+    lines = []
+    families = {}
+    for series, value in sorted(counters.items()):
+        if series.startswith(METRIC_PREFIX):
+            name = series[len(METRIC_PREFIX):].split('{')[0]
+            for suffix in ['_bucket', '_sum', '_count']:
+                if name.endswith(suffix) and name[:-len(suffix)] in METRIC_HELP:
+                    name = name[:-len(suffix)]
+            families.setdefault(name, []).append((series, value))
+        else: # reaper and storage counters
+            name = series + '_total' if series in MONOTONIC_COUNTERS else series
+            families.setdefault(name, []).append((METRIC_PREFIX + name, value))
+
+    for name, samples in families.items():
+        metric_type, help_text = METRIC_HELP.get(name, ('gauge', name.replace('_', ' ')))
+        lines.append(f'# HELP {METRIC_PREFIX}{name} {help_text}')
+        lines.append(f'# TYPE {METRIC_PREFIX}{name} {metric_type}')
+        samples.sort(key=lambda sample: _sample_order(sample[0]))
+        lines.extend(f'{series} {_format_value(value)}' for series, value in samples)
+    return '\n'.join(lines) + '\n'
+
+def _format_value(value):
+    # every digit: byte counters and histogram sums grow past what a short float format keeps
+    value = float(value)
+    return str(int(value)) if value.is_integer() and abs(value) < 2 ** 53 else repr(value)
+
+def _sample_order(series):
+    # histogram samples grouped by label set: buckets in increasing order of their bound, then sum and count
+    name, _, labels = series.partition('{')
+    labels = [label for label in labels.rstrip('}').split(',') if label]
+    bound = next((label.split('"')[1] for label in labels if label.startswith('le=')), None)
+    rank = 0 if name.endswith('_bucket') else 1 if name.endswith('_sum') else 2
+    other_labels = [label for label in labels if not label.startswith('le=')]
+    return (other_labels, rank, float('inf') if bound in [None, '+Inf'] else float(bound))
+
+def init_app(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
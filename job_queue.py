@@ -0,0 +1,143 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from threading import Lock
+import multiprocessing
+import os
+import subprocess
+import time
+import uuid
+import storage
+from instrumentation import get_metrics
+from resources import run_ffmpeg
+
+# Every job class gets its own pool, so short conversions never queue behind long transcriptions
+JOB_CLASSES = {
+    'short': int(os.environ.get('JOB_SHORT_WORKERS', 2)),
+    'long': int(os.environ.get('JOB_LONG_WORKERS', 1)),
+    # batch members fan out over this many processes, the core budget for one batch worker
+    'batch': int(os.environ.get('BATCH_WORKERS', os.cpu_count() or 1)),
+    # chunks of long media are transcribed in parallel, every process keeping its own warm models
+    'chunks': int(os.environ.get('TRANSCRIBE_CHUNK_WORKERS', max(1, (os.cpu_count() or 1) // 4))),
+}
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', 3600))
+
+_executors = {}
+_futures = {}
+_lock = Lock()
+
+def _get_executor(job_class):
+    with _lock:
+        if job_class not in _executors:
+            # spawn instead of fork: the web process runs threads and may hold loaded models
+            _executors[job_class] = ProcessPoolExecutor(
+                max_workers=JOB_CLASSES[job_class],
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _executors[job_class]
+
+def _run_and_flush(fn, *args):
+    # job processes flush their metrics after every job, they may stay idle for long afterwards
+    try:
+        return fn(*args)
+    finally:
+        get_metrics().flush()
+
+def submit_job(job_class, fn, *args, on_success=None, inputs=()):
+    '''
+    Run fn(*args) in the process pool of the given job class and return the job id right away.
+    on_success, if given, runs in this process with the result of fn and returns the job result.
+    The job status is kept in the shared file registry, so any worker can report it, along with the
+    input files of the job (inputs), which the reaper leaves alone until the job has finished.
+    '''
+    if job_class not in JOB_CLASSES:
+        raise ValueError(f"Unknown job class {job_class}")
+    registry = storage.get_file_registry()
+    registry.prune_jobs(time.time() - JOB_RETENTION_SECONDS)
+
+    job_id = uuid.uuid4().hex
+    registry.save_job(job_id, job_class, 'queued')
+    if inputs:
+        registry.save_job_inputs(job_id, inputs)
+    future = _get_executor(job_class).submit(_run_and_flush, fn, *args)
+    with _lock:
+        _futures[job_id] = future
+
+    def done(future):
+        try:
+            result = future.result()
+            registry.save_job(job_id, job_class, 'done', result=on_success(result) if on_success else result)
+        except Exception as e:
+            get_metrics().inc('failures_total', kind='job')
+            registry.save_job(job_id, job_class, 'failed', error=str(e))
+        finally:
+            with _lock:
+                _futures.pop(job_id, None)
+
+    future.add_done_callback(done)
+    return job_id
+
+def submit_task(job_class, fn, *args):
+    '''
+    Run fn(*args) in the pool of the given job class without tracking it as a job, returns the future
+    '''
+    return _get_executor(job_class).submit(_run_and_flush, fn, *args)
+
+def run_unordered(job_class, fn, args_list):
+    '''
+    Run fn(*args) for every args of args_list in the pool of the given job class.
+    Yields (index, result, error) in completion order, error being None on success.
+    '''
+    futures = {submit_task(job_class, fn, *args): index for index, args in enumerate(args_list)}
+    try:
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+    finally:
+        for future in futures:
+            future.cancel() # the client went away, drop what has not started yet
+
+def get_job(job_id):
+    '''
+    Get the public status of a job, or None if it is unknown
+    '''
+    job = storage.get_file_registry().get_job(job_id)
+    if job is None:
+        return None
+
+    status = job['status']
+    future = _futures.get(job_id)
+    if status == 'queued' and future is not None and future.running():
+        status = 'running' # only the submitting worker can tell queued and running apart
+
+    return {
+        'job_id': job_id,
+        'class': job['job_class'],
+        'status': status,
+        'result': job['result'],
+        'error': job['error'],
+    }
+
+def remove_partial_output(*output_filepaths):
+    '''
+    Remove what a failed or killed ffmpeg run left of its outputs
+    '''
+    for output_filepath in output_filepaths:
+        if output_filepath and os.path.exists(output_filepath):
+            os.remove(output_filepath)
+
+def run_command(command, input_filepath=None, output_filepaths=()):
+    '''
+    Job body: run an ffmpeg command, removing its input file afterwards and its output_filepaths if it fails
+    '''
+    try:
+        run_ffmpeg(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        remove_partial_output(*output_filepaths)
+        raise RuntimeError(f'FFmpeg failed: {e.stderr.decode()}')
+    except subprocess.TimeoutExpired as e:
+        remove_partial_output(*output_filepaths)
+        raise RuntimeError(f'FFmpeg timed out after {e.timeout:g} seconds')
+    finally:
+        if input_filepath and os.path.exists(input_filepath):
+            os.remove(input_filepath)
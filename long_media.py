@@ -0,0 +1,220 @@
+import os
+import re
+import subprocess
+import threading
+import logging
+import numpy as np
+from instrumentation import get_metrics, stage
+from job_queue import submit_task
+from model_pool import transcribe_segments
+from resources import FFMPEG_THREADS, FFMPEG_TIMEOUT_SECONDS, child_slot, get_governor, requested_threads, run_ffmpeg, with_threads
+
+# media at least this long is split into chunks transcribed in parallel
+LONG_MEDIA_SECONDS = float(os.environ.get('LONG_MEDIA_SECONDS', 600))
+CHUNK_SECONDS = float(os.environ.get('TRANSCRIBE_CHUNK_SECONDS', 300))
+CHUNK_OVERLAP_SECONDS = float(os.environ.get('TRANSCRIBE_CHUNK_OVERLAP_SECONDS', 2))
+SILENCE_NOISE = os.environ.get('SILENCE_NOISE', '-35dB')
+SILENCE_MIN_SECONDS = float(os.environ.get('SILENCE_MIN_SECONDS', 0.5))
+# longest run of words compared when removing duplicates at chunk seams
+SEAM_MAX_WORDS = 8
+SAMPLE_RATE = 16000
+# long media is decoded and fed to the chunk planner in blocks of this many seconds
+DECODE_BLOCK_SECONDS = 30
+
+logger = logging.getLogger(__name__)
+
+class SilenceTracker:
+    '''
+    Find silences in audio fed block by block while it is being decoded, like ffmpeg's silencedetect:
+    a silence is a run of 20 ms frames quieter than SILENCE_NOISE lasting at least SILENCE_MIN_SECONDS.
+    The midpoint of every silence found so far is in `silences`, in seconds.
+    '''
+    FRAME_SAMPLES = SAMPLE_RATE // 50
+
+    def __init__(self, noise=SILENCE_NOISE, min_seconds=SILENCE_MIN_SECONDS):
+        self.threshold = 10 ** (float(noise.rstrip('dB')) / 20)
+        self.min_frames = max(1, round(min_seconds * SAMPLE_RATE / self.FRAME_SAMPLES))
+        self.silences = []
+        self._frames = 0
+        self._run_start = None
+        self._rest = np.empty(0, dtype=np.float32)
+
+    def _close_run(self):
+        if self._run_start is not None and self._frames - self._run_start >= self.min_frames:
+            midpoint = (self._run_start + self._frames) / 2
+            self.silences.append(midpoint * self.FRAME_SAMPLES / SAMPLE_RATE)
+        self._run_start = None
+
+    def feed(self, samples):
+        samples = np.concatenate([self._rest, samples])
+        count = len(samples) // self.FRAME_SAMPLES
+        self._rest = samples[count * self.FRAME_SAMPLES:]
+        frames = samples[:count * self.FRAME_SAMPLES].reshape(count, self.FRAME_SAMPLES)
+        for quiet in np.sqrt(np.mean(frames ** 2, axis=1)) < self.threshold:
+            if quiet and self._run_start is None:
+                self._run_start = self._frames
+            elif not quiet:
+                self._close_run()
+            self._frames += 1
+
+    def finish(self):
+        self._close_run()
+        return self.silences
+
+def next_cut(position, silences, chunk_seconds=CHUNK_SECONDS):
+    '''
+    Where the chunk starting at position should end: the silence closest to position + chunk_seconds
+    (within 20% of a chunk), or a hard cut there when there is none
+    '''
+    target = position + chunk_seconds
+    window = chunk_seconds * 0.2
+    candidates = [silence for silence in silences if abs(silence - target) <= window]
+    return min(candidates, key=lambda silence: abs(silence - target)) if candidates else target
+
+def _decode_command(filepath, start=None, duration=None):
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+    if start:
+        command.extend(["-ss", f"{start:.3f}"])
+    if duration:
+        command.extend(["-t", f"{duration:.3f}"])
+    command.extend(["-i", filepath, "-vn", "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "f32le",
+                    "-threads", str(FFMPEG_THREADS), "pipe:1"])
+    return command
+
+def decode_audio(filepath, start=None, duration=None):
+    '''
+    Decode (part of) the audio of an audio or video file through an ffmpeg pipe into a 16 kHz mono float32 buffer,
+    ready to be handed to Whisper without any intermediate file
+    '''
+    with stage('decode'):
+        result = run_ffmpeg(_decode_command(filepath, start, duration), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to decode audio: {result.stderr.decode(errors='replace').strip()}")
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+def iter_audio_blocks(filepath, block_seconds=DECODE_BLOCK_SECONDS):
+    '''
+    Like decode_audio, but yield the audio in float32 blocks of block_seconds as ffmpeg decodes it.
+    ffmpeg holds a child slot while it runs and is killed after FFMPEG_TIMEOUT_SECONDS, raising subprocess.TimeoutExpired.
+    '''
+    command = _decode_command(filepath)
+    block_bytes = int(block_seconds * SAMPLE_RATE) * 4
+    with child_slot(), get_governor().allocate('ffmpeg', requested_threads(command)) as n_threads:
+        process = subprocess.Popen(with_threads(command, n_threads), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        timed_out = threading.Event()
+
+        def expire():
+            timed_out.set()
+            process.kill()
+
+        # the blocking reads cannot take a timeout, so a timer kills ffmpeg once the deadline passes
+        watchdog = threading.Timer(FFMPEG_TIMEOUT_SECONDS, expire) if FFMPEG_TIMEOUT_SECONDS else None
+        if watchdog:
+            watchdog.daemon = True
+            watchdog.start()
+        try:
+            while True:
+                data = process.stdout.read(block_bytes)
+                if not data:
+                    break
+                yield np.frombuffer(data[:len(data) - len(data) % 4], dtype=np.float32)
+            error = process.stderr.read().decode(errors='replace').strip()
+            if process.wait() != 0:
+                if timed_out.is_set():
+                    get_metrics().inc('failures_total', kind='ffmpeg_timeout')
+                    raise subprocess.TimeoutExpired(command, FFMPEG_TIMEOUT_SECONDS)
+                get_metrics().inc('failures_total', kind='ffmpeg')
+                raise RuntimeError(f"Failed to decode audio: {error}")
+        finally:
+            if watchdog:
+                watchdog.cancel()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            process.stderr.close()
+
+def transcribe_chunk(audio, offset, language=None):
+    '''
+    Job body: transcribe one decoded chunk, timestamps shifted by its offset (seconds) in the whole file
+    '''
+    segments = transcribe_segments(audio, language)
+    return [dict(segment, start=segment['start'] + offset, end=segment['end'] + offset) for segment in segments]
+
+def _normalize_word(word):
+    return re.sub(r'[^\w]', '', word.lower())
+
+def strip_repeated_words(previous_text, text):
+    '''
+    Drop the leading words of text that repeat the trailing words of previous_text
+    '''
+    previous_words = [_normalize_word(word) for word in previous_text.split()]
+    words = text.split()
+    normalized = [_normalize_word(word) for word in words]
+    for count in range(min(SEAM_MAX_WORDS, len(previous_words), len(words)), 0, -1):
+        if previous_words[-count:] == normalized[:count]:
+            return ' '.join(words[count:])
+    return text
+
+def merge_chunk_segments(chunks):
+    '''
+    Merge the segments of consecutive chunks, given as (cut, segments) in timeline order.
+    Segments lying entirely in the overlap before a chunk's cut were already produced by the previous chunk
+    and are dropped; a segment straddling the cut loses the words the previous chunk already ended with.
+    '''
+    merged = []
+    for cut, segments in chunks:
+        for segment in segments:
+            if merged and segment['end'] <= cut:
+                continue
+            if merged and segment['start'] < cut:
+                segment = dict(segment, text=strip_repeated_words(merged[-1]['text'], segment['text']))
+                if not segment['text'].strip():
+                    continue
+            merged.append(segment)
+    return merged
+
+def transcribe_long_media(filepath, language=None):
+    '''
+    Transcribe long media in parallel chunks cut at silences.
+    The audio is decoded once, through a pipe: silences are tracked as it comes in and every chunk is handed
+    to the chunk process pool (each process keeping its own warm Whisper models) as soon as it is decoded,
+    so transcription runs while the rest of the file is still being decoded.
+    '''
+    tracker = SilenceTracker()
+    window = CHUNK_SECONDS * 0.2
+    # decoded samples from buffer_start (seconds) on, older ones are dropped once every chunk using them is out
+    buffer = np.empty(0, dtype=np.float32)
+    buffer_start = 0.0
+    position = 0.0
+    chunks = []
+
+    def submit(end):
+        start = max(0.0, position - CHUNK_OVERLAP_SECONDS) if position else 0.0
+        first = int(round((start - buffer_start) * SAMPLE_RATE))
+        last = int(round((end - buffer_start) * SAMPLE_RATE))
+        chunks.append((position, submit_task('chunks', transcribe_chunk, buffer[first:last].copy(), start, language)))
+
+    try:
+        for block in iter_audio_blocks(filepath, DECODE_BLOCK_SECONDS):
+            tracker.feed(block)
+            buffer = np.concatenate([buffer, block])
+            decoded = buffer_start + len(buffer) / SAMPLE_RATE
+            # a cut is only final once the whole window around its target has been decoded
+            while decoded - position > CHUNK_SECONDS + window:
+                cut = next_cut(position, tracker.silences, CHUNK_SECONDS)
+                submit(cut)
+                position = cut
+                drop = int((max(0.0, position - CHUNK_OVERLAP_SECONDS) - buffer_start) * SAMPLE_RATE)
+                buffer = buffer[drop:]
+                buffer_start += drop / SAMPLE_RATE
+        tracker.finish()
+        if not buffer_start + len(buffer):
+            raise RuntimeError("No audio found in the media")
+        submit(buffer_start + len(buffer) / SAMPLE_RATE)
+        logger.info("Transcribing %.0fs of media in %d chunk(s)", buffer_start + len(buffer) / SAMPLE_RATE, len(chunks))
+
+        return merge_chunk_segments([(cut, future.result()) for cut, future in chunks])
+    finally:
+        for _, future in chunks:
+            future.cancel()
@@ -0,0 +1,154 @@
+import json
+import os
+import re
+import subprocess
+from instrumentation import get_metrics, stage
+from resources import FFMPEG_TIMEOUT_SECONDS, child_slot
+
+FFPROBE_BINARY = os.environ.get('FFPROBE_BINARY', 'ffprobe')
+
+# codecs each output container takes as is, so compatible inputs are remuxed instead of transcoded
+COPY_CODECS = {
+    'mp3': {'mp3'},
+    'wav': {'pcm_s16le', 'pcm_s24le', 'pcm_s32le', 'pcm_f32le', 'pcm_u8'},
+    'flac': {'flac'},
+    'aac': {'aac'},
+    'm4a': {'aac', 'alac'},
+    'ogg': {'vorbis', 'opus', 'flac'},
+    'opus': {'opus'},
+    'webm': {'opus', 'vorbis'},
+    'wma': {'wmav1', 'wmav2'},
+    'aiff': {'pcm_s16be', 'pcm_s24be', 'pcm_s32be'},
+}
+# encoder names a request may ask for, mapped to the codec they produce
+ENCODER_CODECS = {
+    'libmp3lame': 'mp3',
+    'libvorbis': 'vorbis',
+    'libopus': 'opus',
+    'libfdk_aac': 'aac',
+}
+CHANNEL_LAYOUTS = {'mono': 1, 'stereo': 2, '2.1': 3, 'quad': 4, '4.0': 4, '5.0': 5, '5.1': 6, '6.1': 7, '7.1': 8}
+
+BANNER_FORMAT_PATTERN = re.compile(r"Input #0, ([\w,]+), from")
+BANNER_DURATION_PATTERN = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+BANNER_STREAM_PATTERN = re.compile(r'Stream #0:\d+\S*: (Audio|Video): (\w+)([^\n]*)')
+BANNER_RATE_PATTERN = re.compile(r', (\d+) Hz')
+BANNER_CHANNELS_PATTERN = re.compile(r'Hz, ([\w.]+)(?: channels)?')
+BANNER_SIZE_PATTERN = re.compile(r', (\d+)x(\d+)')
+
+def _probe_with_ffprobe(filepath):
+    result = subprocess.run(
+        [FFPROBE_BINARY, "-v", "error", "-show_format", "-show_streams", "-of", "json", filepath],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=FFMPEG_TIMEOUT_SECONDS or None,
+    )
+    if result.returncode != 0:
+        return None
+    data = json.loads(result.stdout or b'{}')
+    streams = [
+        {
+            'type': stream.get('codec_type'),
+            'codec': stream.get('codec_name'),
+            'sample_rate': int(stream['sample_rate']) if stream.get('sample_rate') else None,
+            'channels': stream.get('channels'),
+            'width': stream.get('width'),
+            'height': stream.get('height'),
+        }
+        for stream in data.get('streams', [])
+    ]
+    format_info = data.get('format', {})
+    duration = format_info.get('duration')
+    return {
+        'format': format_info.get('format_name'),
+        'duration': float(duration) if duration else 0.0,
+        'streams': streams,
+    }
+
+def _probe_with_ffmpeg(filepath):
+    # ffmpeg builds without ffprobe: read the same information from the input banner
+    result = subprocess.run(["ffmpeg", "-hide_banner", "-i", filepath], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            timeout=FFMPEG_TIMEOUT_SECONDS or None)
+    output = result.stderr.decode(errors='replace')
+    format_match = BANNER_FORMAT_PATTERN.search(output)
+    if not format_match:
+        return None
+
+    streams = []
+    for kind, codec, details in BANNER_STREAM_PATTERN.findall(output):
+        rate = BANNER_RATE_PATTERN.search(details)
+        size = BANNER_SIZE_PATTERN.search(details) if kind == 'Video' else None
+        layout = BANNER_CHANNELS_PATTERN.search(details)
+        channels = None
+        if layout:
+            channels = int(layout.group(1)) if layout.group(1).isdigit() else CHANNEL_LAYOUTS.get(layout.group(1))
+        streams.append({
+            'type': kind.lower(),
+            'codec': codec,
+            'sample_rate': int(rate.group(1)) if rate else None,
+            'channels': channels,
+            'width': int(size.group(1)) if size else None,
+            'height': int(size.group(2)) if size else None,
+        })
+
+    duration = 0.0
+    duration_match = BANNER_DURATION_PATTERN.search(output)
+    if duration_match:
+        hours, minutes, seconds = duration_match.groups()
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    return {'format': format_match.group(1), 'duration': duration, 'streams': streams}
+
+def probe_media(filepath):
+    '''
+    Probe the container and streams of a media file, cheaply and without decoding it.
+    Returns {'format', 'duration', 'streams': [{'type', 'codec', 'sample_rate', 'channels', 'width', 'height'}]},
+    raises ValueError if the file is not media ffmpeg can read. The probe takes one of the process' child slots
+    and is killed after FFMPEG_TIMEOUT_SECONDS like any ffmpeg run; raises TimeoutError if no slot frees up.
+    '''
+    with child_slot(), stage('probe'):
+        try:
+            try:
+                info = _probe_with_ffprobe(filepath)
+            except FileNotFoundError:
+                info = _probe_with_ffmpeg(filepath)
+        except subprocess.TimeoutExpired:
+            get_metrics().inc('failures_total', kind='ffmpeg_timeout')
+            raise ValueError('The file could not be probed in time.')
+    if not info or not info['streams']:
+        raise ValueError('The file is not a valid media file.')
+    return info
+
+def audio_stream(info):
+    '''
+    First audio stream of a probe result, raises ValueError if there is none
+    '''
+    for stream in info['streams']:
+        if stream['type'] == 'audio':
+            return stream
+    raise ValueError('The file does not contain an audio stream.')
+
+def video_stream(info):
+    '''
+    First video (or image) stream of a probe result, raises ValueError if there is none
+    '''
+    for stream in info['streams']:
+        if stream['type'] == 'video' and stream['width'] and stream['height']:
+            return stream
+    raise ValueError('The file does not contain an image.')
+
+def can_stream_copy(info, output_format, params):
+    '''
+    Check if converting the probed file to output_format with the given audio parameters is only a change
+    of container, in which case the audio stream can be copied instead of transcoded
+    '''
+    stream = audio_stream(info)
+    if params.get('bitrate') or params.get('volume'):
+        return False
+    if stream['codec'] not in COPY_CODECS.get(output_format, set()):
+        return False
+    codec = params.get('codec')
+    if codec and codec != 'copy' and ENCODER_CODECS.get(codec, codec) != stream['codec']:
+        return False
+    if params.get('sample_rate') and str(stream['sample_rate']) != params['sample_rate']:
+        return False
+    if params.get('channels') and str(stream['channels']) != params['channels']:
+        return False
+    return True
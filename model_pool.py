@@ -0,0 +1,131 @@
+from contextlib import contextmanager
+from queue import Queue, Empty
+from threading import Lock
+import logging
+import os
+from resources import WHISPER_THREADS, get_governor
+from instrumentation import stage
+
+WHISPER_MODEL = os.environ.get('WHISPER_MODEL', 'base-q5_1')
+WHISPER_POOL_SIZE = int(os.environ.get('WHISPER_POOL_SIZE', 1))
+WHISPER_PRELOAD = os.environ.get('WHISPER_PRELOAD', '0') == '1'
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = Lock()
+
+class ModelPool:
+    '''
+    A pool of loaded Whisper models owned by a single worker process.
+    Models are created lazily up to `size` and reused across requests;
+    a request checks a model out and blocks if all of them are busy.
+    '''
+    def __init__(self, model_name=WHISPER_MODEL, size=WHISPER_POOL_SIZE, n_threads=WHISPER_THREADS):
+        self.model_name = model_name
+        self.size = max(1, size)
+        self.n_threads = n_threads
+        self._idle = Queue()
+        self._created = 0
+        self._lock = Lock()
+
+    def _load_model(self):
+        from pywhispercpp.model import Model
+        logger.info("Loading Whisper model %s (pid %d)", self.model_name, os.getpid())
+        with stage('model_load'):
+            return Model(self.model_name, n_threads=self.n_threads)
+
+    def preload(self):
+        '''
+        Load every model of the pool up front, e.g. at worker boot
+        '''
+        while True:
+            with self._lock:
+                if self._created >= self.size:
+                    return
+                self._created += 1
+            try:
+                self._idle.put(self._load_model())
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+    def _acquire(self, timeout=None):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._load_model()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=timeout)
+        except Empty:
+            raise RuntimeError("Timed out waiting for a free Whisper model")
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        '''
+        Check a model out of the pool for the duration of the with block
+        '''
+        model = self._acquire(timeout)
+        try:
+            yield model
+        finally:
+            self._idle.put(model)
+
+    def stats(self):
+        return {
+            'model': self.model_name,
+            'size': self.size,
+            'loaded': self._created,
+            'idle': self._idle.qsize(),
+        }
+
+def get_model_pool():
+    '''
+    Get the Whisper model pool of the current process, creating it on first use
+    '''
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ModelPool()
+    return _pool
+
+def reset_model_pool():
+    '''
+    Drop the pool of the current process, used after fork so children never share models
+    '''
+    global _pool
+    with _pool_lock:
+        _pool = None
+
+def _segment_dict(segment):
+    # whisper.cpp timestamps are in centiseconds
+    return {'text': segment.text, 'start': segment.t0 / 100, 'end': segment.t1 / 100}
+
+def transcribe_segments(audio, language=None, on_segment=None, should_abort=None):
+    '''
+    Transcribe a media file path (or a 16 kHz mono float32 buffer) with a pooled model.
+    Returns a list of {'text', 'start', 'end'} segments, timestamps in seconds.
+    on_segment, if given, is called with every segment as soon as Whisper produces it,
+    and should_abort is polled by Whisper to stop decoding early.
+    '''
+    callback = (lambda segment: on_segment(_segment_dict(segment))) if on_segment else None
+    with get_model_pool().checkout() as model, get_governor().allocate('whisper', WHISPER_THREADS) as n_threads, stage('transcribe'):
+        # pooled models keep decode params between calls, so always reset the language ('' = auto-detect)
+        segments = model.transcribe(audio, language=language or '', n_threads=n_threads,
+                                    new_segment_callback=callback, abort_callback=should_abort)
+    return [_segment_dict(segment) for segment in segments]
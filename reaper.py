@@ -0,0 +1,156 @@
+from threading import Thread, Event, Lock
+import fcntl
+import logging
+import os
+import time
+import storage
+
+REAPER_INTERVAL_SECONDS = int(os.environ.get('REAPER_INTERVAL_SECONDS', 60))
+OUTPUT_BUDGET_BYTES = int(os.environ.get('OUTPUT_BUDGET_BYTES', 10 * 1024 ** 3))
+UPLOAD_TTL_SECONDS = int(os.environ.get('UPLOAD_TTL_SECONDS', 3600))
+# files younger than this may still be written by a running conversion and are never touched
+GRACE_SECONDS = int(os.environ.get('REAPER_GRACE_SECONDS', 600))
+UPLOAD_FOLDER = 'uploads'
+LOCK_FILENAME = '.reaper.lock'
+
+logger = logging.getLogger(__name__)
+
+_reaper = None
+_reaper_lock = Lock()
+
+def _remove(filepath):
+    try:
+        size = os.path.getsize(filepath)
+        os.remove(filepath)
+        return size
+    except FileNotFoundError:
+        return 0
+
+def _list_outputs():
+    '''
+    List (mtime, size, output_id, path) for every file in the sharded outputs folder.
+    Outputs handed out by result cache hits are hard links to one file, each link counts for its share of the size.
+    '''
+    outputs = []
+    for shard in os.scandir(storage.OUTPUT_FOLDER):
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            if entry.is_file():
+                stat = entry.stat()
+                outputs.append((stat.st_mtime, stat.st_size // stat.st_nlink, entry.name, entry.path))
+    return outputs
+
+def sweep(registry=None, budget_bytes=OUTPUT_BUDGET_BYTES, now=None):
+    '''
+    Run one reaper pass:
+        - delete outputs whose registry entry expired
+        - delete uploads left behind for longer than UPLOAD_TTL_SECONDS, unless an unfinished job still needs them,
+          and forget chunked uploads as old
+        - forget transcripts unused for TRANSCRIPT_TTL_SECONDS
+        - evict outputs, oldest unreferenced ones first, until the outputs folder fits the byte budget
+    Returns the numbers of this pass, cumulative numbers are kept as registry counters.
+    '''
+    registry = registry or storage.get_file_registry()
+    now = time.time() if now is None else now
+    expired_files = 0
+    evicted_files = 0
+    evicted_bytes = 0
+
+    while True:
+        expired = registry.expire(now)
+        for output_id in expired:
+            if _remove(storage.output_path(output_id)):
+                expired_files += 1
+        if not expired:
+            break
+
+    job_inputs = registry.pending_job_inputs() # queued jobs may wait longer than the TTL for a worker
+    for entry in os.scandir(UPLOAD_FOLDER) if os.path.isdir(UPLOAD_FOLDER) else []:
+        if entry.is_file() and entry.stat().st_mtime < now - UPLOAD_TTL_SECONDS and os.path.abspath(entry.path) not in job_inputs:
+            _remove(entry.path)
+    registry.prune_uploads(now - UPLOAD_TTL_SECONDS)
+    registry.prune_transcripts(now - storage.TRANSCRIPT_TTL_SECONDS)
+
+    outputs = _list_outputs()
+    usage_bytes = sum(size for _, size, _, _ in outputs)
+    if usage_bytes > budget_bytes:
+        registered = registry.output_ids()
+        # unreferenced (not in the registry) before referenced, then oldest first
+        candidates = sorted(
+            (output for output in outputs if output[0] < now - GRACE_SECONDS),
+            key=lambda output: (output[2] in registered, output[0]),
+        )
+        for _, size, output_id, path in candidates:
+            if usage_bytes <= budget_bytes:
+                break
+            if _remove(path):
+                registry.remove(output_id)
+                usage_bytes -= size
+                evicted_files += 1
+                evicted_bytes += size
+
+    registry.bump_counter('reaper_sweeps')
+    registry.bump_counter('reaper_expired_files', expired_files)
+    registry.bump_counter('reaper_evicted_files', evicted_files)
+    registry.bump_counter('reaper_evicted_bytes', evicted_bytes)
+    registry.set_counter('output_usage_bytes', usage_bytes)
+    registry.set_counter('output_files', len(outputs) - evicted_files) # expired files were gone before the listing
+    registry.set_counter('reaper_last_sweep', now)
+    return {
+        'expired_files': expired_files,
+        'evicted_files': evicted_files,
+        'evicted_bytes': evicted_bytes,
+        'usage_bytes': usage_bytes,
+    }
+
+def get_metrics():
+    '''
+    Get output storage usage and cumulative reaper counters, shared by every worker
+    '''
+    counters = storage.get_file_registry().get_counters()
+    metrics = {'budget_bytes': OUTPUT_BUDGET_BYTES}
+    for name in ['output_usage_bytes', 'output_files', 'reaper_sweeps', 'reaper_expired_files',
+                 'reaper_evicted_files', 'reaper_evicted_bytes', 'reaper_last_sweep']:
+        metrics[name] = counters.get(name, 0)
+    return metrics
+
+class OutputReaper(Thread):
+    '''
+    Background thread running a sweep every REAPER_INTERVAL_SECONDS.
+    Every worker runs one, but a file lock makes sure only one of them sweeps at a time.
+    '''
+    def __init__(self, interval=REAPER_INTERVAL_SECONDS):
+        super().__init__(name='output-reaper', daemon=True)
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        os.makedirs(storage.OUTPUT_FOLDER, exist_ok=True)
+        lock_path = os.path.join(storage.OUTPUT_FOLDER, LOCK_FILENAME)
+        while not self.stopped.wait(self.interval):
+            with open(lock_path, 'w') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue # another worker is sweeping
+                try:
+                    sweep()
+                except Exception:
+                    logger.exception("Output reaper failed")
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stop(self):
+        self.stopped.set()
+
+def start_reaper():
+    '''
+    Start the reaper thread of the current process if it is not running yet
+    '''
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None or not _reaper.is_alive():
+            _reaper = OutputReaper()
+            _reaper.start()
+    return _reaper
@@ -0,0 +1,132 @@
+from contextlib import contextmanager
+from threading import BoundedSemaphore
+import os
+import subprocess
+import storage
+from instrumentation import get_metrics, stage
+
+CPU_CORES = os.cpu_count() or 1
+# threads handed out across all processes may exceed the core count by this factor
+CPU_OVERCOMMIT = float(os.environ.get('CPU_OVERCOMMIT', 1.0))
+# every job gets at least this many threads, even when the budget is used up
+CPU_MIN_THREADS = int(os.environ.get('CPU_MIN_THREADS', 1))
+FFMPEG_THREADS = int(os.environ.get('FFMPEG_THREADS', 4))
+WHISPER_THREADS = int(os.environ.get('WHISPER_THREADS', min(12, CPU_CORES)))
+# ffmpeg runs taking longer than this are killed (0 disables the limit)
+FFMPEG_TIMEOUT_SECONDS = float(os.environ.get('FFMPEG_TIMEOUT_SECONDS', 600))
+# ffmpeg children one process runs at once; requests beyond that wait up to FFMPEG_QUEUE_SECONDS for a slot
+FFMPEG_MAX_CHILDREN = int(os.environ.get('FFMPEG_MAX_CHILDREN', 16))
+FFMPEG_QUEUE_SECONDS = float(os.environ.get('FFMPEG_QUEUE_SECONDS', 30))
+
+class ResourceGovernor:
+    '''
+    Hands out thread counts (ffmpeg -threads, Whisper n_threads) from one machine wide budget.
+    Allocations live in the shared registry, so every gunicorn worker and job process sees
+    what the others are running.
+    '''
+    def __init__(self, cores=CPU_CORES, overcommit=CPU_OVERCOMMIT, min_threads=CPU_MIN_THREADS):
+        self.cores = cores
+        self.overcommit = overcommit
+        self.min_threads = min_threads
+        self.budget = max(1, int(cores * overcommit))
+
+    def acquire(self, kind, requested):
+        '''
+        Allocate threads for a job, returns (allocation_id, threads); pair with release()
+        '''
+        return storage.get_file_registry().allocate_threads(kind, requested, self.budget, self.min_threads)
+
+    def release(self, allocation_id):
+        storage.get_file_registry().release_threads(allocation_id)
+
+    @contextmanager
+    def allocate(self, kind, requested):
+        '''
+        Allocate threads for the duration of the with block, yields the granted thread count
+        '''
+        allocation_id, threads = self.acquire(kind, requested)
+        try:
+            yield threads
+        finally:
+            self.release(allocation_id)
+
+    def stats(self):
+        allocations = storage.get_file_registry().thread_allocations()
+        by_kind = {}
+        for allocation in allocations:
+            by_kind[allocation['kind']] = by_kind.get(allocation['kind'], 0) + allocation['threads']
+        return {
+            'cores': self.cores,
+            'overcommit': self.overcommit,
+            'budget': self.budget,
+            'in_use': sum(by_kind.values()),
+            'in_use_by_kind': by_kind,
+            'allocations': allocations,
+        }
+
+_governor = None
+
+def get_governor():
+    '''
+    Get the resource governor of the current process
+    '''
+    global _governor
+    if _governor is None:
+        _governor = ResourceGovernor()
+    return _governor
+
+_children = BoundedSemaphore(FFMPEG_MAX_CHILDREN)
+
+def acquire_child():
+    '''
+    Take one of the FFMPEG_MAX_CHILDREN child slots of the process; pair with release_child().
+    Raises TimeoutError if none frees up within FFMPEG_QUEUE_SECONDS.
+    '''
+    if not _children.acquire(timeout=FFMPEG_QUEUE_SECONDS):
+        get_metrics().inc('failures_total', kind='ffmpeg_busy')
+        raise TimeoutError('Too many conversions running, please try again later')
+
+def release_child():
+    _children.release()
+
+@contextmanager
+def child_slot():
+    acquire_child()
+    try:
+        yield
+    finally:
+        release_child()
+
+def with_threads(command, threads):
+    '''
+    Copy of an ffmpeg command with the value of its -threads option replaced
+    '''
+    command = list(command)
+    if "-threads" in command:
+        command[command.index("-threads") + 1] = str(threads)
+    return command
+
+def requested_threads(command):
+    if "-threads" in command:
+        return int(command[command.index("-threads") + 1])
+    return FFMPEG_THREADS
+
+def run_ffmpeg(command, **kwargs):
+    '''
+    subprocess.run an ffmpeg command in one of the process' child slots, with its thread count granted
+    by the governor. Waiting threads hold no CPU, so a threaded worker oversees many ffmpeg runs at once.
+    The run is killed after FFMPEG_TIMEOUT_SECONDS, raising subprocess.TimeoutExpired.
+    '''
+    kwargs.setdefault('timeout', FFMPEG_TIMEOUT_SECONDS or None)
+    try:
+        with child_slot(), get_governor().allocate('ffmpeg', requested_threads(command)) as threads, stage('ffmpeg'):
+            result = subprocess.run(with_threads(command, threads), **kwargs)
+    except subprocess.CalledProcessError:
+        get_metrics().inc('failures_total', kind='ffmpeg')
+        raise
+    except subprocess.TimeoutExpired:
+        get_metrics().inc('failures_total', kind='ffmpeg_timeout')
+        raise
+    if result.returncode != 0:
+        get_metrics().inc('failures_total', kind='ffmpeg')
+    return result
@@ -0,0 +1,81 @@
+from threading import Lock
+import hashlib
+import json
+import os
+import storage
+from instrumentation import get_metrics, METRIC_PREFIX
+
+RESULT_CACHE_BYTES = int(os.environ.get('RESULT_CACHE_BYTES', 1024 ** 3))
+
+_cache = None
+_cache_lock = Lock()
+
+def make_cache_key(kind, content_digest, params):
+    '''
+    Build the cache key of a conversion from the input content hash and its normalized parameters
+    '''
+    normalized = json.dumps(params, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(f"{kind}:{content_digest}:{normalized}".encode('utf-8')).hexdigest()
+
+class ResultCache:
+    '''
+    Content addressed cache of conversion outputs, bounded by the total size of the cached files.
+    The index lives in the shared registry, so every worker process shares one budget and one hit rate.
+    Least recently used entries are dropped from the index once the budget is exceeded. Their files were
+    handed out to clients, so they stay until their registry entry expires and the reaper deletes them.
+    '''
+    def __init__(self, max_bytes=RESULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+
+    def get(self, key):
+        '''
+        Return a new output id for the output cached under key, a hard link to it that the caller registers
+        under its own download name, or None on a miss
+        '''
+        registry = storage.get_file_registry()
+        linked_filename = None
+        cached_filename = registry.get_cached_output(key)
+        if cached_filename:
+            try:
+                linked_filename = storage.link_output(cached_filename)
+            except FileNotFoundError:
+                # the output was removed behind our back, forget it
+                registry.remove_cached_output(key)
+        get_metrics().inc('result_cache_total', result='hit' if linked_filename else 'miss')
+        return linked_filename
+
+    def put(self, key, output_filename):
+        if self.max_bytes <= 0: # caching disabled
+            return
+        registry = storage.get_file_registry()
+        size = os.path.getsize(storage.output_path(output_filename))
+        evicted = registry.put_cached_output(key, output_filename, size, self.max_bytes)
+        if evicted:
+            registry.bump_counter('result_cache_evictions', len(evicted))
+
+    def stats(self):
+        '''
+        Cache usage of every worker, hits and misses as of the last metrics flush
+        '''
+        registry = storage.get_file_registry()
+        entries, used_bytes = registry.result_cache_usage()
+        counters = registry.get_counters()
+        return {
+            'entries': entries,
+            'bytes': used_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': counters.get(f'{METRIC_PREFIX}result_cache_total{{result="hit"}}', 0),
+            'misses': counters.get(f'{METRIC_PREFIX}result_cache_total{{result="miss"}}', 0),
+            'evictions': counters.get('result_cache_evictions', 0),
+        }
+
+def get_result_cache():
+    '''
+    Get the conversion result cache of the current process, creating it on first use
+    '''
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResultCache()
+    return _cache
@@ -1,21 +1,47 @@
-from flask import Flask, Blueprint, request, jsonify, send_file
+from flask import Flask, Blueprint, Response, request, jsonify, send_file, stream_with_context
+from werkzeug.exceptions import ClientDisconnected
 from werkzeug.utils import secure_filename
+import json
+import logging
 import os
 import uuid
 import subprocess
+import threading
 import storage
+from instrumentation import get_metrics
+from resources import FFMPEG_THREADS, FFMPEG_TIMEOUT_SECONDS, run_ffmpeg, get_governor, with_threads, requested_threads, acquire_child, release_child
+from batch import collect_batch_inputs, stream_batch_zip
+from job_queue import submit_job, run_command, remove_partial_output
+from result_cache import get_result_cache, make_cache_key
+from media_probe import probe_media, can_stream_copy
+from chunked_upload import read_request_upload
 
 audio_routes = Blueprint("audio_routes", __name__)
+logger = logging.getLogger(__name__)
 
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'outputs'
-FFMPEG_WORKERS = 4
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-file_mapping = storage.get_file_mapping()
+file_registry = storage.get_file_registry()
 valid_extensions = ['mp3', 'wav', 'flac', 'aac', 'ogg', 'm4a', 'wma', 'webm', 'opus', 'aiff']
 
+# output formats whose container can be written to a pipe, mapped to (ffmpeg muxer, mime type)
+STREAM_FORMATS = {
+    'mp3': ('mp3', 'audio/mpeg'),
+    'ogg': ('ogg', 'audio/ogg'),
+    'opus': ('opus', 'audio/ogg'),
+    'flac': ('flac', 'audio/flac'),
+    'wav': ('wav', 'audio/wav'),
+    'aac': ('adts', 'audio/aac'),
+}
+STREAM_CHUNK_SIZE = 64 * 1024
+# how long a finished stream waits for its feeder threads, which may be blocked on a stalled client
+STREAM_JOIN_SECONDS = 5
+# renditions one /convert_renditions request may ask for
+AUDIO_MAX_RENDITIONS = int(os.environ.get('AUDIO_MAX_RENDITIONS', 8))
+
 def allowed_file(filename, allowed_extensions):
     '''
     Check if the file extension is allowed
@@ -30,6 +56,98 @@ def generate_unique_filename(filename):
     unique_filename = f"{uuid.uuid4().hex}.{extension}"  # generate unique file name with original extension
     return unique_filename
 
+def parse_audio_params(form):
+    '''
+    Read and normalize the optional audio modification parameters of a request form.
+    Raises ValueError with a user facing message if any of them is invalid.
+    '''
+    params = {}
+    for name in ['codec', 'bitrate', 'sample_rate', 'channels', 'volume']:
+        value = (form.get(name) or '').strip().lower()
+        params[name] = value or None
+
+    if params['volume']:
+        try:
+            params['volume'] = str(float(params['volume'])) # check if the volume is a valid number
+        except ValueError:
+            raise ValueError('Invalid volume value. Please provide a numeric value.')
+
+    return params
+
+def build_audio_command(input_filepath, output_filepath, params):
+    '''
+    Build the ffmpeg command converting an audio file with the given parameters
+    '''
+    command = ["ffmpeg", "-i", input_filepath, "-threads", str(FFMPEG_THREADS)]
+    command.extend(audio_output_options(params))
+
+    # add output file path
+    command.append(output_filepath)
+    return command
+
+def audio_output_options(params):
+    '''
+    ffmpeg output options applying the audio parameters of one output
+    '''
+    command = []
+    # Add codec, bitrate, samplerate, channels, volume if specified
+    if params['codec']:
+        command.extend(["-c:a", params['codec']])
+
+    if params['bitrate']:
+        command.extend(["-b:a", params['bitrate']])
+
+    if params['sample_rate']:
+        command.extend(["-ar", params['sample_rate']])
+
+    if params['channels']:
+        command.extend(["-ac", params['channels']])
+
+    if params['volume']:
+        command.extend(["-filter:a", f"volume={params['volume']}"])
+    return command
+
+def build_renditions_command(input_filepath, outputs):
+    '''
+    Build one ffmpeg command writing several outputs, [(output_filepath, params, stream_copy)], from a single
+    decode of the input: every output maps the first audio stream and gets its own encoder options
+    '''
+    command = ["ffmpeg", "-i", input_filepath, "-threads", str(FFMPEG_THREADS)]
+    for output_filepath, params, stream_copy in outputs:
+        command.extend(["-map", "0:a:0"])
+        command.extend(["-c:a", "copy"] if stream_copy else audio_output_options(params))
+        command.append(output_filepath)
+    return command
+
+def parse_renditions(value):
+    '''
+    Parse the JSON list of rendition specs of a request, [{output_format, codec, bitrate, ...}],
+    into [(output_format, params)]. Raises ValueError with a user facing message if any of them is invalid.
+    '''
+    try:
+        specs = json.loads(value or '')
+    except ValueError:
+        raise ValueError('Invalid renditions, expected a JSON list like [{"output_format": "mp3", "bitrate": "128k"}]')
+    if not isinstance(specs, list) or not specs or not all(isinstance(spec, dict) for spec in specs):
+        raise ValueError('Invalid renditions, expected a JSON list like [{"output_format": "mp3", "bitrate": "128k"}]')
+    if len(specs) > AUDIO_MAX_RENDITIONS:
+        raise ValueError(f'Too many renditions, the limit is {AUDIO_MAX_RENDITIONS}')
+
+    renditions = []
+    for spec in specs:
+        output_format = str(spec.get('output_format') or '').lower()
+        if output_format not in valid_extensions:
+            raise ValueError(f'Unsupported output file format: {output_format or "missing"}')
+        params = parse_audio_params({name: str(value) for name, value in spec.items() if value is not None})
+        renditions.append((output_format, params))
+    return renditions
+
+def build_remux_command(input_filepath, output_filepath):
+    '''
+    Build the ffmpeg command copying the audio stream of a file into another container, without transcoding
+    '''
+    return ["ffmpeg", "-i", input_filepath, "-threads", "1", "-vn", "-map", "0:a:0", "-c:a", "copy", output_filepath]
+
 # Audio conversion endpoint
 @audio_routes.route('/convert_audio', methods=['POST'])
 def convert_audio():
@@ -43,6 +161,7 @@ def convert_audio():
     - Response Params: 
         - Files:
             - file: audio file to convert
+            - or upload_id (form field): a completed chunked upload, see /uploads
         - Required:
             - output_format: audio format to convert to
         - Optional:
@@ -51,33 +170,18 @@ def convert_audio():
             - sample_rate: audio sample rate to use
             - channels: audio channels to use, either 1 or 2
             - volume: audio volume to use
+            - async: "1" to queue the conversion as a job and return its job id right away
     
     @returns:
         - JSON response with message and output file name if successful
         - JSON response with error message if unsuccessful
     '''
-    print("Audio Converting...")
-    print(request)
-
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file part in the request'}), 400
-
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'error': 'No file selected for upload'}), 400
-
-    filename = secure_filename(file.filename)
-    unique_filename = generate_unique_filename(filename)
-    filepath = os.path.join(UPLOAD_FOLDER, unique_filename)
-    file.save(filepath)
+    filename, filepath, content_digest, error_response = read_request_upload()
+    if error_response:
+        return error_response
 
     # get output format from the form and check if it is valid
     output_format = request.form.get('output_format')
-    codec = request.form.get('codec')
-    bitrate = request.form.get('bitrate')
-    sample_rate = request.form.get('sample_rate')
-    channels = request.form.get('channels')
-    volume = request.form.get('volume')
 
     if not output_format or '.' in output_format:
         os.remove(filepath)
@@ -86,53 +190,365 @@ def convert_audio():
         os.remove(filepath)
         return jsonify({'error': 'Unsupported output file format'}), 400
     
-    input_extension = filename.rsplit('.', 1)[1].lower()
+    input_extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
     if input_extension not in valid_extensions:
         os.remove(filepath)
         return jsonify({'error': 'Unsupported input file format'}), 400
 
-    # generate output file path, and store the mapping between original and converted file names
-    output_filename = f"{uuid.uuid4().hex}.{output_format}"
-    output_filepath = os.path.join(OUTPUT_FOLDER, output_filename)
-    print("output will be saved to ", output_filepath)
-    file_mapping[output_filename] = filename.split('.')[0] + '.' + output_format
-    
-    command = ["ffmpeg", "-i", filepath, "-threads", str(FFMPEG_WORKERS)]
+    try:
+        params = parse_audio_params(request.form)
+    except ValueError as e:
+        os.remove(filepath)
+        return jsonify({'error': str(e)}), 400
 
-    # Add codec, bitrate, samplerate, channels, volume if specified
-    if codec:
-        command.extend(["-c:a", codec])
+    download_name = filename.rsplit('.', 1)[0] + '.' + output_format
 
-    if bitrate:
-        command.extend(["-b:a", bitrate])
+    # same content converted with the same parameters before: hand out a link to the existing output
+    result_cache = get_result_cache()
+    cache_key = make_cache_key('audio', content_digest, dict(params, output_format=output_format))
+    cached_filename = result_cache.get(cache_key)
+    if cached_filename:
+        os.remove(filepath)
+        cached_filepath = storage.output_path(cached_filename)
+        file_registry.register(cached_filename, download_name, size=os.path.getsize(cached_filepath))
+        return jsonify({
+            'message': f'File converted to {output_format} successfully',
+            'output_file': cached_filename,
+            'cached': True
+        })
 
-    if sample_rate:
-        command.extend(["-ar", sample_rate])
+    # preflight: reject files ffmpeg cannot read before any encode work, and only remux when the
+    # requested output has the input's codec, sample rate and channels
+    try:
+        stream_copy = can_stream_copy(probe_media(filepath), output_format, params)
+    except ValueError as e:
+        os.remove(filepath)
+        return jsonify({'error': str(e)}), 400
+    except TimeoutError as e:
+        os.remove(filepath)
+        return jsonify({'error': str(e)}), 503
 
-    if channels:
-        command.extend(["-ac", channels])
+    # generate output file path, the output is registered under its original name once converted
+    output_filename = f"{uuid.uuid4().hex}.{output_format}"
+    output_filepath = storage.output_path(output_filename, create=True)
     
-    if volume:
-        try:
-            float(volume) # check if the volume is a valid number
-            command.extend(["-filter:a", f"volume={volume}"])
-        except ValueError:
-            os.remove(filepath)
-            return jsonify({'error': 'Invalid volume value. Please provide a numeric value.'}), 400
+    if stream_copy:
+        command = build_remux_command(filepath, output_filepath)
+    else:
+        command = build_audio_command(filepath, output_filepath, params)
+    logger.debug("Converting %s: %s", filename, command)
 
+    if request.form.get('async', '').lower() in ['1', 'true']:
+        def on_success(_):
+            file_registry.register(output_filename, download_name, size=os.path.getsize(output_filepath))
+            result_cache.put(cache_key, output_filename)
+            return {'output_file': output_filename}
 
-    # add output file path
-    command.append(output_filepath)
-    print(command)
+        job_id = submit_job('short', run_command, command, filepath, [output_filepath], on_success=on_success, inputs=[filepath])
+        return jsonify({'job_id': job_id, 'status_url': f'/jobs/{job_id}'}), 202
 
     # run ffmpeg convert the file
     try:
-        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        run_ffmpeg(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        os.remove(filepath)
+        file_registry.register(output_filename, download_name, size=os.path.getsize(output_filepath))
+        result_cache.put(cache_key, output_filename)
         return jsonify({
             'message': f'File converted to {output_format} successfully',
             'output_file': output_filename
         })
     except subprocess.CalledProcessError as e:
         os.remove(filepath)
+        remove_partial_output(output_filepath)
+        return jsonify({'error': f'FFmpeg failed: {e.stderr.decode()}'}), 500
+    except subprocess.TimeoutExpired:
+        os.remove(filepath)
+        remove_partial_output(output_filepath)
+        return jsonify({'error': f'FFmpeg timed out after {FFMPEG_TIMEOUT_SECONDS:g} seconds'}), 504
+    except TimeoutError as e:
+        os.remove(filepath)
+        return jsonify({'error': str(e)}), 503
+
+# Multi-output audio conversion endpoint
+@audio_routes.route('/convert_renditions', methods=['POST'])
+def convert_renditions():
+    '''
+    @description:
+        Convert one audio file into several renditions (e.g. mp3 128k, mp3 320k and opus) with a single upload
+        and a single ffmpeg run: the input is decoded once and encoded once per rendition.
+        Renditions already in the result cache are reused, and only the others are encoded.
+
+    @params:
+    - Response Params:
+        - Files:
+            - file: audio file to convert
+            - or upload_id (form field): a completed chunked upload, see /uploads
+        - Required:
+            - renditions: JSON list of output specs, each with output_format and optionally
+              codec, bitrate, sample_rate, channels and volume (same as /convert_audio)
+        - Optional:
+            - async: "1" to queue the conversion as a job and return its job id right away
+
+    @returns:
+        - JSON response with one {output_format, output_file} per rendition, in the order they were asked for
+        - JSON response with error message if unsuccessful
+    '''
+    filename, filepath, content_digest, error_response = read_request_upload()
+    if error_response:
+        return error_response
+
+    input_extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    if input_extension not in valid_extensions:
+        os.remove(filepath)
+        return jsonify({'error': 'Unsupported input file format'}), 400
+
+    try:
+        renditions = parse_renditions(request.form.get('renditions'))
+        info = probe_media(filepath)
+        stream_copies = [can_stream_copy(info, output_format, params) for output_format, params in renditions]
+    except ValueError as e:
+        os.remove(filepath)
+        return jsonify({'error': str(e)}), 400
+    except TimeoutError as e:
+        os.remove(filepath)
+        return jsonify({'error': str(e)}), 503
+
+    base_name = filename.rsplit('.', 1)[0]
+    formats = [output_format for output_format, _ in renditions]
+    result_cache = get_result_cache()
+    results = []
+    outputs = [] # renditions to encode: (output_filepath, params, stream_copy)
+    pending = [] # and how to register them: (output_filename, download_name, cache_key)
+    for (output_format, params), stream_copy in zip(renditions, stream_copies):
+        label = '-'.join(value for value in params.values() if value) if formats.count(output_format) > 1 else ''
+        download_name = f"{base_name}{'-' + label if label else ''}.{output_format}"
+        cache_key = make_cache_key('audio', content_digest, dict(params, output_format=output_format))
+        output_filename = result_cache.get(cache_key)
+        if output_filename:
+            file_registry.register(output_filename, download_name, size=os.path.getsize(storage.output_path(output_filename)))
+            results.append({'output_format': output_format, 'output_file': output_filename, 'cached': True})
+            continue
+        output_filename = f"{uuid.uuid4().hex}.{output_format}"
+        outputs.append((storage.output_path(output_filename, create=True), params, stream_copy))
+        pending.append((output_filename, download_name, cache_key))
+        results.append({'output_format': output_format, 'output_file': output_filename})
+
+    def register_outputs(_=None):
+        for output_filename, download_name, cache_key in pending:
+            file_registry.register(output_filename, download_name, size=os.path.getsize(storage.output_path(output_filename)))
+            result_cache.put(cache_key, output_filename)
+        return {'renditions': results}
+
+    if not outputs:
+        os.remove(filepath)
+        return jsonify(dict(register_outputs(), message='Renditions converted successfully'))
+
+    command = build_renditions_command(filepath, outputs)
+    output_filepaths = [output[0] for output in outputs]
+    logger.debug("Converting %s into %d rendition(s): %s", filename, len(outputs), command)
+
+    if request.form.get('async', '').lower() in ['1', 'true']:
+        job_id = submit_job('short', run_command, command, filepath, output_filepaths, on_success=register_outputs, inputs=[filepath])
+        return jsonify({'job_id': job_id, 'status_url': f'/jobs/{job_id}'}), 202
+
+    try:
+        run_ffmpeg(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        remove_partial_output(*output_filepaths)
         return jsonify({'error': f'FFmpeg failed: {e.stderr.decode()}'}), 500
-   
\ No newline at end of file
+    except subprocess.TimeoutExpired:
+        remove_partial_output(*output_filepaths)
+        return jsonify({'error': f'FFmpeg timed out after {FFMPEG_TIMEOUT_SECONDS:g} seconds'}), 504
+    except TimeoutError as e:
+        return jsonify({'error': str(e)}), 503
+    finally:
+        os.remove(filepath)
+    return jsonify(dict(register_outputs(), message='Renditions converted successfully'))
+
+def pipe_to_stdin(source, process):
+    '''
+    Feed an input stream into the stdin of a running process, chunk by chunk
+    '''
+    try:
+        while True:
+            chunk = source.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            process.stdin.write(chunk)
+    except (BrokenPipeError, ValueError):
+        pass # ffmpeg exited early, its exit code tells why
+    except ClientDisconnected:
+        pass # the upload was cut short, ffmpeg sees the end of its input
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+# Streaming audio conversion endpoint
+@audio_routes.route('/stream_audio', methods=['POST'])
+def stream_audio():
+    '''
+    @description:
+        Convert an audio stream without touching the disk: the upload is piped into ffmpeg's stdin
+        and the encoded output is streamed back to the client while ffmpeg produces it.
+        Only formats that can be muxed into a pipe are supported: mp3, ogg, opus, flac, wav and aac (adts).
+
+    @params:
+    - Response Params:
+        - Body: either a multipart form with a "file" part and the parameters below,
+          or the raw audio bytes with the parameters in the query string (no spooling to disk at all)
+        - Required:
+            - output_format: audio format to convert to
+        - Optional:
+            - codec, bitrate, sample_rate, channels, volume: same as /convert_audio
+            - filename: original file name used for the download name (raw body only)
+
+    @returns:
+        - Streamed converted audio as an attachment if successful
+        - JSON response with error message if unsuccessful
+    '''
+    if request.mimetype == 'multipart/form-data':
+        form = request.form
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file part in the request'}), 400
+        file = request.files['file']
+        source = file.stream
+        filename = secure_filename(file.filename) or 'audio'
+    else:
+        form = request.args
+        source = request.stream
+        filename = secure_filename(request.args.get('filename', '')) or 'audio'
+
+    output_format = (form.get('output_format') or '').lower()
+    if output_format not in STREAM_FORMATS:
+        return jsonify({'error': 'Unsupported streaming output format. Please use one of: ' + ', '.join(STREAM_FORMATS)}), 400
+
+    try:
+        params = parse_audio_params(form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    muxer, mime_type = STREAM_FORMATS[output_format]
+    command = build_audio_command("pipe:0", "pipe:1", params)
+    command[-1:-1] = ["-f", muxer]
+
+    try:
+        acquire_child()
+    except TimeoutError as e:
+        return jsonify({'error': str(e)}), 503
+    governor = get_governor()
+    allocation_id = None
+    process = None
+    stderr_chunks = []
+    threads = []
+    timed_out = threading.Event()
+    release_lock = threading.Lock()
+    released = False
+
+    def release():
+        # give back the threads and the child slot once, from the watchdog or from cleanup
+        nonlocal released
+        with release_lock:
+            if released:
+                return
+            released = True
+        if allocation_id is not None:
+            governor.release(allocation_id)
+        release_child()
+
+    def expire():
+        # like run_ffmpeg, kill ffmpeg after FFMPEG_TIMEOUT_SECONDS, also when a stalled client keeps the response open
+        timed_out.set()
+        get_metrics().inc('failures_total', kind='ffmpeg_timeout')
+        process.kill()
+        release()
+
+    watchdog = threading.Timer(FFMPEG_TIMEOUT_SECONDS, expire) if FFMPEG_TIMEOUT_SECONDS else None
+
+    def cleanup():
+        # runs once: on an error below, or when the server closes the streamed response
+        if watchdog:
+            watchdog.cancel()
+        if process is not None:
+            if process.poll() is None:
+                process.kill() # client went away
+            process.wait()
+            for thread in threads:
+                thread.join(STREAM_JOIN_SECONDS)
+        release()
+
+    try:
+        allocation_id, n_threads = governor.acquire('ffmpeg', requested_threads(command))
+        process = subprocess.Popen(with_threads(command, n_threads), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if watchdog:
+            watchdog.daemon = True
+            watchdog.start()
+        threads.extend([
+            threading.Thread(target=pipe_to_stdin, args=(source, process), daemon=True),
+            threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True),
+        ])
+        for thread in threads:
+            thread.start()
+
+        # wait for the first encoded bytes so a bad input still gets a proper error response
+        first_chunk = process.stdout.read1(STREAM_CHUNK_SIZE)
+    except BaseException:
+        cleanup()
+        raise
+    if not first_chunk:
+        cleanup()
+        if timed_out.is_set():
+            return jsonify({'error': f'FFmpeg timed out after {FFMPEG_TIMEOUT_SECONDS:g} seconds'}), 504
+        return jsonify({'error': f'FFmpeg failed: {b"".join(stderr_chunks).decode(errors="replace")}'}), 500
+
+    def generate():
+        yield first_chunk
+        while True:
+            chunk = process.stdout.read1(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    download_name = filename.rsplit('.', 1)[0] + '.' + output_format
+    response = Response(stream_with_context(generate()), mimetype=mime_type,
+                        headers={'Content-Disposition': f'attachment; filename="{download_name}"'})
+    # a generator's finally does not run if the body is closed before it starts, call_on_close always does
+    response.call_on_close(cleanup)
+    return response
+
+# Batch audio conversion endpoint
+@audio_routes.route('/convert_batch', methods=['POST'])
+def convert_audio_batch():
+    '''
+    @description:
+        Convert many audio files with one set of parameters. The conversions run in parallel
+        in the batch process pool and a zip archive is streamed back as they finish.
+
+    @params:
+    - Response Params:
+        - Files:
+            - files: audio files to convert (repeat the part for every file)
+            - archive: or a single zip archive holding the audio files
+        - Required:
+            - output_format: audio format to convert to
+        - Optional:
+            - codec, bitrate, sample_rate, channels, volume: same as /convert_audio
+
+    @returns:
+        - Streamed zip archive with one converted file (or <name>.error.txt) per input
+        - JSON response with error message if unsuccessful
+    '''
+    output_format = request.form.get('output_format')
+    if not output_format or output_format not in valid_extensions:
+        return jsonify({'error': 'Invalid or missing output format. Please specify a valid format like "mp3", "wav", etc.'}), 400
+
+    try:
+        params = parse_audio_params(request.form)
+        inputs = collect_batch_inputs(valid_extensions)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    build_command = lambda input_filepath, output_filepath: build_audio_command(input_filepath, output_filepath, params)
+    return Response(stream_with_context(stream_batch_zip(inputs, output_format, build_command)), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename="converted_audio.zip"'})
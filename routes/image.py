@@ -1,197 +1,454 @@
-from flask import Flask, Blueprint, request, jsonify, send_file
-from werkzeug.utils import secure_filename
-import os
-import uuid
-import subprocess
-import storage
-
-image_routes = Blueprint("image_routes", __name__)
-
-UPLOAD_FOLDER = 'uploads'
-OUTPUT_FOLDER = 'outputs'
-FFMPEG_WORKERS = 4
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-
-file_mapping = storage.get_file_mapping()
-
-def generate_unique_filename(filename):
-    """
-    Generate a unique filename using uuid to avoid name collisions.
-    """
-    extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
-    unique_filename = f"{uuid.uuid4().hex}.{extension}"
-    return unique_filename
-
-# Updated convert_image endpoint
-@image_routes.route('/convert_image', methods=['POST'])
-def convert_image():
-    '''
-    @description: 
-        Convert an image file to a different format using ffmpeg, 
-        and save the converted file to the outputs folder. 
-        Basic image modification also supported: width, height, quality, rotation, and flip.
-    @params:
-        - Response Params:
-            - Files:
-                - file: image file to convert
-            - Required:
-                - output_format: image format to convert to
-            - Optional:
-                - width: image width to use
-                - height: image height to use
-                - quality: image quality to use (1-31)
-                - rotate: image rotation angle to use (90, 180, 270)
-                - flip: image flip direction to use (v, h, hv, vh)
-                - grayscale: convert image to grayscale (1)
-    @returns:
-        - JSON response with message and output file name if successful
-        - JSON response with error message if unsuccessful
-    '''
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file part in the request'}), 400
-
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'error': 'No file selected for upload'}), 400
-
-    filename = secure_filename(file.filename)
-    unique_filename = generate_unique_filename(filename)
-    filepath = os.path.join(UPLOAD_FOLDER, unique_filename)
-    file.save(filepath)
-
-    width = request.form.get('width')
-    height = request.form.get('height')
-    quality = request.form.get('quality')
-    rotate = request.form.get('rotate')
-    flip = request.form.get('flip')
-    grayscale = request.form.get('grayscale')
-
-    output_format = request.form.get('output_format')
-    
-    if not output_format or '.' in output_format:
-        os.remove(filepath)
-        return jsonify({'error': 'Invalid or missing output format. Please specify a valid format like "jpg", "png", etc.'}), 400
-
-    input_extension = filename.rsplit('.', 1)[1].lower()
-    valid_extensions = ['jpg', 'jpeg', 'png', 'bmp', 'gif', 'tiff', 'webp']
-    if input_extension not in valid_extensions:
-        os.remove(filepath)
-        return jsonify({'error': 'Unsupported input file format'}), 400
-
-    output_filename = generate_unique_filename(f"output.{output_format}")
-    output_filepath = os.path.join(OUTPUT_FOLDER, output_filename)
-
-    command = ["ffmpeg", "-i", filepath, "-threads", str(FFMPEG_WORKERS)]
-
-    # Apply width and height if provided
-    if width and height:
-        try:
-            width = int(width)
-            height = int(height)
-            command.extend(["-vf", f"scale={width}:{height}"])
-        except ValueError:
-            os.remove(filepath)
-            return jsonify({'error': 'Invalid width or height values. They must be integers.'}), 400
-
-    # Apply quality if provided
-    if quality:
-        try:
-            quality = int(quality)
-            if quality < 1 or quality > 31:
-                os.remove(filepath)
-                return jsonify({'error': 'Quality must be between 1 and 31.'}), 400
-            command.extend(["-q:v", str(quality)])
-        except ValueError:
-            os.remove(filepath)
-            return jsonify({'error': 'Invalid quality value. It must be an integer between 1 and 31.'}), 400
-
-    # Apply rotation if provided
-    if rotate:
-        try:
-            rotate_angle = int(rotate)
-            if rotate_angle not in [90, 180, 270]:
-                raise ValueError
-            if rotate_angle == 90:
-                command.extend(["-vf", "transpose=1"])
-            elif rotate_angle == 180:
-                command.extend(["-vf", "transpose=2,transpose=2"])
-            elif rotate_angle == 270:
-                command.extend(["-vf", "transpose=2"])
-        except ValueError:
-            os.remove(filepath)
-            return jsonify({'error': 'Invalid rotation value. Only 90, 180, and 270 degrees are supported.'}), 400
-    
-    # First conversion step: Apply width, height, quality, rotation
-    temp_filename = generate_unique_filename(f"temp_output.{output_format}")
-    temp_filepath = os.path.join(OUTPUT_FOLDER, temp_filename)
-    command.append(temp_filepath)
-
-    # run ffmpeg to convert the file
-    try:
-        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        os.remove(filepath)
-        return jsonify({'error': f'FFmpeg failed during the first conversion: {e.stderr.decode()}'}), 500
-
-    # Apply flip if needed
-    flip_command = ["ffmpeg", "-i", temp_filepath, "-threads", str(FFMPEG_WORKERS)]
-
-    if flip:
-        if flip.lower() == 'h':
-            flip_command.extend(["-vf", "hflip"])
-        elif flip.lower() == 'v':
-            flip_command.extend(["-vf", "vflip"])
-        elif flip.lower() == 'hv' or flip.lower() == 'vh':
-            flip_command.extend(["-vf", "hflip,vflip"])
-        else:
-            os.remove(filepath)
-            os.remove(temp_filepath)
-            return jsonify({'error': 'Invalid flip direction. Please use "horizontal" or "vertical".'}), 400
-
-    temp_filename_2 = generate_unique_filename(f"temp_output_2.{output_format}")
-    temp_filepath_2 = os.path.join(OUTPUT_FOLDER, temp_filename_2)
-    flip_command.append(temp_filepath_2)
-
-    # ffmpeg command to flip the image
-    try:
-        subprocess.run(flip_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        os.remove(filepath)
-        os.remove(temp_filepath)
-        os.remove(temp_filepath_2)
-        return jsonify({'error': f'FFmpeg failed during the flip conversion: {e.stderr.decode()}'}), 500
-
-    # Apply grayscale if specified
-    grayscale_command = ["ffmpeg", "-i", temp_filepath_2, "-threads", str(FFMPEG_WORKERS)]
-
-    if grayscale:
-        if grayscale == "1":
-            grayscale_command.extend(["-vf", "format=gray"])
-        else:
-            os.remove(filepath)
-            os.remove(temp_filepath)
-            os.remove(temp_filepath_2)
-            return jsonify({'error': 'Invalid grayscale value. Please use "1" to convert to grayscale.'}), 400
-
-    # Final output file
-    grayscale_command.append(output_filepath)
-
-    # ffmpeg command to convert the image to grayscale
-    try:
-        subprocess.run(grayscale_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        os.remove(filepath)
-        os.remove(temp_filepath)
-        os.remove(temp_filepath_2)
-        return jsonify({'error': f'FFmpeg failed during the grayscale conversion: {e.stderr.decode()}'}), 500
-
-    # Clean up the temporary files
-    os.remove(filepath)
-    os.remove(temp_filepath)
-    os.remove(temp_filepath_2)
-
-    return jsonify({
-        'message': f'File converted to {output_format} successfully',
-        'output_file': output_filename
-    })
+from flask import Flask, Blueprint, Response, request, jsonify, send_file, stream_with_context
+import json
+import logging
+import os
+import uuid
+import subprocess
+import storage
+from resources import FFMPEG_THREADS, FFMPEG_TIMEOUT_SECONDS, run_ffmpeg
+from batch import collect_batch_inputs, stream_batch_zip
+from job_queue import submit_job, run_command, remove_partial_output
+from result_cache import get_result_cache, make_cache_key
+from image_engine import (choose_engine, convert_in_process, run_in_process, choose_renditions_engine, dct_scale,
+                          convert_renditions_in_process)
+from media_probe import probe_media, video_stream
+from chunked_upload import read_request_upload
+
+image_routes = Blueprint("image_routes", __name__)
+logger = logging.getLogger(__name__)
+
+UPLOAD_FOLDER = 'uploads'
+OUTPUT_FOLDER = 'outputs'
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+
+file_registry = storage.get_file_registry()
+valid_extensions = ['jpg', 'jpeg', 'png', 'bmp', 'gif', 'tiff', 'webp']
+
+ROTATE_FILTERS = {
+    90: ['transpose=1'],
+    180: ['transpose=2', 'transpose=2'],
+    270: ['transpose=2'],
+}
+
+# renditions one /convert_renditions request may ask for
+IMAGE_MAX_RENDITIONS = int(os.environ.get('IMAGE_MAX_RENDITIONS', 12))
+
+FLIP_FILTERS = {
+    'h': ['hflip'],
+    'v': ['vflip'],
+    'hv': ['hflip', 'vflip'],
+    'vh': ['hflip', 'vflip'],
+}
+
+def generate_unique_filename(filename):
+    """
+    Generate a unique filename using uuid to avoid name collisions.
+    """
+    extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    unique_filename = f"{uuid.uuid4().hex}.{extension}"
+    return unique_filename
+
+def parse_image_params(form):
+    '''
+    Validate the optional image modification parameters of a request form.
+    Raises ValueError with a user facing message if any of them is invalid.
+    '''
+    params = {'width': None, 'height': None, 'quality': None, 'rotate': None, 'flip': None, 'grayscale': False}
+
+    width = form.get('width')
+    height = form.get('height')
+    if width and height:
+        try:
+            params['width'] = int(width)
+            params['height'] = int(height)
+        except ValueError:
+            raise ValueError('Invalid width or height values. They must be integers.')
+
+    quality = form.get('quality')
+    if quality:
+        try:
+            params['quality'] = int(quality)
+        except ValueError:
+            raise ValueError('Invalid quality value. It must be an integer between 1 and 31.')
+        if params['quality'] < 1 or params['quality'] > 31:
+            raise ValueError('Quality must be between 1 and 31.')
+
+    rotate = form.get('rotate')
+    if rotate:
+        try:
+            params['rotate'] = int(rotate)
+        except ValueError:
+            params['rotate'] = None
+        if params['rotate'] not in ROTATE_FILTERS:
+            raise ValueError('Invalid rotation value. Only 90, 180, and 270 degrees are supported.')
+
+    flip = form.get('flip')
+    if flip:
+        if flip.lower() not in FLIP_FILTERS:
+            raise ValueError('Invalid flip direction. Please use "h", "v" or "hv".')
+        params['flip'] = flip.lower()
+
+    grayscale = form.get('grayscale')
+    if grayscale:
+        if grayscale != "1":
+            raise ValueError('Invalid grayscale value. Please use "1" to convert to grayscale.')
+        params['grayscale'] = True
+
+    return params
+
+def build_filter_chain(params):
+    '''
+    Compose scale, rotation, flip and grayscale into a single ffmpeg filter chain
+    '''
+    filters = []
+    if params['width'] and params['height']:
+        filters.append(f"scale={params['width']}:{params['height']}")
+    if params['rotate']:
+        filters.extend(ROTATE_FILTERS[params['rotate']])
+    if params['flip']:
+        filters.extend(FLIP_FILTERS[params['flip']])
+    if params['grayscale']:
+        filters.append('format=gray')
+    return ','.join(filters)
+
+def build_image_command(input_filepath, output_filepath, params):
+    '''
+    Build the ffmpeg command converting an image in a single pass
+    '''
+    command = ["ffmpeg", "-i", input_filepath, "-threads", str(FFMPEG_THREADS)]
+
+    filter_chain = build_filter_chain(params)
+    if filter_chain:
+        command.extend(["-vf", filter_chain])
+
+    if params['quality']:
+        command.extend(["-q:v", str(params['quality'])])
+
+    command.append(output_filepath)
+    return command
+
+def parse_renditions(value, source_width, source_height):
+    '''
+    Parse the JSON list of rendition specs of a request, [{output_format, width, height, quality}], into
+    [(output_format, width, height, quality)]. A rendition without height keeps the aspect ratio of the source,
+    and none is larger than the source. Raises ValueError with a user facing message if any of them is invalid.
+    '''
+    try:
+        specs = json.loads(value or '')
+    except ValueError:
+        specs = None
+    if not isinstance(specs, list) or not specs or not all(isinstance(spec, dict) for spec in specs):
+        raise ValueError('Invalid renditions, expected a JSON list like [{"output_format": "webp", "width": 320}]')
+    if len(specs) > IMAGE_MAX_RENDITIONS:
+        raise ValueError(f'Too many renditions, the limit is {IMAGE_MAX_RENDITIONS}')
+
+    renditions = []
+    for spec in specs:
+        output_format = str(spec.get('output_format') or '').lower()
+        if output_format not in valid_extensions:
+            raise ValueError(f'Unsupported output file format: {output_format or "missing"}')
+        try:
+            width = int(spec['width'])
+            height = int(spec['height']) if spec.get('height') else None
+            quality = int(spec['quality']) if spec.get('quality') else None
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Every rendition needs an integer width, and optionally an integer height and quality.')
+        if width < 1 or (height is not None and height < 1):
+            raise ValueError('Rendition width and height must be positive.')
+        if quality is not None and (quality < 1 or quality > 31):
+            raise ValueError('Quality must be between 1 and 31.')
+
+        if height is None:
+            width = min(width, source_width)
+            height = max(1, round(source_height * width / source_width))
+        elif width > source_width or height > source_height:
+            scale = min(source_width / width, source_height / height)
+            width, height = max(1, round(width * scale)), max(1, round(height * scale))
+        renditions.append((output_format, width, height, quality))
+    return renditions
+
+def build_renditions_command(input_filepath, outputs, lowres=0):
+    '''
+    Build one ffmpeg command writing several sizes of an image, [(output_filepath, output_format, width, height, quality)]:
+    the decoded image is split into one scale branch per rendition. lowres decodes JPEG sources at 1/2**lowres of their size.
+    '''
+    command = ["ffmpeg"]
+    if lowres:
+        command.extend(["-lowres", str(lowres)])
+    command.extend(["-i", input_filepath, "-threads", str(FFMPEG_THREADS)])
+
+    branches = ''.join(f'[s{index}]' for index in range(len(outputs)))
+    graph = [f"[0:v]split={len(outputs)}{branches}"]
+    graph.extend(f"[s{index}]scale={width}:{height}[o{index}]" for index, (_, _, width, height, _) in enumerate(outputs))
+    command.extend(["-filter_complex", ';'.join(graph)])
+
+    for index, (output_filepath, _, _, _, quality) in enumerate(outputs):
+        command.extend(["-map", f"[o{index}]"])
+        if quality:
+            command.extend(["-q:v", str(quality)])
+        command.append(output_filepath)
+    return command
+
+# Updated convert_image endpoint
+@image_routes.route('/convert_image', methods=['POST'])
+def convert_image():
+    '''
+    @description: 
+        Convert an image file to a different format, and save the converted file to the outputs folder.
+        Small images are converted in process with Pillow, others with ffmpeg (see choose_engine).
+        Basic image modification also supported: width, height, quality, rotation, flip and grayscale,
+        applied in a single pass.
+    @params:
+        - Response Params:
+            - Files:
+                - file: image file to convert
+                - or upload_id (form field): a completed chunked upload, see /uploads
+            - Required:
+                - output_format: image format to convert to
+            - Optional:
+                - width: image width to use
+                - height: image height to use
+                - quality: image quality to use (1-31)
+                - rotate: image rotation angle to use (90, 180, 270)
+                - flip: image flip direction to use (v, h, hv, vh)
+                - grayscale: convert image to grayscale (1)
+                - async: "1" to queue the conversion as a job and return its job id right away
+    @returns:
+        - JSON response with message and output file name if successful
+        - JSON response with error message if unsuccessful
+    '''
+    filename, filepath, content_digest, error_response = read_request_upload()
+    if error_response:
+        return error_response
+
+    output_format = request.form.get('output_format')
+    
+    if not output_format or '.' in output_format:
+        os.remove(filepath)
+        return jsonify({'error': 'Invalid or missing output format. Please specify a valid format like "jpg", "png", etc.'}), 400
+    elif output_format.lower() not in valid_extensions:
+        os.remove(filepath)
+        return jsonify({'error': 'Unsupported output file format'}), 400
+
+    input_extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    if input_extension not in valid_extensions:
+        os.remove(filepath)
+        return jsonify({'error': 'Unsupported input file format'}), 400
+
+    try:
+        params = parse_image_params(request.form)
+    except ValueError as e:
+        os.remove(filepath)
+        return jsonify({'error': str(e)}), 400
+
+    download_name = filename.rsplit('.', 1)[0] + '.' + output_format
+
+    # same content converted with the same parameters before: hand out a link to the existing output
+    result_cache = get_result_cache()
+    cache_key = make_cache_key('image', content_digest, dict(params, output_format=output_format.lower()))
+    cached_filename = result_cache.get(cache_key)
+    if cached_filename:
+        os.remove(filepath)
+        cached_filepath = storage.output_path(cached_filename)
+        file_registry.register(cached_filename, download_name, size=os.path.getsize(cached_filepath))
+        return jsonify({
+            'message': f'File converted to {output_format} successfully',
+            'output_file': cached_filename,
+            'cached': True
+        })
+
+    output_filename = generate_unique_filename(f"output.{output_format}")
+    output_filepath = storage.output_path(output_filename, create=True)
+
+    # small images are converted in process, anything else in one ffmpeg pass: one decode, one filter chain, one encode
+    engine = choose_engine(filepath, input_extension, output_format)
+    command = build_image_command(filepath, output_filepath, params)
+
+    if request.form.get('async', '').lower() in ['1', 'true']:
+        def on_success(_):
+            file_registry.register(output_filename, download_name, size=os.path.getsize(output_filepath))
+            result_cache.put(cache_key, output_filename)
+            return {'output_file': output_filename}
+
+        if engine == 'pillow':
+            job_id = submit_job('short', run_in_process, convert_in_process, (filepath, output_filepath, output_format, params),
+                                command, filepath, [output_filepath], on_success=on_success, inputs=[filepath])
+        else:
+            job_id = submit_job('short', run_command, command, filepath, [output_filepath], on_success=on_success, inputs=[filepath])
+        return jsonify({'job_id': job_id, 'status_url': f'/jobs/{job_id}'}), 202
+
+    try:
+        if engine == 'pillow':
+            try:
+                convert_in_process(filepath, output_filepath, output_format, params)
+            except Exception as e:
+                logger.warning("In-process image conversion failed, falling back to ffmpeg: %s", e)
+                remove_partial_output(output_filepath) # ffmpeg does not overwrite what Pillow left
+                engine = 'ffmpeg'
+        if engine == 'ffmpeg':
+            run_ffmpeg(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        remove_partial_output(output_filepath)
+        return jsonify({'error': f'FFmpeg failed: {e.stderr.decode()}'}), 500
+    except subprocess.TimeoutExpired:
+        remove_partial_output(output_filepath)
+        return jsonify({'error': f'FFmpeg timed out after {FFMPEG_TIMEOUT_SECONDS:g} seconds'}), 504
+    except TimeoutError as e:
+        return jsonify({'error': str(e)}), 503
+    finally:
+        os.remove(filepath)
+
+    file_registry.register(output_filename, download_name, size=os.path.getsize(output_filepath))
+    result_cache.put(cache_key, output_filename)
+
+    return jsonify({
+        'message': f'File converted to {output_format} successfully',
+        'output_file': output_filename
+    })
+
+# Responsive image renditions endpoint
+@image_routes.route('/convert_renditions', methods=['POST'])
+def convert_image_renditions():
+    '''
+    @description:
+        Make a set of renditions of one image (several widths and formats, for responsive web delivery)
+        from a single decode: in process with Pillow, or in one ffmpeg run splitting the decoded image
+        into one scale branch per rendition. Large JPEG sources are decoded at a reduced scale
+        (DCT scaling) when the largest rendition is small enough.
+    @params:
+        - Response Params:
+            - Files:
+                - file: image file to convert
+                - or upload_id (form field): a completed chunked upload, see /uploads
+            - Required:
+                - renditions: JSON list of {output_format, width, height (optional, keeps the aspect ratio
+                  when missing), quality (optional, 1-31)}
+            - Optional:
+                - async: "1" to queue the conversion as a job and return its job id right away
+    @returns:
+        - JSON manifest with one {output_file, output_format, width, height, size} per rendition, in the order asked for
+        - JSON response with error message if unsuccessful
+    '''
+    filename, filepath, content_digest, error_response = read_request_upload()
+    if error_response:
+        return error_response
+
+    input_extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    if input_extension not in valid_extensions:
+        os.remove(filepath)
+        return jsonify({'error': 'Unsupported input file format'}), 400
+
+    try:
+        source = video_stream(probe_media(filepath))
+        renditions = parse_renditions(request.form.get('renditions'), source['width'], source['height'])
+    except ValueError as e:
+        os.remove(filepath)
+        return jsonify({'error': str(e)}), 400
+    except TimeoutError as e:
+        os.remove(filepath)
+        return jsonify({'error': str(e)}), 503
+
+    base_name = filename.rsplit('.', 1)[0]
+    result_cache = get_result_cache()
+    manifest = []
+    outputs = [] # renditions to write: (output_filepath, output_format, width, height, quality)
+    pending = [] # and how to register them: (manifest entry, download_name, cache_key)
+    for output_format, width, height, quality in renditions:
+        download_name = f"{base_name}-{width}x{height}.{output_format}"
+        params = {'width': width, 'height': height, 'quality': quality, 'rotate': None, 'flip': None, 'grayscale': False}
+        cache_key = make_cache_key('image', content_digest, dict(params, output_format=output_format))
+        entry = {'output_format': output_format, 'width': width, 'height': height}
+        output_filename = result_cache.get(cache_key)
+        if output_filename:
+            size = os.path.getsize(storage.output_path(output_filename))
+            file_registry.register(output_filename, download_name, size=size)
+            manifest.append(dict(entry, output_file=output_filename, size=size, cached=True))
+            continue
+        output_filename = generate_unique_filename(f"output.{output_format}")
+        outputs.append((storage.output_path(output_filename, create=True), output_format, width, height, quality))
+        entry['output_file'] = output_filename
+        pending.append((entry, download_name, cache_key))
+        manifest.append(entry)
+
+    def register_outputs(_=None):
+        for entry, download_name, cache_key in pending:
+            entry['size'] = os.path.getsize(storage.output_path(entry['output_file']))
+            file_registry.register(entry['output_file'], download_name, size=entry['size'])
+            result_cache.put(cache_key, entry['output_file'])
+        return {'renditions': manifest}
+
+    if not outputs:
+        os.remove(filepath)
+        return jsonify(register_outputs())
+
+    largest = (max(output[2] for output in outputs), max(output[3] for output in outputs))
+    engine = choose_renditions_engine(filepath, input_extension, [output[1] for output in outputs], *largest)
+    scale = dct_scale(source['width'], source['height'], *largest) if source['codec'] == 'mjpeg' else 1
+    command = build_renditions_command(filepath, outputs, lowres=scale.bit_length() - 1)
+    output_filepaths = [output[0] for output in outputs]
+
+    if request.form.get('async', '').lower() in ['1', 'true']:
+        if engine == 'pillow':
+            job_id = submit_job('short', run_in_process, convert_renditions_in_process, (filepath, outputs),
+                                command, filepath, output_filepaths, on_success=register_outputs, inputs=[filepath])
+        else:
+            job_id = submit_job('short', run_command, command, filepath, output_filepaths, on_success=register_outputs, inputs=[filepath])
+        return jsonify({'job_id': job_id, 'status_url': f'/jobs/{job_id}'}), 202
+
+    try:
+        if engine == 'pillow':
+            try:
+                convert_renditions_in_process(filepath, outputs)
+            except Exception as e:
+                logger.warning("In-process image renditions failed, falling back to ffmpeg: %s", e)
+                remove_partial_output(*output_filepaths)
+                engine = 'ffmpeg'
+        if engine == 'ffmpeg':
+            run_ffmpeg(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        remove_partial_output(*output_filepaths)
+        return jsonify({'error': f'FFmpeg failed: {e.stderr.decode()}'}), 500
+    except subprocess.TimeoutExpired:
+        remove_partial_output(*output_filepaths)
+        return jsonify({'error': f'FFmpeg timed out after {FFMPEG_TIMEOUT_SECONDS:g} seconds'}), 504
+    except TimeoutError as e:
+        return jsonify({'error': str(e)}), 503
+    finally:
+        os.remove(filepath)
+
+    return jsonify(register_outputs())
+
+# Batch image conversion endpoint
+@image_routes.route('/convert_batch', methods=['POST'])
+def convert_image_batch():
+    '''
+    @description:
+        Convert many images with one set of parameters. The conversions run in parallel
+        in the batch process pool and a zip archive is streamed back as they finish.
+    @params:
+        - Response Params:
+            - Files:
+                - files: image files to convert (repeat the part for every file)
+                - archive: or a single zip archive holding the images
+            - Required:
+                - output_format: image format to convert to
+            - Optional:
+                - width, height, quality, rotate, flip, grayscale: same as /convert_image
+    @returns:
+        - Streamed zip archive with one converted file (or <name>.error.txt) per input
+        - JSON response with error message if unsuccessful
+    '''
+    output_format = request.form.get('output_format')
+    if not output_format or output_format.lower() not in valid_extensions:
+        return jsonify({'error': 'Invalid or missing output format. Please specify a valid format like "jpg", "png", etc.'}), 400
+
+    try:
+        params = parse_image_params(request.form)
+        inputs = collect_batch_inputs(valid_extensions)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    build_command = lambda input_filepath, output_filepath: build_image_command(input_filepath, output_filepath, params)
+    return Response(stream_with_context(stream_batch_zip(inputs, output_format, build_command)), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename="converted_images.zip"'})
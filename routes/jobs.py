@@ -0,0 +1,31 @@
+from flask import Blueprint, jsonify
+from job_queue import get_job
+
+job_routes = Blueprint("job_routes", __name__)
+
+@job_routes.route('/<job_id>', methods=['GET'])
+def job_status(job_id):
+    '''
+    @description:
+        Get the status of a job submitted with async=1.
+        Once done, the result holds the output_file to pass to /download/<unique_filename>,
+        or the transcribed_text for transcriptions that were not saved to a file.
+    @returns:
+        - JSON response with job_id, class, status (queued, running, done, failed), result and error
+        - JSON response with error message if the job is unknown
+    '''
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@job_routes.route('/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] == 'failed':
+        return jsonify({'error': job['error']}), 500
+    if job['status'] != 'done':
+        return jsonify({'status': job['status']}), 202
+    return jsonify(job['result'])
@@ -1,15 +1,19 @@
-from flask import Blueprint, request, jsonify, send_file
-from werkzeug.utils import secure_filename
-from fpdf import FPDF
-from docx import Document
-from io import BytesIO
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 import json
-from reportlab.pdfgen import canvas
-from pywhispercpp.model import Model
 import os
-import subprocess
-import argostranslate.package
-import argostranslate.translate
+import queue
+import threading
+import uuid
+import storage
+from job_queue import submit_job
+from model_pool import transcribe_segments
+from long_media import LONG_MEDIA_SECONDS, decode_audio, transcribe_long_media
+from media_probe import probe_media
+from translation import get_translation_engine
+from transcript_render import render_transcript
+from instrumentation import stage
+from chunked_upload import read_request_upload
+from transcript_store import TRANSCRIPT_STORE, find_transcript, save_transcript, get_transcript, translated_paragraphs
 
 transcribe_routes = Blueprint("transcribe_routes", __name__)
 
@@ -18,223 +22,296 @@ OUTPUT_FOLDER = 'outputs'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-FFMPEG_WORKERS = 4
+file_registry = storage.get_file_registry()
+SSE_KEEPALIVE_SECONDS = 15
 
 SUPPORTED_LANGUAGES = [
     'ar', 'az', 'zh', 'nl', 'en', 'fi', 'fr', 'de', 'hi', 'hu', 'id', 'ga', 'it', 'ja', 'ko', 'pl', 'pt', 'ru', 'es', 'sv', 'tr', 'uk', 'vi'
 ]
 
-def transcribe_audio(audio_file_path, language=None):
+def transcribe_audio(audio_file_path, language=None, long_media=None):
+    '''
+    Transcribe an audio or video file with Whisper, returns its {'text', 'start', 'end'} segments
+    '''
     try:
-        model = Model(f'base-q5_1', n_threads=12)
-        if language:
-            segments = model.transcribe(audio_file_path, language=language)
+        if long_media is None:
+            long_media = probe_media(audio_file_path)['duration'] >= LONG_MEDIA_SECONDS
+        if long_media:
+            with stage('transcribe'):
+                segments = transcribe_long_media(audio_file_path, language)
         else:
-            segments = model.transcribe(audio_file_path)
-        
-        output = " ".join([segment.text for segment in segments])
-        return output
+            segments = transcribe_segments(decode_audio(audio_file_path), language)
+        return segments
     except Exception as e:
         raise RuntimeError(f"Whisper transcription failed: {str(e)}")
 
-def extract_audio_from_video(video_file_path, audio_output_path):
-    cmd = [
-        'ffmpeg',
-        '-i', video_file_path,
-        '-vn',
-        '-acodec', 'pcm_s16le',
-        '-ar', '16000',
-        '-ac', '1',
-        '-threads', str(FFMPEG_WORKERS),
-        audio_output_path
-    ]
-    subprocess.run(cmd, check=True)
-
-def generate_transcription_file(transcribed_text, save_format):
-    if save_format == "txt":
-        file_stream = BytesIO()
-        file_stream.write(transcribed_text.encode('utf-8'))
-        file_stream.seek(0)
-        return file_stream, "transcription.txt", "text/plain"
-    
-    elif save_format == "docx":
-        file_stream = BytesIO()
-        doc = Document()
-        doc.add_paragraph(transcribed_text)
-        doc.save(file_stream)
-        file_stream.seek(0)
-        return file_stream, "transcription.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-    
-    elif save_format == "json":
-        file_stream = BytesIO()
-        json_data = json.dumps({"transcribed_text": transcribed_text}).encode('utf-8')
-        file_stream.write(json_data)
-        file_stream.seek(0)
-        return file_stream, "transcription.json", "application/json"
-    
-    elif save_format == "pdf":
-        file_stream = BytesIO()
-        pdf_canvas = canvas.Canvas(file_stream)
-        pdf_canvas.setFont("Helvetica", 12)
-        
-        page_width, page_height = pdf_canvas._pagesize
-        margin = 40
-        text_width = page_width - 2 * margin
-        y_position = page_height - margin
-        
-        lines = []
-        for line in transcribed_text.splitlines():
-            words = line.split(' ')
-            current_line = ""
-            for word in words:
-                if pdf_canvas.stringWidth(current_line + word) <= text_width:
-                    current_line += word + " "
-                else:
-                    lines.append(current_line.strip())
-                    current_line = word + " "
-            lines.append(current_line.strip())
-        
-        for line in lines:
-            if y_position < margin:
-                pdf_canvas.showPage()
-                y_position = page_height - margin
-            pdf_canvas.drawString(margin, y_position, line)
-            y_position -= 15
-        
-        pdf_canvas.save()
-        file_stream.seek(0)
-        return file_stream, "transcription.pdf", "application/pdf"
-    
-    raise ValueError("Unsupported format")
+def generate_transcription_file(paragraphs, save_format):
+    '''
+    Render a transcription given as a list of paragraphs (one per segment) in a save format.
+    Returns (chunks, download_name, mimetype), see render_transcript.
+    '''
+    return render_transcript(paragraphs, save_format)
+
+def transcription_file_response(paragraphs, save_format, stored_id=None):
+    '''
+    Stream a rendered transcription file as an attachment, while it is rendered
+    '''
+    chunks, download_name, mimetype = generate_transcription_file(paragraphs, save_format)
+    headers = {'Content-Disposition': f'attachment; filename="{download_name}"'}
+    if stored_id:
+        headers['X-Transcript-ID'] = stored_id
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
 
 def translate_text(text, from_code, to_code):
-    argostranslate.package.update_package_index()
-    available_packages = argostranslate.package.get_available_packages()
-    package_to_install = next(
-        filter(
-            lambda x: x.from_code == from_code and x.to_code == to_code,
-            available_packages
-        )
-    )
-    argostranslate.package.install_from_path(package_to_install.download())
-    
-    translated = argostranslate.translate.translate(text, from_code, to_code)
-    return translated
+    with stage('translate'):
+        return get_translation_engine().translate(text, from_code, to_code)
 
 def validate_language(language):
     if language not in SUPPORTED_LANGUAGES:
         return jsonify({'error': 'Unsupported language. Please choose from the following: ' + ', '.join(SUPPORTED_LANGUAGES)}), 400
     return None
 
-@transcribe_routes.route('/transcribe_audio', methods=['POST'])
-def transcribe_audio_endpoint():
+def run_transcription(filepath, media_digest, input_language=None, output_language='en', long_media=None):
+    '''
+    Transcribe (and translate if needed) an uploaded audio or video file, removing it afterwards.
+    The audio is decoded straight into memory, video or not, so nothing but the upload touches the disk.
+    Transcripts are stored by media content, model and input language: media transcribed before is not
+    decoded again, and only translations into new languages are computed (unless TRANSCRIPT_STORE is off).
+    Returns (transcript_id, paragraphs), one paragraph per segment.
+    '''
+    try:
+        transcript = find_transcript(media_digest, input_language) if TRANSCRIPT_STORE else None
+        if transcript is None:
+            segments = transcribe_audio(filepath, input_language, long_media)
+            stored_id = save_transcript(media_digest, input_language, segments)
+            transcript = {'transcript_id': stored_id, 'input_language': input_language or '', 'segments': segments}
+    finally:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+    return transcript['transcript_id'], translated_paragraphs(transcript, output_language, translate_text)
+
+def transcription_job(filepath, media_digest, input_language, output_language, save_format, long_media=None):
+    '''
+    Job body: run a transcription in a job worker, writing the transcription file to the outputs folder if requested
+    '''
+    stored_id, paragraphs = run_transcription(filepath, media_digest, input_language, output_language, long_media)
+    if not save_format:
+        return {'transcribed_text': ' '.join(paragraphs), 'transcript_id': stored_id}
+
+    chunks, download_name, _ = generate_transcription_file(paragraphs, save_format)
+    output_filename = f"{uuid.uuid4().hex}.{save_format}"
+    with open(storage.output_path(output_filename, create=True), 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    return {'output_file': output_filename, 'download_name': download_name, 'transcript_id': stored_id}
+
+def register_transcription_output(result):
+    if 'output_file' in result:
+        output_filepath = storage.output_path(result['output_file'])
+        file_registry.register(result['output_file'], result.pop('download_name'), size=os.path.getsize(output_filepath))
+    return result
+
+def read_transcription_request():
+    '''
+    Validate the languages of a transcription request, then get its upload (file part or upload_id).
+    Returns (input_language, output_language, filepath, media_digest, error_response), error_response being None if valid.
+    '''
     input_language = request.form.get('input_language', None)
     output_language = request.form.get('output_language', 'en')
-    save_file = request.form.get('save_file', False)
-    save_format = request.form.get('save_format', 'txt')
     if input_language:
         validation_error = validate_language(input_language)
         if validation_error:
-            return validation_error
+            return None, None, None, None, validation_error
     
     validation_error = validate_language(output_language)
     if validation_error:
-        return validation_error
+        return None, None, None, None, validation_error
 
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file part in the request'}), 400
+    _, filepath, media_digest, error_response = read_request_upload()
+    if error_response:
+        return None, None, None, None, error_response
+    return input_language, output_language, filepath, media_digest, None
 
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'error': 'No file selected for upload'}), 400
+def handle_transcription_request(is_video):
+    save_file = request.form.get('save_file', False)
+    save_format = request.form.get('save_format', 'txt')
+    run_async = request.form.get('async', '').lower() in ['1', 'true']
+    # long_media=1 forces chunked parallel transcription, long_media=0 disables it, otherwise it depends on the duration
+    long_media = {'1': True, 'true': True, '0': False, 'false': False}.get(request.form.get('long_media', '').lower())
 
-    filename = secure_filename(file.filename)
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(filepath)
-    # print("save file is", save_file, "and format is", save_format)
-    try:
-        transcribed_text = transcribe_audio(filepath, input_language)
-        os.remove(filepath)
+    input_language, output_language, filepath, media_digest, error_response = read_transcription_request()
+    if error_response:
+        return error_response
+    save_format = save_format if save_file and save_format in ['txt', 'docx', 'pdf', 'json'] else None
 
-        if not (input_language == 'en' and output_language == 'en'):
-            transcribed_text = translate_text(transcribed_text, input_language or 'en', output_language)
+    if run_async:
+        job_id = submit_job('long', transcription_job, filepath, media_digest, input_language, output_language, save_format, long_media,
+                            on_success=register_transcription_output, inputs=[filepath])
+        return jsonify({'job_id': job_id, 'status_url': f'/jobs/{job_id}'}), 202
+
+    try:
+        stored_id, paragraphs = run_transcription(filepath, media_digest, input_language, output_language, long_media)
 
-        if save_file and save_format in ['txt', 'docx', 'pdf', 'json']:
-            file_stream, filename, mime_type = generate_transcription_file(transcribed_text, save_format)
-            return send_file(file_stream, download_name=filename, mimetype=mime_type, as_attachment=True)
+        if save_format:
+            return transcription_file_response(paragraphs, save_format, stored_id)
 
-        return jsonify({'transcribed_text': transcribed_text})
+        return jsonify({'transcribed_text': ' '.join(paragraphs), 'transcript_id': stored_id})
 
     except Exception as e:
-        os.remove(filepath)
-        return jsonify({'error': f'Failed to transcribe audio: {str(e)}'}), 500
+        media = 'video' if is_video else 'audio'
+        return jsonify({'error': f'Failed to transcribe {media}: {str(e)}'}), 500
+
+@transcribe_routes.route('/transcribe_audio', methods=['POST'])
+def transcribe_audio_endpoint():
+    return handle_transcription_request(is_video=False)
 
 @transcribe_routes.route('/transcribe_video', methods=['POST'])
 def transcribe_video_endpoint():
-    input_language = request.form.get('input_language', None)
-    output_language = request.form.get('output_language', 'en')
-    save_file = request.form.get('save_file', False)
-    save_format = request.form.get('save_format', 'txt')
-    if input_language:
-        validation_error = validate_language(input_language)
-        if validation_error:
-            return validation_error
-    
-    validation_error = validate_language(output_language)
+    return handle_transcription_request(is_video=True)
+
+def stream_transcription_events(filepath, input_language, output_language):
+    '''
+    Transcribe in a background thread and yield every segment as a Server-Sent Event as soon as Whisper
+    produces it, translated on the fly if needed. Keep-alive comments are sent while waiting.
+    '''
+    events = queue.Queue()
+    cancelled = threading.Event()
+
+    def transcribe():
+        last_event = ('done', None)
+        try:
+            transcribe_segments(decode_audio(filepath), input_language,
+                                on_segment=lambda segment: events.put(('segment', segment)),
+                                should_abort=cancelled.is_set)
+        except Exception as e:
+            last_event = ('error', {'error': f'Failed to transcribe: {str(e)}'})
+        finally:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            events.put(last_event)
+
+    worker = threading.Thread(target=transcribe, daemon=True)
+    worker.start()
+    translate = not (input_language == 'en' and output_language == 'en')
+    try:
+        while True:
+            try:
+                kind, data = events.get(timeout=SSE_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+
+            if kind == 'segment' and translate:
+                try:
+                    data = dict(data, text=translate_text(data['text'], input_language or 'en', output_language))
+                except Exception as e:
+                    kind, data = 'error', {'error': f'Failed to translate: {str(e)}'}
+            yield f"event: {kind}\ndata: {json.dumps(data or {})}\n\n"
+            if kind in ['done', 'error']:
+                break
+    finally:
+        cancelled.set() # stops Whisper if the client went away
+
+def handle_transcription_stream():
+    input_language, output_language, filepath, _, error_response = read_transcription_request()
+    if error_response:
+        return error_response
+
+    return Response(stream_transcription_events(filepath, input_language, output_language),
+                    mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@transcribe_routes.route('/stream_audio', methods=['POST'])
+def stream_audio_endpoint():
+    '''
+    @description:
+        Same as /transcribe_audio, but the response is a text/event-stream sending every segment
+        as it is transcribed: "segment" events with {text, start, end} (seconds), then a "done" event,
+        or an "error" event if the transcription failed.
+    '''
+    return handle_transcription_stream()
+
+@transcribe_routes.route('/stream_video', methods=['POST'])
+def stream_video_endpoint():
+    '''
+    @description:
+        Same as /stream_audio, for video files.
+    '''
+    return handle_transcription_stream()
+
+def stored_transcript_paragraphs(stored_id, language):
+    '''
+    Paragraphs of a stored transcript in a language (its input language by default), translated if needed.
+    Returns (transcript, paragraphs, error_response), error_response being None if found.
+    '''
+    transcript = get_transcript(stored_id)
+    if transcript is None:
+        return None, None, (jsonify({'error': 'Transcript not found'}), 404)
+    language = language or transcript['input_language'] or 'en'
+    validation_error = validate_language(language)
     if validation_error:
-        return validation_error
-
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file part in the request'}), 400
-
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'error': 'No file selected for upload'}), 400
-
-    filename = secure_filename(file.filename)
-    video_filepath = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(video_filepath)
-
+        return None, None, validation_error
     try:
-        audio_filepath = os.path.join(UPLOAD_FOLDER, "audio.wav")
-        extract_audio_from_video(video_filepath, audio_filepath)
-        transcribed_text = transcribe_audio(audio_filepath, input_language)
-        os.remove(video_filepath)
-        os.remove(audio_filepath)
-
-        if not (input_language == 'en' and output_language == 'en'):
-            transcribed_text = translate_text(transcribed_text, input_language or 'en', output_language)
-
-        if save_file and save_format in ['txt', 'docx', 'pdf', 'json']:
-            file_stream, filename, mime_type = generate_transcription_file(transcribed_text, save_format)
-            return send_file(file_stream, download_name=filename, mimetype=mime_type, as_attachment=True)
-
-        return jsonify({'transcribed_text': transcribed_text})
-
+        return transcript, translated_paragraphs(transcript, language, translate_text), None
+    except LookupError as e:
+        return None, None, (jsonify({'error': str(e)}), 400)
     except Exception as e:
-        os.remove(video_filepath)
-        return jsonify({'error': f'Failed to transcribe video: {str(e)}'}), 500
+        return None, None, (jsonify({'error': f'Failed to translate text: {str(e)}'}), 500)
+
+@transcribe_routes.route('/transcripts/<stored_id>', methods=['GET'])
+def transcript_endpoint(stored_id):
+    '''
+    @description:
+        Get a stored transcript: the transcript_id returned by the transcription endpoints stays valid
+        while the transcript is used, for TRANSCRIPT_TTL_SECONDS after its last use.
+    @params:
+        - language: language of transcribed_text (query string, defaults to the input language)
+    @returns:
+        - JSON response with the segments ({text, start, end}) and the transcribed_text
+        - JSON response with error message if unsuccessful
+    '''
+    transcript, paragraphs, error_response = stored_transcript_paragraphs(stored_id, request.args.get('language'))
+    if error_response:
+        return error_response
+    return jsonify({
+        'transcript_id': stored_id,
+        'model': transcript['model'],
+        'input_language': transcript['input_language'] or None,
+        'segments': transcript['segments'],
+        'transcribed_text': ' '.join(paragraphs),
+    })
 
 @transcribe_routes.route('/save_transcription', methods=['POST'])
 def save_transcription_endpoint():
+    '''
+    @description:
+        Render a transcription as a txt, docx, json or pdf file: either a text posted by the client,
+        or a stored transcript in any language, without posting the text back.
+    @params:
+        - JSON body:
+            - format: txt, docx, json or pdf
+            - text: the transcription to render
+            - or transcript_id: a stored transcript, with language (optional, defaults to its input language)
+    '''
     data = request.get_json()
-    if not data or 'text' not in data or 'format' not in data:
-        return jsonify({'error': 'Missing required fields (text, format)'}), 400
+    if not data or 'format' not in data or ('text' not in data and 'transcript_id' not in data):
+        return jsonify({'error': 'Missing required fields (text or transcript_id, format)'}), 400
 
-    text = data['text']
     save_format = data['format']
 
     if save_format not in ["txt", "docx", "json", "pdf"]:
         return jsonify({'error': 'Invalid format. Valid options are txt, docx, json, pdf.'}), 400
 
+    stored_id = data.get('transcript_id')
+    if stored_id:
+        _, paragraphs, error_response = stored_transcript_paragraphs(stored_id, data.get('language'))
+        if error_response:
+            return error_response
+    else:
+        paragraphs = data['text'].splitlines()
+
     try:
-        file_stream, filename, mime_type = generate_transcription_file(text, save_format)
-        return send_file(
-            file_stream,
-            download_name=filename,
-            mimetype=mime_type,
-            as_attachment=True
-        )
+        return transcription_file_response(paragraphs, save_format, stored_id)
     except Exception as e:
         return jsonify({'error': f'Failed to generate transcription: {str(e)}'}), 500
 
@@ -251,5 +328,7 @@ def translate_text_endpoint():
     try:
         translated_text = translate_text(text, from_code, to_code)
         return jsonify({'translated_text': translated_text})
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': f'Failed to translate text: {str(e)}'}), 500
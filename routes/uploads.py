@@ -0,0 +1,90 @@
+from flask import Blueprint, request, jsonify
+import storage
+import chunked_upload
+
+upload_routes = Blueprint("upload_routes", __name__)
+
+def find_upload(upload_id):
+    upload = storage.get_file_registry().get_upload(upload_id)
+    if upload is None:
+        return None, (jsonify({'error': 'Upload not found'}), 404)
+    return upload, None
+
+@upload_routes.route('', methods=['POST'])
+def create_upload():
+    '''
+    @description:
+        Start a resumable chunked upload, for large files. Send its chunks with PUT /uploads/<upload_id>?offset=N,
+        complete it with POST /uploads/<upload_id>/complete, then pass upload_id instead of a file part
+        to /audio/convert_audio, /image/convert_image and the /transcribe endpoints.
+
+    @params:
+        - JSON body:
+            - filename: name of the file, its extension tells the input format
+            - size: size of the file in bytes
+
+    @returns:
+        - JSON response with the upload_id and the block_size chunk offsets must be a multiple of
+        - JSON response with error message if unsuccessful
+    '''
+    data = request.get_json(silent=True) or {}
+    try:
+        upload_id = chunked_upload.create_upload(data.get('filename'), data.get('size'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'upload_id': upload_id, 'block_size': storage.UPLOAD_BLOCK_SIZE, 'upload_url': f'/uploads/{upload_id}'}), 201
+
+@upload_routes.route('/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    '''
+    @description:
+        Get the progress of an upload. After a dropped connection, resume by sending the rest of the file from next_offset.
+    '''
+    upload, error_response = find_upload(upload_id)
+    if error_response:
+        return error_response
+    return jsonify(chunked_upload.upload_status(upload))
+
+@upload_routes.route('/<upload_id>', methods=['PUT'])
+def put_chunk(upload_id):
+    '''
+    @description:
+        Write the raw request body at an offset of the file. The offset must be a multiple of block_size,
+        chunks may have any length, and may be sent in any order or in parallel.
+
+    @params:
+        - offset: position of the chunk in the file (query string)
+
+    @returns:
+        - JSON response with the progress of the upload
+        - JSON response with error message if unsuccessful
+    '''
+    upload, error_response = find_upload(upload_id)
+    if error_response:
+        return error_response
+    try:
+        offset = int(request.args.get('offset', 0))
+        chunked_upload.write_chunk(upload, offset, request.stream)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(chunked_upload.upload_status(upload))
+
+@upload_routes.route('/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    upload, error_response = find_upload(upload_id)
+    if error_response:
+        return error_response
+    if upload['digest'] is None:
+        try:
+            upload['digest'] = chunked_upload.complete_upload(upload)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 409
+    return jsonify({'upload_id': upload_id, 'size': upload['size'], 'digest': upload['digest']})
+
+@upload_routes.route('/<upload_id>', methods=['DELETE'])
+def delete_upload(upload_id):
+    upload, error_response = find_upload(upload_id)
+    if error_response:
+        return error_response
+    chunked_upload.remove_upload(upload_id)
+    return '', 204
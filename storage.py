@@ -1,11 +1,510 @@
-from threading import local
+import hashlib
+import json
+import mimetypes
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from instrumentation import stage
 
-_thread_locals = local() # Thread local storage
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# uploads are hashed in blocks of this size, so chunked uploads can be hashed as their chunks arrive
+UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024
+OUTPUT_FOLDER = 'outputs'
+FILE_REGISTRY_PATH = os.environ.get('FILE_REGISTRY_PATH', 'registry.db')
+OUTPUT_TTL_SECONDS = int(os.environ.get('OUTPUT_TTL_SECONDS', 24 * 3600))
+# transcripts not used for this long are forgotten
+TRANSCRIPT_TTL_SECONDS = int(os.environ.get('TRANSCRIPT_TTL_SECONDS', 30 * 24 * 3600))
 
-def get_file_mapping():
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    output_id TEXT PRIMARY KEY,
+    original_name TEXT NOT NULL,
+    size INTEGER,
+    content_type TEXT,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_expires_at ON files (expires_at);
+CREATE TABLE IF NOT EXISTS result_cache (
+    cache_key TEXT PRIMARY KEY,
+    output_id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS result_cache_used_at ON result_cache (used_at);
+CREATE INDEX IF NOT EXISTS result_cache_output_id ON result_cache (output_id);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS allocations (
+    allocation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pid INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    threads INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    job_class TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS job_inputs (
+    job_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (job_id, path)
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    upload_id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    digest TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transcripts (
+    transcript_id TEXT PRIMARY KEY,
+    media_digest TEXT NOT NULL,
+    model TEXT NOT NULL,
+    input_language TEXT NOT NULL,
+    segments TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transcript_translations (
+    transcript_id TEXT NOT NULL,
+    language TEXT NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (transcript_id, language)
+);
+CREATE TABLE IF NOT EXISTS upload_blocks (
+    upload_id TEXT NOT NULL,
+    block INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (upload_id, block)
+);
+'''
+
+class FileRegistry:
+    '''
+    Registry of converted outputs shared by every worker process and thread.
+    Backed by SQLite in WAL mode, so lookups never block on writers; each thread keeps its own connection.
+    '''
+    def __init__(self, path=FILE_REGISTRY_PATH):
+        self.path = path
+        self._connections = threading.local()
+
+    def _connect(self):
+        connection = getattr(self._connections, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+            self._connections.connection = connection
+        return connection
+
+    def register(self, output_id, original_name, size=None, content_type=None, ttl=OUTPUT_TTL_SECONDS):
+        '''
+        Register (or refresh) an output under its id with the name it should be downloaded as
+        '''
+        now = time.time()
+        if content_type is None:
+            content_type = mimetypes.guess_type(original_name)[0] or 'application/octet-stream'
+        self._connect().execute(
+            'INSERT OR REPLACE INTO files (output_id, original_name, size, content_type, created_at, expires_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (output_id, original_name, size, content_type, now, now + ttl),
+        )
+
+    def lookup(self, output_id):
+        '''
+        Get the registry entry of an output as a dict, or None if it is unknown or expired
+        '''
+        row = self._connect().execute(
+            'SELECT * FROM files WHERE output_id = ? AND expires_at > ?', (output_id, time.time())
+        ).fetchone()
+        return dict(row) if row else None
+
+    def remove(self, output_id):
+        connection = self._connect()
+        connection.execute('DELETE FROM files WHERE output_id = ?', (output_id,))
+        connection.execute('DELETE FROM result_cache WHERE output_id = ?', (output_id,))
+
+    def expire(self, now=None, batch_size=500):
+        '''
+        Delete up to batch_size expired entries in one transaction and return their output ids
+        '''
+        now = time.time() if now is None else now
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(
+                'SELECT output_id FROM files WHERE expires_at <= ? LIMIT ?', (now, batch_size)
+            ).fetchall()
+            expired = [row['output_id'] for row in rows]
+            connection.executemany('DELETE FROM files WHERE output_id = ?', [(output_id,) for output_id in expired])
+            connection.executemany('DELETE FROM result_cache WHERE output_id = ?', [(output_id,) for output_id in expired])
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return expired
+
+    def output_ids(self):
+        '''
+        Get the ids of every registered output, expired or not
+        '''
+        return {row['output_id'] for row in self._connect().execute('SELECT output_id FROM files')}
+
+    def get_cached_output(self, cache_key, ttl=OUTPUT_TTL_SECONDS):
+        '''
+        Get the output id cached under cache_key, or None on a miss.
+        Marks the entry as used and keeps its output registered for at least ttl more seconds.
+        '''
+        connection = self._connect()
+        row = connection.execute('SELECT output_id FROM result_cache WHERE cache_key = ?', (cache_key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        connection.execute('UPDATE result_cache SET used_at = ? WHERE cache_key = ?', (now, cache_key))
+        connection.execute('UPDATE files SET expires_at = MAX(expires_at, ?) WHERE output_id = ?', (now + ttl, row['output_id']))
+        return row['output_id']
+
+    def put_cached_output(self, cache_key, output_id, size, max_bytes):
+        '''
+        Cache an output under cache_key, then evict least recently used entries until the cached outputs
+        of every worker fit max_bytes (the new entry is always kept). Returns the evicted output ids.
+        '''
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'INSERT OR REPLACE INTO result_cache (cache_key, output_id, size, used_at) VALUES (?, ?, ?, ?)',
+                (cache_key, output_id, size, time.time()),
+            )
+            total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM result_cache').fetchone()[0]
+            evicted = []
+            while total > max_bytes:
+                row = connection.execute(
+                    'SELECT cache_key, output_id, size FROM result_cache WHERE cache_key != ? ORDER BY used_at LIMIT 1', (cache_key,)
+                ).fetchone()
+                if row is None:
+                    break
+                connection.execute('DELETE FROM result_cache WHERE cache_key = ?', (row['cache_key'],))
+                total -= row['size']
+                evicted.append(row['output_id'])
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return evicted
+
+    def remove_cached_output(self, cache_key):
+        self._connect().execute('DELETE FROM result_cache WHERE cache_key = ?', (cache_key,))
+
+    def result_cache_usage(self):
+        '''
+        Get (entries, bytes) of the result cache
+        '''
+        row = self._connect().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM result_cache').fetchone()
+        return row[0], row[1]
+
+    def bump_counter(self, name, amount=1):
+        self._connect().execute(
+            'INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+            (name, amount),
+        )
+
+    def bump_counters(self, amounts):
+        '''
+        Add {name: amount} to many counters in one transaction
+        '''
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany(
+                'INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                list(amounts.items()),
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def set_counter(self, name, value):
+        self._connect().execute('INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)', (name, value))
+
+    def get_counters(self):
+        return {row['name']: row['value'] for row in self._connect().execute('SELECT name, value FROM counters')}
+
+    def allocate_threads(self, kind, requested, budget, min_threads=1):
+        '''
+        Atomically grant up to `requested` threads out of `budget`, taking every live allocation
+        of every process into account. Allocations of dead processes are released first.
+        Returns (allocation_id, threads).
+        '''
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for row in connection.execute('SELECT DISTINCT pid FROM allocations').fetchall():
+                try:
+                    os.kill(row['pid'], 0)
+                except ProcessLookupError:
+                    connection.execute('DELETE FROM allocations WHERE pid = ?', (row['pid'],))
+                except PermissionError:
+                    pass
+            in_use = connection.execute('SELECT COALESCE(SUM(threads), 0) FROM allocations').fetchone()[0]
+            threads = max(min_threads, min(requested, budget - in_use))
+            cursor = connection.execute(
+                'INSERT INTO allocations (pid, kind, threads, created_at) VALUES (?, ?, ?, ?)',
+                (os.getpid(), kind, threads, time.time()),
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return cursor.lastrowid, threads
+
+    def release_threads(self, allocation_id):
+        self._connect().execute('DELETE FROM allocations WHERE allocation_id = ?', (allocation_id,))
+
+    def thread_allocations(self):
+        return [dict(row) for row in self._connect().execute('SELECT * FROM allocations ORDER BY allocation_id')]
+
+    def save_job(self, job_id, job_class, status, result=None, error=None):
+        '''
+        Record the status of a job so any worker can answer status requests for it
+        '''
+        now = time.time()
+        finished_at = now if status in ['done', 'failed'] else None
+        self._connect().execute(
+            'INSERT INTO jobs (job_id, job_class, status, result, error, created_at, finished_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(job_id) DO UPDATE SET status = excluded.status, result = excluded.result, '
+            'error = excluded.error, finished_at = excluded.finished_at',
+            (job_id, job_class, status, json.dumps(result), error, now, finished_at),
+        )
+
+    def get_job(self, job_id):
+        row = self._connect().execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def prune_jobs(self, finished_before):
+        connection = self._connect()
+        connection.execute(
+            'DELETE FROM job_inputs WHERE job_id IN (SELECT job_id FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?)',
+            (finished_before,),
+        )
+        connection.execute('DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?', (finished_before,))
+
+    def save_job_inputs(self, job_id, paths):
+        self._connect().executemany(
+            'INSERT OR IGNORE INTO job_inputs (job_id, path) VALUES (?, ?)', [(job_id, os.path.abspath(path)) for path in paths]
+        )
+
+    def pending_job_inputs(self):
+        '''
+        Get the absolute paths of the input files of every job not finished yet, which must not be reaped
+        '''
+        rows = self._connect().execute(
+            'SELECT path FROM job_inputs JOIN jobs ON jobs.job_id = job_inputs.job_id WHERE jobs.finished_at IS NULL'
+        )
+        return {row['path'] for row in rows}
+
+    def save_transcript(self, transcript_id, media_digest, model, input_language, segments):
+        now = time.time()
+        self._connect().execute(
+            'INSERT OR REPLACE INTO transcripts (transcript_id, media_digest, model, input_language, segments, created_at, used_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (transcript_id, media_digest, model, input_language, json.dumps(segments), now, now),
+        )
+
+    def get_transcript(self, transcript_id):
+        '''
+        Get a stored transcript as a dict with its segments, or None if it is unknown. Marks it as used.
+        '''
+        connection = self._connect()
+        row = connection.execute('SELECT * FROM transcripts WHERE transcript_id = ?', (transcript_id,)).fetchone()
+        if row is None:
+            return None
+        connection.execute('UPDATE transcripts SET used_at = ? WHERE transcript_id = ?', (time.time(), transcript_id))
+        transcript = dict(row)
+        transcript['segments'] = json.loads(transcript['segments'])
+        return transcript
+
+    def get_transcript_translation(self, transcript_id, language):
+        row = self._connect().execute(
+            'SELECT text FROM transcript_translations WHERE transcript_id = ? AND language = ?', (transcript_id, language)
+        ).fetchone()
+        return row['text'] if row else None
+
+    def save_transcript_translation(self, transcript_id, language, text):
+        self._connect().execute(
+            'INSERT OR REPLACE INTO transcript_translations (transcript_id, language, text) VALUES (?, ?, ?)',
+            (transcript_id, language, text),
+        )
+
+    def prune_transcripts(self, used_before):
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'DELETE FROM transcript_translations WHERE transcript_id IN (SELECT transcript_id FROM transcripts WHERE used_at < ?)',
+                (used_before,),
+            )
+            connection.execute('DELETE FROM transcripts WHERE used_at < ?', (used_before,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def create_upload(self, upload_id, filename, size):
+        now = time.time()
+        self._connect().execute(
+            'INSERT INTO uploads (upload_id, filename, size, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+            (upload_id, filename, size, now, now),
+        )
+
+    def get_upload(self, upload_id):
+        '''
+        Get a chunked upload as a dict, with the number of blocks received so far, or None if it is unknown
+        '''
+        row = self._connect().execute(
+            'SELECT uploads.*, (SELECT COUNT(*) FROM upload_blocks WHERE upload_blocks.upload_id = uploads.upload_id) AS blocks '
+            'FROM uploads WHERE upload_id = ?', (upload_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def save_upload_block(self, upload_id, block, digest):
+        connection = self._connect()
+        connection.execute('INSERT OR REPLACE INTO upload_blocks (upload_id, block, digest) VALUES (?, ?, ?)', (upload_id, block, digest))
+        connection.execute('UPDATE uploads SET updated_at = ? WHERE upload_id = ?', (time.time(), upload_id))
+
+    def upload_block_digests(self, upload_id):
+        '''
+        Get {block index: digest} of the blocks of a chunked upload received so far
+        '''
+        rows = self._connect().execute('SELECT block, digest FROM upload_blocks WHERE upload_id = ?', (upload_id,))
+        return {row['block']: row['digest'] for row in rows}
+
+    def touch_upload(self, upload_id):
+        self._connect().execute('UPDATE uploads SET updated_at = ? WHERE upload_id = ?', (time.time(), upload_id))
+
+    def complete_upload(self, upload_id, digest):
+        self._connect().execute('UPDATE uploads SET digest = ?, updated_at = ? WHERE upload_id = ?', (digest, time.time(), upload_id))
+
+    def remove_upload(self, upload_id):
+        connection = self._connect()
+        connection.execute('DELETE FROM upload_blocks WHERE upload_id = ?', (upload_id,))
+        connection.execute('DELETE FROM uploads WHERE upload_id = ?', (upload_id,))
+
+    def prune_uploads(self, updated_before):
+        '''
+        Forget chunked uploads untouched since updated_before, returns their ids
+        '''
+        connection = self._connect()
+        rows = connection.execute('SELECT upload_id FROM uploads WHERE updated_at < ?', (updated_before,)).fetchall()
+        for row in rows:
+            self.remove_upload(row['upload_id'])
+        return [row['upload_id'] for row in rows]
+
+_registries = {}
+
+def get_file_registry():
+    '''
+    Get the shared file registry
+    '''
+    if FILE_REGISTRY_PATH not in _registries:
+        _registries[FILE_REGISTRY_PATH] = FileRegistry(FILE_REGISTRY_PATH)
+    return _registries[FILE_REGISTRY_PATH]
+
+def output_path(output_id, create=False):
+    '''
+    Get the path of an output file, sharded into subdirectories by the first characters of its id
+    so the outputs folder never turns into one huge flat directory
+    '''
+    shard_folder = os.path.join(OUTPUT_FOLDER, output_id[:2])
+    if create:
+        os.makedirs(shard_folder, exist_ok=True)
+    return os.path.join(shard_folder, output_id)
+
+def link_output(output_id):
+    '''
+    Give an existing output a new id of its own, a hard link to the same file, so it can be registered
+    under another download name without renaming the download of whoever got the first id.
+    Raises FileNotFoundError if the output is gone.
+    '''
+    linked_id = uuid.uuid4().hex + os.path.splitext(output_id)[1]
+    os.link(output_path(output_id), output_path(linked_id, create=True))
+    return linked_id
+
+class BlockHasher:
+    '''
+    Hash content in UPLOAD_BLOCK_SIZE blocks as it streams in. The blocks of a file can be hashed in any order,
+    by different processes, and combined into its content digest with combine_block_digests.
+    '''
+    def __init__(self):
+        self.digests = []
+        self._block = hashlib.sha256()
+        self._filled = 0
+
+    def update(self, data):
+        '''
+        Hash data, returns the digests of the blocks it completed
+        '''
+        completed = len(self.digests)
+        view = memoryview(data)
+        while view:
+            size = min(len(view), UPLOAD_BLOCK_SIZE - self._filled)
+            self._block.update(view[:size])
+            self._filled += size
+            view = view[size:]
+            if self._filled == UPLOAD_BLOCK_SIZE:
+                self._end_block()
+        return self.digests[completed:]
+
+    def finish(self):
+        '''
+        Hash the last, partial block if any, returns the digests of every block
+        '''
+        if self._filled:
+            self._end_block()
+        return self.digests
+
+    def _end_block(self):
+        self.digests.append(self._block.hexdigest())
+        self._block = hashlib.sha256()
+        self._filled = 0
+
+def combine_block_digests(digests):
+    '''
+    Content digest of a file from the digests of its blocks, in order
+    '''
+    return hashlib.sha256(''.join(digests).encode()).hexdigest()
+
+def save_upload(file, filepath):
     '''
-    Get the file mapping dictionary from the thread local storage
+    Save an uploaded file chunk by chunk, hashing the content as it streams in.
+    Returns the content digest of the saved content (see BlockHasher).
     '''
-    if not hasattr(_thread_locals, "file_mapping"):
-        _thread_locals.file_mapping = {}
-    return _thread_locals.file_mapping
+    hasher = BlockHasher()
+    with stage('upload'), open(filepath, 'wb') as f:
+        while True:
+            chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            f.write(chunk)
+    return combine_block_digests(hasher.finish())
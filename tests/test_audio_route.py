@@ -2,7 +2,15 @@ import unittest
 from io import BytesIO
 from app import app
 import os
+import shutil
+import storage
+import subprocess
 import threading
+import time
+import resources
+from unittest import mock
+from job_queue import run_command
+from resources import run_ffmpeg
 
 class AudioConversionTestCase(unittest.TestCase):
     def setUp(self):
@@ -20,7 +28,10 @@ class AudioConversionTestCase(unittest.TestCase):
         for folder in ['uploads', 'outputs']:
             for file in os.listdir(folder):
                 file_path = os.path.join(folder, file)
-                os.remove(file_path)
+                if os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+                else:
+                    os.remove(file_path)
 
     def test_convert_audio_required(self):
         """Test valid audio conversion with required parameters."""
@@ -106,6 +117,196 @@ class AudioConversionTestCase(unittest.TestCase):
             self.assertIn('File converted to wav successfully', response.json['message'])
             self.assertIn('output_file', response.json)
     
+    def test_convert_audio_removes_upload(self):
+        """Test the uploaded input is removed once the conversion succeeded."""
+        with open(self.test_audio_path, 'rb') as f:
+            response = self.app.post('/audio/convert_audio',
+                                    data={'file': (BytesIO(f.read()), 'test.mp3'), 'output_format': 'ogg'},
+                                    content_type='multipart/form-data')
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(os.listdir('uploads'), [])
+
+    def test_convert_audio_rejects_invalid_media(self):
+        """Test an upload ffmpeg cannot read is rejected by the preflight probe."""
+        response = self.app.post('/audio/convert_audio',
+                                data={'file': (BytesIO(b'not audio at all'), 'test.mp3'), 'output_format': 'wav'},
+                                content_type='multipart/form-data')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('not a valid media file', response.json['error'])
+        self.assertEqual(os.listdir('uploads'), [])
+
+    def test_convert_audio_stream_copy(self):
+        """Test a container-only change copies the audio stream instead of re-encoding it."""
+        with open(self.test_audio_path, 'rb') as f:
+            response = self.app.post('/audio/convert_audio',
+                                    data={'file': (BytesIO(f.read()), 'test.mp3'), 'output_format': 'mp3'},
+                                    content_type='multipart/form-data')
+
+        self.assertEqual(response.status_code, 200)
+        output_filepath = storage.output_path(response.json['output_file'])
+        banner = subprocess.run(['ffmpeg', '-hide_banner', '-i', output_filepath], stderr=subprocess.PIPE).stderr.decode()
+        # re-encoding would have used the encoder's default 128 kb/s
+        self.assertIn('Audio: mp3', banner)
+        self.assertIn('192 kb/s', banner)
+
+    def test_convert_renditions(self):
+        """Test several renditions come out of a single ffmpeg run, each with its own output."""
+        renditions = '[{"output_format": "mp3", "bitrate": "64k"}, {"output_format": "mp3", "bitrate": "96k"}, {"output_format": "ogg"}]'
+        with open(self.test_audio_path, 'rb') as f:
+            data = {'file': (BytesIO(f.read()), 'test.mp3'), 'renditions': renditions}
+        with mock.patch('routes.audio.run_ffmpeg', wraps=run_ffmpeg) as spy:
+            response = self.app.post('/audio/convert_renditions', data=data, content_type='multipart/form-data')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(spy.call_count, 1)
+        outputs = response.json['renditions']
+        self.assertEqual([output['output_format'] for output in outputs], ['mp3', 'mp3', 'ogg'])
+        banners = [subprocess.run(['ffmpeg', '-hide_banner', '-i', storage.output_path(output['output_file'])],
+                                  stderr=subprocess.PIPE).stderr.decode() for output in outputs]
+        self.assertIn('64 kb/s', banners[0])
+        self.assertIn('96 kb/s', banners[1])
+        self.assertIn('Audio: vorbis', banners[2])
+        self.assertEqual(os.listdir('uploads'), [])
+
+        download = self.app.get(f"/download/{outputs[1]['output_file']}")
+        self.assertIn('test-96k.mp3', download.headers['Content-Disposition'])
+        download.close()
+
+    def fail_after_writing_outputs(self, command, **kwargs):
+        # an ffmpeg run that got partway through every output before failing
+        for arg in command:
+            if arg.startswith(storage.OUTPUT_FOLDER + os.sep):
+                with open(arg, 'wb') as f:
+                    f.write(b'partial')
+        raise subprocess.CalledProcessError(1, command, stderr=b'Conversion failed')
+
+    def output_files(self):
+        return [name for _, _, names in os.walk('outputs') for name in names]
+
+    def test_convert_renditions_failure_removes_outputs(self):
+        """Test a failed rendition run leaves none of its outputs behind, in the route and as a job."""
+        renditions = '[{"output_format": "mp3", "bitrate": "64k"}, {"output_format": "ogg"}]'
+        with open(self.test_audio_path, 'rb') as f:
+            data = {'file': (BytesIO(f.read()), 'test.mp3'), 'renditions': renditions}
+        with mock.patch('routes.audio.run_ffmpeg', side_effect=self.fail_after_writing_outputs):
+            response = self.app.post('/audio/convert_renditions', data=data, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.output_files(), [])
+
+        outputs = [storage.output_path(f'{name}.mp3', create=True) for name in ['first', 'second']]
+        command = ['ffmpeg', '-i', 'in.mp3', outputs[0], outputs[1]]
+        with mock.patch('job_queue.run_ffmpeg', side_effect=self.fail_after_writing_outputs):
+            with self.assertRaises(RuntimeError):
+                run_command(command, None, outputs)
+        self.assertEqual(self.output_files(), [])
+
+    def test_convert_renditions_invalid(self):
+        """Test invalid rendition lists are rejected before running ffmpeg."""
+        for renditions in ['', '{}', '[{"output_format": "xyz"}]', '[{"output_format": "mp3", "volume": "loud"}]']:
+            with open(self.test_audio_path, 'rb') as f:
+                data = {'file': (BytesIO(f.read()), 'test.mp3'), 'renditions': renditions}
+            response = self.app.post('/audio/convert_renditions', data=data, content_type='multipart/form-data')
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(os.listdir('uploads'), [])
+
+    def test_stream_audio_multipart(self):
+        """Test streaming conversion of a multipart upload."""
+        with open(self.test_audio_path, 'rb') as f:
+            response = self.app.post('/audio/stream_audio',
+                                    data={'file': (BytesIO(f.read()), 'test.mp3'), 'output_format': 'wav'},
+                                    content_type='multipart/form-data')
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'audio/wav')
+            self.assertIn('test.wav', response.headers['Content-Disposition'])
+            self.assertTrue(response.data.startswith(b'RIFF'))
+            self.assertEqual(os.listdir('uploads'), [])
+            self.assertEqual(os.listdir('outputs'), [])
+
+    def test_stream_audio_raw_body(self):
+        """Test streaming conversion of a raw request body with parameters in the query string."""
+        with open(self.test_audio_path, 'rb') as f:
+            response = self.app.post('/audio/stream_audio?output_format=flac&channels=1',
+                                    data=f.read(), content_type='application/octet-stream')
+
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.data.startswith(b'fLaC'))
+
+    def test_stream_audio_releases_child_slot(self):
+        """Test the child slot is given back after a streamed conversion, a bad input and a failed start."""
+        with mock.patch('resources._children', threading.BoundedSemaphore(1)), \
+             mock.patch('resources.FFMPEG_QUEUE_SECONDS', 0.2):
+            with open(self.test_audio_path, 'rb') as f:
+                response = self.app.post('/audio/stream_audio?output_format=wav', data=f.read(),
+                                        content_type='application/octet-stream')
+            self.assertTrue(response.data.startswith(b'RIFF'))
+            response.close()
+
+            response = self.app.post('/audio/stream_audio?output_format=wav', data=b'not audio',
+                                    content_type='application/octet-stream')
+            self.assertEqual(response.status_code, 500)
+
+            with mock.patch('routes.audio.subprocess.Popen', side_effect=OSError('ffmpeg not found')):
+                response = self.app.post('/audio/stream_audio?output_format=wav', data=b'not audio',
+                                        content_type='application/octet-stream')
+            self.assertEqual(response.status_code, 500)
+
+            with open(self.test_audio_path, 'rb') as f:
+                response = self.app.post('/audio/stream_audio?output_format=wav', data=f.read(),
+                                        content_type='application/octet-stream')
+            self.assertEqual(response.status_code, 200)
+            response.close()
+
+    def test_stream_audio_timeout(self):
+        """Test a stream whose client stops sending is killed after the ffmpeg timeout and gives its slot back."""
+        with open(self.test_audio_path, 'rb') as f:
+            head = f.read(2048)
+        unblock = threading.Event()
+
+        class StalledUpload:
+            def __init__(self):
+                self.sent = False
+                self.pos = 0
+
+            def tell(self):
+                return self.pos
+
+            def seek(self, pos, whence=0):
+                self.pos = 10 ** 6 if whence == 2 else pos # announce a body that never fully arrives
+
+            def read(self, size=-1):
+                if not self.sent:
+                    self.sent = True
+                    return head
+                unblock.wait(10) # the client stops sending
+                return b''
+
+        self.addCleanup(unblock.set)
+        with mock.patch('resources._children', threading.BoundedSemaphore(1)), \
+             mock.patch('resources.FFMPEG_QUEUE_SECONDS', 0.2), \
+             mock.patch('routes.audio.FFMPEG_TIMEOUT_SECONDS', 0.5), \
+             mock.patch('routes.audio.STREAM_JOIN_SECONDS', 0.1):
+            start = time.monotonic()
+            response = self.app.post('/audio/stream_audio?output_format=wav', input_stream=StalledUpload(),
+                                     content_type='application/octet-stream')
+            response.get_data()
+            response.close()
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertIn(response.status_code, [200, 504])
+            with resources.child_slot():
+                pass
+
+    def test_stream_audio_unsupported_format(self):
+        """Test formats that cannot be written to a pipe are rejected."""
+        with open(self.test_audio_path, 'rb') as f:
+            response = self.app.post('/audio/stream_audio',
+                                    data={'file': (BytesIO(f.read()), 'test.mp3'), 'output_format': 'm4a'},
+                                    content_type='multipart/form-data')
+
+            self.assertEqual(response.status_code, 400)
+
     def test_collision(self):
         """Test for filename collision."""
         def send_request():
@@ -0,0 +1,41 @@
+import unittest
+from benchmarks.run import compare_to_baseline, parse_server_timing, percentile
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_percentile(self):
+        """Test nearest-rank percentiles."""
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.50), 50)
+        self.assertEqual(percentile(values, 0.95), 95)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([7], 0.99), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_parse_server_timing(self):
+        """Test stage timings are read back from the Server-Timing header."""
+        self.assertEqual(parse_server_timing('upload;dur=1.5, ffmpeg;dur=42.0'), {'upload': 1.5, 'ffmpeg': 42.0})
+        self.assertEqual(parse_server_timing(None), {})
+
+    def test_compare_to_baseline(self):
+        """Test slowdowns past the threshold and newly failing scenarios are regressions, noise is not."""
+        baseline = {
+            'fast': {'p50_ms': 10.0, 'p95_ms': 12.0},
+            'slow': {'p50_ms': 100.0, 'p95_ms': 120.0},
+            'broken': {'p50_ms': 50.0, 'p95_ms': 60.0},
+            'never_worked': {'error': 'no model'},
+        }
+        results = {
+            'fast': {'p50_ms': 14.0, 'p95_ms': 15.0},  # +40% but only 4 ms
+            'slow': {'p50_ms': 110.0, 'p95_ms': 200.0},
+            'broken': {'error': 'HTTP 500'},
+            'never_worked': {'error': 'no model'},
+        }
+
+        regressions = compare_to_baseline(results, baseline, threshold=0.25, min_ms=5)
+
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('slow: p95_ms'))
+        self.assertTrue(regressions[1].startswith('broken: failing'))
+
+if __name__ == '__main__':
+    unittest.main()
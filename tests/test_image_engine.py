@@ -0,0 +1,134 @@
+import unittest
+import os
+import shutil
+import subprocess
+import tempfile
+from unittest import mock
+from PIL import Image
+import image_engine
+from image_engine import (choose_engine, convert_in_process, pillow_quality, dct_scale, choose_renditions_engine,
+                          convert_renditions_in_process, run_in_process)
+from routes.image import build_image_command, build_renditions_command
+
+NO_PARAMS = {'width': None, 'height': None, 'quality': None, 'rotate': None, 'flip': None, 'grayscale': False}
+
+class ImageEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.test_image_path = 'tests/test.png'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def test_choose_engine(self):
+        """Test small images in Pillow formats are routed in process and everything else to ffmpeg."""
+        self.assertEqual(choose_engine(self.test_image_path, 'png', 'webp'), 'pillow')
+        self.assertEqual(choose_engine(self.test_image_path, 'png', 'avif'), 'ffmpeg')
+        with mock.patch.object(image_engine, 'IMAGE_ENGINE_MAX_BYTES', 10):
+            self.assertEqual(choose_engine(self.test_image_path, 'png', 'webp'), 'ffmpeg')
+        with mock.patch.object(image_engine, 'IMAGE_ENGINE_MAX_PIXELS', 100):
+            self.assertEqual(choose_engine(self.test_image_path, 'png', 'webp'), 'ffmpeg')
+        with mock.patch.object(image_engine, 'IMAGE_ENGINE', 'ffmpeg'):
+            self.assertEqual(choose_engine(self.test_image_path, 'png', 'webp'), 'ffmpeg')
+
+    def test_convert_all_modifications(self):
+        """Test scale, rotation, flip, grayscale and quality are applied in process."""
+        output = self.path('out.jpg')
+        convert_in_process(self.test_image_path, output, 'jpg',
+                           dict(NO_PARAMS, width=32, height=24, quality=5, rotate=90, flip='h', grayscale=True))
+
+        with Image.open(output) as image:
+            self.assertEqual(image.format, 'JPEG')
+            self.assertEqual(image.size, (24, 32))
+            self.assertEqual(image.mode, 'L')
+
+    def test_transforms_match_ffmpeg(self):
+        """Test rotations and flips turn the image the same way as the ffmpeg filter chain."""
+        source = self.path('source.png')
+        image = Image.new('RGB', (6, 4), 'black')
+        image.putpixel((0, 0), (255, 0, 0))
+        image.putpixel((5, 0), (0, 255, 0))
+        image.save(source)
+
+        for rotate, flip in [(90, None), (180, None), (270, None), (None, 'h'), (None, 'v'), (90, 'hv')]:
+            params = dict(NO_PARAMS, rotate=rotate, flip=flip)
+            convert_in_process(source, self.path('pillow.png'), 'png', params)
+            subprocess.run(build_image_command(source, self.path('ffmpeg.png'), params) + ['-y'],
+                           check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            with Image.open(self.path('pillow.png')) as pillow, Image.open(self.path('ffmpeg.png')) as ffmpeg:
+                self.assertEqual(pillow.convert('RGB').tobytes(), ffmpeg.convert('RGB').tobytes(),
+                                 f'rotate={rotate} flip={flip}')
+
+    def test_transparent_image_to_jpeg(self):
+        """Test the alpha channel is dropped for formats that cannot store it."""
+        source = self.path('alpha.png')
+        Image.new('RGBA', (8, 8), (255, 0, 0, 128)).save(source)
+
+        convert_in_process(source, self.path('out.jpg'), 'jpg', NO_PARAMS)
+        convert_in_process(source, self.path('out.webp'), 'webp', dict(NO_PARAMS, grayscale=True))
+
+        with Image.open(self.path('out.jpg')) as image:
+            self.assertEqual(image.mode, 'RGB')
+        with Image.open(self.path('out.webp')) as image:
+            self.assertIn('A', image.mode)
+
+    def test_pillow_quality(self):
+        """Test ffmpeg quality values map to Pillow qualities in reverse order."""
+        self.assertEqual(pillow_quality(1), 95)
+        self.assertEqual(pillow_quality(31), 1)
+        self.assertGreater(pillow_quality(5), pillow_quality(10))
+
+    def test_dct_scale(self):
+        """Test the largest DCT scale still covering the target size is picked."""
+        self.assertEqual(dct_scale(4000, 3000, 320, 240), 8)
+        self.assertEqual(dct_scale(4000, 3000, 1000, 750), 4)
+        self.assertEqual(dct_scale(4000, 3000, 1001, 750), 2)
+        self.assertEqual(dct_scale(4000, 3000, 4000, 3000), 1)
+
+    def test_renditions_from_draft_decode(self):
+        """Test a large JPEG is decoded at a reduced scale and every rendition gets its size and format."""
+        photo = self.path('photo.jpg')
+        subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', 'testsrc2=size=4000x3000',
+                        '-frames:v', '1', photo], check=True)
+        with mock.patch.object(image_engine, 'IMAGE_ENGINE_MAX_PIXELS', 1000 * 1000):
+            # too large to decode in full, small enough once decoded at 1/4
+            self.assertEqual(choose_renditions_engine(photo, 'jpg', ['webp'], 4000, 3000), 'ffmpeg')
+            self.assertEqual(choose_renditions_engine(photo, 'jpg', ['webp', 'png'], 800, 600), 'pillow')
+
+        decoded_sizes = []
+        load = Image.Image.load
+        def spy_load(image):
+            decoded_sizes.append(image.size)
+            return load(image)
+        outputs = [(self.path('small.webp'), 'webp', 320, 240, None), (self.path('large.jpg'), 'jpg', 800, 600, 5)]
+        with mock.patch.object(Image.Image, 'load', spy_load):
+            convert_renditions_in_process(photo, outputs)
+
+        self.assertEqual(decoded_sizes[0], (1000, 750))
+        with Image.open(self.path('small.webp')) as small, Image.open(self.path('large.jpg')) as large:
+            self.assertEqual((small.format, small.size), ('WEBP', (320, 240)))
+            self.assertEqual((large.format, large.size), ('JPEG', (800, 600)))
+
+    def test_job_falls_back_to_ffmpeg(self):
+        """Test the in-process job body replaces what a failed Pillow run wrote with the ffmpeg outputs, then removes its input."""
+        source = self.path('source.png')
+        shutil.copy(self.test_image_path, source)
+        outputs = [(self.path('small.png'), 'png', 16, 12, None), (self.path('large.jpg'), 'jpg', 32, 24, None)]
+
+        def fail(*args):
+            with open(outputs[0][0], 'wb') as f:
+                f.write(b'partial')
+            raise OSError('cannot identify image file')
+
+        run_in_process(fail, (), build_renditions_command(source, outputs), source, [output[0] for output in outputs])
+
+        with Image.open(outputs[0][0]) as small, Image.open(outputs[1][0]) as large:
+            self.assertEqual((small.format, small.size), ('PNG', (16, 12)))
+            self.assertEqual((large.format, large.size), ('JPEG', (32, 24)))
+        self.assertFalse(os.path.exists(source))
+
+if __name__ == '__main__':
+    unittest.main()
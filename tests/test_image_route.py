@@ -0,0 +1,318 @@
+import unittest
+from unittest import mock
+from io import BytesIO
+from app import app
+from routes.image import build_image_command
+import storage
+import subprocess
+from resources import run_ffmpeg
+from result_cache import get_result_cache
+import os
+import shutil
+import struct
+import time
+import zipfile
+
+class ImageConversionTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment."""
+        self.app = app.test_client()
+        self.app.testing = True
+
+        os.makedirs('uploads', exist_ok=True)
+        os.makedirs('outputs', exist_ok=True)
+
+        self.test_image_path = 'tests/test.png'
+
+    def tearDown(self):
+        """Clean up after each test."""
+        for folder in ['uploads', 'outputs']:
+            for file in os.listdir(folder):
+                file_path = os.path.join(folder, file)
+                if os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+                else:
+                    os.remove(file_path)
+
+    def convert(self, **form):
+        with open(self.test_image_path, 'rb') as f:
+            data = BytesIO(f.read())
+        form['file'] = (data, 'test.png')
+        return self.app.post('/image/convert_image', data=form, content_type='multipart/form-data')
+
+    def png_size(self, output_file):
+        """Read width and height from the PNG IHDR chunk."""
+        with open(storage.output_path(output_file), 'rb') as f:
+            header = f.read(24)
+        return struct.unpack('>II', header[16:24])
+
+    def test_convert_image_required(self):
+        """Test valid image conversion with required parameters."""
+        response = self.convert(output_format='jpg')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('File converted to jpg successfully', response.json['message'])
+        self.assertIn('output_file', response.json)
+
+    def test_convert_image_server_timing(self):
+        """Test the time spent in each stage is reported in a Server-Timing header."""
+        response = self.convert(output_format='webp')
+
+        self.assertEqual(response.status_code, 200)
+        stages = [metric.split(';')[0] for metric in response.headers['Server-Timing'].split(', ')]
+        self.assertIn('upload', stages)
+        self.assertIn('pillow', stages)
+
+    def test_convert_image_all_modifications(self):
+        """Test scale, rotation, flip and grayscale applied together in one pass."""
+        response = self.convert(output_format='png', width='32', height='24', rotate='90', flip='hv', grayscale='1')
+
+        self.assertEqual(response.status_code, 200)
+        # scale and rotation must both apply: 32x24 rotated by 90 degrees is 24x32
+        self.assertEqual(self.png_size(response.json['output_file']), (24, 32))
+        # only the output is left behind, no intermediate files
+        output_files = [name for _, _, names in os.walk('outputs') for name in names if not name.startswith('.')]
+        self.assertEqual(output_files, [response.json['output_file']])
+        self.assertEqual(os.listdir('uploads'), [])
+
+    def test_download_converted_image(self):
+        """Test the converted image can be downloaded under its original name."""
+        response = self.convert(output_format='jpg', quality='5')
+        download = self.app.get(f"/download/{response.json['output_file']}")
+
+        self.assertEqual(download.status_code, 200)
+        self.assertEqual(download.mimetype, 'image/jpeg')
+        self.assertIn('test.jpg', download.headers['Content-Disposition'])
+        download.close()
+
+    def test_download_ranges_and_etag(self):
+        """Test partial and conditional downloads: Range, If-None-Match and If-Range."""
+        output_file = self.convert(output_format='png').json['output_file']
+        full = self.app.get(f"/download/{output_file}")
+        body, etag = full.get_data(), full.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        self.assertEqual(full.headers['Accept-Ranges'], 'bytes')
+
+        partial = self.app.get(f"/download/{output_file}", headers={'Range': 'bytes=10-', 'If-Range': etag})
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(partial.get_data(), body[10:])
+        self.assertEqual(partial.headers['Content-Range'], f'bytes 10-{len(body) - 1}/{len(body)}')
+
+        stale = self.app.get(f"/download/{output_file}", headers={'Range': 'bytes=10-', 'If-Range': '"other"'})
+        self.assertEqual(stale.status_code, 200)
+        self.assertEqual(stale.get_data(), body)
+
+        not_modified = self.app.get(f"/download/{output_file}", headers={'If-None-Match': etag})
+        self.assertEqual(not_modified.status_code, 304)
+
+        # resuming a complete download asks for the range starting at the end of the file
+        out_of_range = self.app.get(f"/download/{output_file}", headers={'Range': f'bytes={len(body)}-'})
+        self.assertEqual(out_of_range.status_code, 416)
+        self.assertEqual(out_of_range.headers['Content-Range'], f'bytes */{len(body)}')
+        for response in [full, partial, stale, not_modified, out_of_range]:
+            response.close()
+
+    def test_download_offload(self):
+        """Test offloaded downloads only name the file for the proxy."""
+        output_file = self.convert(output_format='png').json['output_file']
+        with mock.patch('app.DOWNLOAD_OFFLOAD', 'x-accel'):
+            download = self.app.get(f"/download/{output_file}")
+        self.assertEqual(download.status_code, 200)
+        self.assertEqual(download.get_data(), b'')
+        self.assertEqual(download.headers['X-Accel-Redirect'], f'/protected-outputs/{output_file[:2]}/{output_file}')
+        self.assertIn('test.png', download.headers['Content-Disposition'])
+
+        with mock.patch('app.DOWNLOAD_OFFLOAD', 'x-sendfile'):
+            download = self.app.get(f"/download/{output_file}")
+        self.assertEqual(download.headers['X-Sendfile'], os.path.abspath(storage.output_path(output_file)))
+
+    def test_convert_image_invalid_flip(self):
+        """Test invalid flip direction is rejected before running ffmpeg."""
+        response = self.convert(output_format='png', flip='x')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(os.listdir('uploads'), [])
+
+    def test_convert_image_unsupported_output_format(self):
+        """Test output formats outside the supported image formats are rejected, single and batch."""
+        response = self.convert(output_format='exe')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(os.listdir('uploads'), [])
+
+        with open(self.test_image_path, 'rb') as f:
+            response = self.app.post('/image/convert_batch',
+                                     data={'files': [(BytesIO(f.read()), 'test.png')], 'output_format': 'exe'},
+                                     content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(os.listdir('uploads'), [])
+
+    def test_convert_image_cache_hit(self):
+        """Test converting the same content with the same parameters links to the first output under a new id."""
+        first = self.convert(output_format='png', rotate='270')
+        with open(self.test_image_path, 'rb') as f:
+            second = self.app.post('/image/convert_image', data={'file': (BytesIO(f.read()), 'renamed.png'), 'output_format': 'png',
+                                   'rotate': '270'}, content_type='multipart/form-data')
+        other = self.convert(output_format='png', rotate='90')
+
+        self.assertEqual(second.status_code, 200)
+        self.assertTrue(second.json.get('cached'))
+        self.assertNotEqual(first.json['output_file'], second.json['output_file'])
+        self.assertTrue(os.path.samefile(storage.output_path(first.json['output_file']), storage.output_path(second.json['output_file'])))
+        self.assertFalse(other.json.get('cached'))
+        # the first client still downloads under its own name
+        self.assertIn('test.png', self.app.get(f"/download/{first.json['output_file']}").headers['Content-Disposition'])
+        self.assertIn('renamed.png', self.app.get(f"/download/{second.json['output_file']}").headers['Content-Disposition'])
+        self.assertEqual(os.listdir('uploads'), [])
+
+    def test_cache_eviction_keeps_outputs(self):
+        """Test an output evicted from the result cache is no longer reused but still downloads until it expires."""
+        with mock.patch.object(get_result_cache(), 'max_bytes', 1):
+            first = self.convert(output_format='png', rotate='180')
+            self.convert(output_format='png', rotate='90')
+            again = self.convert(output_format='png', rotate='180')
+
+        self.assertFalse(again.json.get('cached'))
+        download = self.app.get(f"/download/{first.json['output_file']}")
+        self.assertEqual(download.status_code, 200)
+        download.close()
+
+    def test_convert_renditions(self):
+        """Test a rendition set returns a manifest of outputs with their sizes, never larger than the source."""
+        renditions = '[{"output_format": "webp", "width": 32}, {"output_format": "png", "width": 200}, {"output_format": "jpg", "width": 16, "height": 16}]'
+        with open(self.test_image_path, 'rb') as f:
+            response = self.app.post('/image/convert_renditions', data={'file': (BytesIO(f.read()), 'test.png'), 'renditions': renditions},
+                                     content_type='multipart/form-data')
+
+        self.assertEqual(response.status_code, 200)
+        manifest = response.json['renditions']
+        self.assertEqual([(entry['output_format'], entry['width'], entry['height']) for entry in manifest],
+                         [('webp', 32, 24), ('png', 64, 48), ('jpg', 16, 16)])
+        self.assertEqual(self.png_size(manifest[1]['output_file']), (64, 48))
+        for entry in manifest:
+            self.assertEqual(entry['size'], os.path.getsize(storage.output_path(entry['output_file'])))
+        self.assertEqual(os.listdir('uploads'), [])
+
+    def test_convert_renditions_ffmpeg_lowres(self):
+        """Test the ffmpeg path writes every rendition in one run, decoding a large JPEG at a reduced scale."""
+        photo = os.path.join('uploads', 'photo.jpg')
+        subprocess.run(['ffmpeg', '-loglevel', 'error', '-y', '-f', 'lavfi', '-i', 'testsrc2=size=2000x1500',
+                        '-frames:v', '1', photo], check=True)
+        with open(photo, 'rb') as f:
+            data = {'file': (BytesIO(f.read()), 'photo.jpg'),
+                    'renditions': '[{"output_format": "jpg", "width": 320}, {"output_format": "png", "width": 480}]'}
+        os.remove(photo)
+        with mock.patch('image_engine.IMAGE_ENGINE', 'ffmpeg'), \
+             mock.patch('routes.image.run_ffmpeg', wraps=run_ffmpeg) as spy:
+            response = self.app.post('/image/convert_renditions', data=data, content_type='multipart/form-data')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(spy.call_count, 1)
+        command = spy.call_args[0][0]
+        self.assertEqual(command[command.index('-lowres') + 1], '2')
+        manifest = response.json['renditions']
+        self.assertEqual(self.png_size(manifest[1]['output_file']), (480, 360))
+
+    def test_convert_renditions_failure_removes_outputs(self):
+        """Test a failed ffmpeg rendition run leaves none of its outputs behind."""
+        def fail_after_writing_outputs(command, **kwargs):
+            for arg in command:
+                if arg.startswith(storage.OUTPUT_FOLDER + os.sep):
+                    with open(arg, 'wb') as f:
+                        f.write(b'partial')
+            raise subprocess.CalledProcessError(1, command, stderr=b'Conversion failed')
+
+        renditions = '[{"output_format": "jpg", "width": 32}, {"output_format": "png", "width": 16}]'
+        with open(self.test_image_path, 'rb') as f:
+            data = {'file': (BytesIO(f.read()), 'test.png'), 'renditions': renditions}
+        with mock.patch('image_engine.IMAGE_ENGINE', 'ffmpeg'), \
+             mock.patch('routes.image.run_ffmpeg', side_effect=fail_after_writing_outputs):
+            response = self.app.post('/image/convert_renditions', data=data, content_type='multipart/form-data')
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual([name for _, _, names in os.walk('outputs') for name in names], [])
+
+    def test_convert_renditions_invalid(self):
+        """Test invalid rendition lists are rejected."""
+        for renditions in ['', '[]', '[{"output_format": "png"}]', '[{"output_format": "png", "width": 10, "quality": 50}]']:
+            with open(self.test_image_path, 'rb') as f:
+                data = {'file': (BytesIO(f.read()), 'test.png'), 'renditions': renditions}
+            response = self.app.post('/image/convert_renditions', data=data, content_type='multipart/form-data')
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(os.listdir('uploads'), [])
+
+    def test_convert_image_async_job(self):
+        """Test async conversion returns a job id and the job result points at the output."""
+        response = self.convert(output_format='png', flip='v', grayscale='1', **{'async': '1'})
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json['job_id']
+
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            job = self.app.get(f'/jobs/{job_id}').json
+            if job['status'] in ['done', 'failed']:
+                break
+            time.sleep(0.1)
+
+        self.assertEqual(job['status'], 'done')
+        result = self.app.get(f'/jobs/{job_id}/result')
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(os.path.exists(storage.output_path(result.json['output_file'])))
+        self.assertEqual(os.listdir('uploads'), [])
+
+    def test_convert_image_batch(self):
+        """Test a batch of images is converted and streamed back as one zip."""
+        with open(self.test_image_path, 'rb') as f:
+            image = f.read()
+        files = [(BytesIO(image), 'test.png'), (BytesIO(image), 'test.png'), (BytesIO(b'not an image'), 'broken.png')]
+        response = self.app.post('/image/convert_batch',
+                                 data={'files': files, 'output_format': 'jpg', 'grayscale': '1'},
+                                 content_type='multipart/form-data')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/zip')
+        archive = zipfile.ZipFile(BytesIO(response.data))
+        self.assertEqual(sorted(archive.namelist()), ['broken.error.txt', 'test.jpg', 'test_1.jpg'])
+        self.assertTrue(archive.read('test.jpg').startswith(b'\xff\xd8'))
+        self.assertEqual(os.listdir('uploads'), [])
+
+    def test_convert_image_batch_archive(self):
+        """Test a zip archive of images is accepted as batch input."""
+        upload = BytesIO()
+        with zipfile.ZipFile(upload, 'w') as archive:
+            archive.write(self.test_image_path, 'photos/a.png')
+            archive.writestr('notes.txt', 'skipped')
+        upload.seek(0)
+        response = self.app.post('/image/convert_batch',
+                                 data={'archive': (upload, 'photos.zip'), 'output_format': 'webp'},
+                                 content_type='multipart/form-data')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(zipfile.ZipFile(BytesIO(response.data)).namelist(), ['a.webp'])
+
+    def test_convert_image_batch_too_large(self):
+        """Test a batch over the file or byte limit is rejected and the files saved so far are removed."""
+        with open(self.test_image_path, 'rb') as f:
+            image = f.read()
+        upload = BytesIO()
+        with zipfile.ZipFile(upload, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('a.png', image)
+            archive.writestr('b.png', image)
+        for patched, limit in [('batch.BATCH_MAX_FILES', 1), ('batch.BATCH_MAX_BYTES', len(image) + 10)]:
+            with mock.patch(patched, limit):
+                response = self.app.post('/image/convert_batch',
+                                         data={'archive': (BytesIO(upload.getvalue()), 'photos.zip'), 'output_format': 'jpg'},
+                                         content_type='multipart/form-data')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(os.listdir('uploads'), [])
+
+    def test_build_image_command_single_filter_chain(self):
+        """Test all filters are composed into a single -vf argument."""
+        params = {'width': 10, 'height': 20, 'quality': 3, 'rotate': 180, 'flip': 'h', 'grayscale': True}
+        command = build_image_command('in.png', 'out.jpg', params)
+
+        self.assertEqual(command.count('-vf'), 1)
+        self.assertEqual(command[command.index('-vf') + 1], 'scale=10:20,transpose=2,transpose=2,hflip,format=gray')
+        self.assertEqual(command[-1], 'out.jpg')
+
+if __name__ == '__main__':
+    unittest.main()
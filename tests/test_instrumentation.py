@@ -0,0 +1,81 @@
+import unittest
+import os
+import tempfile
+from unittest import mock
+from app import app
+from storage import FileRegistry
+import instrumentation
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up metrics flushing to a registry in a temporary database."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.registry = FileRegistry(os.path.join(self.tmpdir.name, 'registry.db'))
+        patcher = mock.patch('storage.get_file_registry', return_value=self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """Clean up the temporary database."""
+        self.tmpdir.cleanup()
+
+    def test_flush_adds_to_registry_counters(self):
+        """Test metrics are kept in memory until flushed, and flushes of several processes add up."""
+        first, second = instrumentation.Metrics(flush_seconds=3600), instrumentation.Metrics(flush_seconds=3600)
+        first.inc('failures_total', kind='ffmpeg')
+        second.inc('failures_total', 2, kind='ffmpeg')
+        self.assertEqual(self.registry.get_counters(), {})
+
+        first.flush()
+        second.flush()
+        self.assertEqual(self.registry.get_counters(), {'formatconverter_failures_total{kind="ffmpeg"}': 3})
+
+    def test_render_prometheus(self):
+        """Test histograms render in bucket order with their sum and count, next to the storage counters."""
+        metrics = instrumentation.Metrics(flush_seconds=3600)
+        metrics.observe('stage_seconds', 0.3, stage='ffmpeg')
+        metrics.observe('stage_seconds', 20, stage='ffmpeg')
+        metrics.flush()
+        self.registry.set_counter('output_files', 4)
+        self.registry.bump_counter('reaper_evicted_bytes', 2097153)
+
+        lines = instrumentation.render_prometheus(self.registry.get_counters()).splitlines()
+        self.assertIn('# TYPE formatconverter_stage_seconds histogram', lines)
+        self.assertIn('# TYPE formatconverter_output_files gauge', lines)
+        self.assertIn('formatconverter_output_files 4', lines)
+        # monotonic storage counters are counters, every digit kept
+        self.assertIn('# TYPE formatconverter_reaper_evicted_bytes_total counter', lines)
+        self.assertIn('formatconverter_reaper_evicted_bytes_total 2097153', lines)
+        samples = [line for line in lines if line.startswith('formatconverter_stage_seconds')]
+        self.assertEqual(samples[0], 'formatconverter_stage_seconds_bucket{le="0.005",stage="ffmpeg"} 0')
+        self.assertIn('formatconverter_stage_seconds_bucket{le="0.5",stage="ffmpeg"} 1', samples)
+        self.assertEqual(samples[-3:], [
+            'formatconverter_stage_seconds_bucket{le="+Inf",stage="ffmpeg"} 2',
+            'formatconverter_stage_seconds_sum{stage="ffmpeg"} 20.3',
+            'formatconverter_stage_seconds_count{stage="ffmpeg"} 2',
+        ])
+
+    def test_metrics_endpoint(self):
+        """Test /metrics reports the requests handled so far, and requests get an id."""
+        client = app.test_client()
+        response = client.get('/cache/stats', headers={'X-Request-ID': 'abc123'})
+        self.assertEqual(response.headers['X-Request-ID'], 'abc123')
+
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn('formatconverter_requests_total{endpoint="cache_stats",status="200"} 1', response.get_data(as_text=True))
+
+    def test_streamed_stages_logged_after_body(self):
+        """Test stages that run while a body is streamed are logged with the request id once it is sent."""
+        client = app.test_client()
+        with self.assertLogs('instrumentation', level='INFO') as logs:
+            response = client.post('/transcribe/save_transcription', json={'text': 'Hello there.', 'format': 'pdf'},
+                                   headers={'X-Request-ID': 'stream123'})
+            self.assertNotIn('render', response.headers.get('Server-Timing', ''))
+            response.get_data()
+
+        streamed = [record for record in logs.records if getattr(record, 'streamed_timings', None)]
+        self.assertEqual(len(streamed), 1)
+        self.assertEqual(streamed[0].request_id, 'stream123')
+        self.assertIn('render', streamed[0].streamed_timings)
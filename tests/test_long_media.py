@@ -0,0 +1,123 @@
+import unittest
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from unittest import mock
+import long_media
+import resources
+from long_media import SilenceTracker, decode_audio, iter_audio_blocks, next_cut, merge_chunk_segments, strip_repeated_words
+
+class LongMediaTestCase(unittest.TestCase):
+    def test_next_cut_at_silences(self):
+        """Test chunks are cut at the silence closest to each target boundary, or hard cut without one."""
+        silences = [95, 290, 310, 640]
+        self.assertEqual(next_cut(0.0, silences, chunk_seconds=300), 290)
+        self.assertEqual(next_cut(290, silences, chunk_seconds=300), 640)
+        self.assertEqual(next_cut(640, silences, chunk_seconds=300), 940)
+
+    def test_strip_repeated_words(self):
+        """Test words repeated across a chunk seam are removed once."""
+        self.assertEqual(strip_repeated_words('we went to the', 'To the market today'), 'market today')
+        self.assertEqual(strip_repeated_words('hello there', 'general kenobi'), 'general kenobi')
+
+    def test_merge_chunk_segments(self):
+        """Test segments from overlapping chunks are merged in order without duplicates."""
+        first = [{'text': 'one two', 'start': 0, 'end': 4}, {'text': 'three four', 'start': 4, 'end': 10}]
+        second = [
+            {'text': 'four', 'start': 8, 'end': 9.5},  # inside the overlap, already transcribed
+            {'text': 'three four five', 'start': 9, 'end': 12},  # straddles the cut
+            {'text': 'six', 'start': 12, 'end': 14},
+        ]
+
+        merged = merge_chunk_segments([(0, first), (10, second)])
+
+        self.assertEqual([segment['text'] for segment in merged], ['one two', 'three four', 'five', 'six'])
+
+    def _write_tone(self, path, duration, silence):
+        # a tone with one silent stretch at silence=(start, end)
+        subprocess.run([
+            'ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+            '-af', f"volume='if(between(t,{silence[0]},{silence[1]}),0,1)':eval=frame", path,
+        ], check=True)
+
+    def test_track_silences_while_decoding(self):
+        """Test silences are found in audio decoded block by block and chunks decode to 16 kHz float32 buffers."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'tone.wav')
+            self._write_tone(path, 5, (2, 3))
+
+            tracker = SilenceTracker()
+            blocks = list(iter_audio_blocks(path, block_seconds=0.7))
+            for block in blocks:
+                tracker.feed(block)
+            silences = tracker.finish()
+            self.assertGreater(len(blocks), 5)
+            self.assertAlmostEqual(sum(len(block) for block in blocks), 80000, delta=400)
+            self.assertEqual(len(silences), 1)
+            self.assertAlmostEqual(silences[0], 2.5, delta=0.1)
+
+            audio = decode_audio(path, start=1, duration=2)
+            self.assertEqual(str(audio.dtype), 'float32')
+            self.assertAlmostEqual(len(audio), 32000, delta=400)
+
+    def test_iter_audio_blocks_timeout(self):
+        """Test a streamed decode holds a child slot and is killed once FFMPEG_TIMEOUT_SECONDS passes."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'tone.wav')
+            self._write_tone(path, 20, (2, 3))
+
+            with mock.patch('resources._children', threading.BoundedSemaphore(1)), \
+                 mock.patch('resources.FFMPEG_QUEUE_SECONDS', 0.1), \
+                 mock.patch('long_media.FFMPEG_TIMEOUT_SECONDS', 0.3):
+                blocks = iter_audio_blocks(path, block_seconds=0.5)
+                next(blocks)
+                with self.assertRaises(TimeoutError):
+                    with resources.child_slot():
+                        pass
+                time.sleep(0.5) # ffmpeg blocks on the full pipe until the deadline passes
+                with self.assertRaises(subprocess.TimeoutExpired):
+                    list(blocks)
+                with resources.child_slot():
+                    pass
+
+    def test_decode_audio_invalid_file(self):
+        """Test undecodable media raises a RuntimeError."""
+        with tempfile.NamedTemporaryFile(suffix='.wav') as f:
+            f.write(b'not audio')
+            f.flush()
+            with self.assertRaises(RuntimeError):
+                decode_audio(f.name)
+
+    def test_transcribe_long_media_submits_decoded_chunks(self):
+        """Test long media is cut at silences while decoding and every chunk is transcribed from memory."""
+        submitted = []
+
+        def fake_submit(job_class, fn, audio, offset, language):
+            submitted.append((offset, len(audio)))
+            future = Future()
+            future.set_result([{'text': f'chunk at {offset:.1f}', 'start': offset, 'end': offset + len(audio) / 16000}])
+            return future
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'tone.wav')
+            self._write_tone(path, 100, (40, 42))
+            with mock.patch.object(long_media, 'CHUNK_SECONDS', 40), \
+                 mock.patch.object(long_media, 'CHUNK_OVERLAP_SECONDS', 1), \
+                 mock.patch.object(long_media, 'DECODE_BLOCK_SECONDS', 5), \
+                 mock.patch.object(long_media, 'submit_task', side_effect=fake_submit):
+                segments = long_media.transcribe_long_media(path)
+
+        # cut at the silence around 41s, then a hard cut at 81s
+        self.assertEqual(len(submitted), 3)
+        self.assertEqual(submitted[0][0], 0.0)
+        self.assertAlmostEqual(submitted[0][1] / 16000, 41, delta=0.1)
+        self.assertAlmostEqual(submitted[1][0], 40, delta=0.1)
+        self.assertAlmostEqual(submitted[2][0], 80, delta=0.1)
+        self.assertAlmostEqual(sum(length for _, length in submitted) / 16000, 102, delta=0.2)
+        self.assertEqual(len(segments), 3)
+
+if __name__ == '__main__':
+    unittest.main()
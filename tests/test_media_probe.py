@@ -0,0 +1,62 @@
+import unittest
+import os
+import subprocess
+import tempfile
+import threading
+from unittest import mock
+from media_probe import audio_stream, video_stream, can_stream_copy, probe_media
+
+class MediaProbeTestCase(unittest.TestCase):
+    def test_probe_media(self):
+        """Test the streams of a media file are probed without decoding it."""
+        info = probe_media('tests/test.mp3')
+
+        self.assertAlmostEqual(info['duration'], 47.8, delta=0.1)
+        self.assertEqual(audio_stream(info), {'type': 'audio', 'codec': 'mp3', 'sample_rate': 44100, 'channels': 2,
+                                              'width': None, 'height': None})
+        image = video_stream(probe_media('tests/test.png'))
+        self.assertEqual((image['codec'], image['width'], image['height']), ('png', 64, 48))
+
+    def test_probe_invalid_media(self):
+        """Test files that are not media, or have no audio, raise a ValueError."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'bad.mp3')
+            with open(path, 'wb') as f:
+                f.write(b'not audio at all')
+            with self.assertRaises(ValueError):
+                probe_media(path)
+
+            with self.assertRaises(ValueError):
+                audio_stream(probe_media('tests/test.png'))
+
+    def test_probe_in_child_slot(self):
+        """Test probing waits for a child slot and is killed after the ffmpeg timeout."""
+        children = threading.BoundedSemaphore(1)
+        with mock.patch('resources._children', children), mock.patch('resources.FFMPEG_QUEUE_SECONDS', 0.1):
+            children.acquire()
+            with self.assertRaises(TimeoutError):
+                probe_media('tests/test.mp3')
+            children.release()
+            with mock.patch('media_probe.FFMPEG_TIMEOUT_SECONDS', 0.0001), self.assertRaises(ValueError):
+                probe_media('tests/test.mp3')
+            self.assertTrue(children.acquire(blocking=False))
+
+    def test_can_stream_copy(self):
+        """Test only container changes keeping codec, sample rate and channels are remuxed."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'opus.webm')
+            subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', 'sine=duration=1',
+                            '-c:a', 'libopus', path], check=True)
+            info = probe_media(path)
+
+        params = {'codec': None, 'bitrate': None, 'sample_rate': None, 'channels': None, 'volume': None}
+        self.assertTrue(can_stream_copy(info, 'ogg', params))
+        self.assertTrue(can_stream_copy(info, 'opus', dict(params, codec='libopus', sample_rate='48000', channels='1')))
+        self.assertFalse(can_stream_copy(info, 'mp3', params))
+        self.assertFalse(can_stream_copy(info, 'ogg', dict(params, codec='libvorbis')))
+        self.assertFalse(can_stream_copy(info, 'ogg', dict(params, channels='2')))
+        self.assertFalse(can_stream_copy(info, 'ogg', dict(params, bitrate='64k')))
+        self.assertFalse(can_stream_copy(info, 'ogg', dict(params, volume='1.5')))
+
+if __name__ == '__main__':
+    unittest.main()
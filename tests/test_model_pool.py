@@ -0,0 +1,97 @@
+import unittest
+import threading
+from model_pool import ModelPool
+
+class StubModel:
+    """Stand-in for a Whisper model, numbered in load order."""
+    def __init__(self, number):
+        self.number = number
+
+class StubModelPool(ModelPool):
+    """Model pool loading stub models instead of Whisper, optionally failing the next load."""
+    def __init__(self, size):
+        super().__init__(model_name='stub', size=size, n_threads=1)
+        self.loads = 0
+        self.fail_next_load = False
+
+    def _load_model(self):
+        if self.fail_next_load:
+            self.fail_next_load = False
+            raise RuntimeError('model file missing')
+        self.loads += 1
+        return StubModel(self.loads)
+
+class ModelPoolTestCase(unittest.TestCase):
+    def test_models_are_created_up_to_pool_size(self):
+        """Test models are loaded lazily, never more than the pool size, and reused once returned."""
+        pool = StubModelPool(size=2)
+        self.assertEqual(pool.stats()['loaded'], 0)
+
+        with pool.checkout() as first, pool.checkout() as second:
+            self.assertNotEqual(first.number, second.number)
+            self.assertEqual(pool.stats()['idle'], 0)
+        with pool.checkout() as third:
+            self.assertIn(third.number, [first.number, second.number])
+
+        self.assertEqual(pool.loads, 2)
+        self.assertEqual(pool.stats(), {'model': 'stub', 'size': 2, 'loaded': 2, 'idle': 2})
+
+    def test_preload_fills_the_pool(self):
+        """Test preload loads every model up front and checkouts then load nothing more."""
+        pool = StubModelPool(size=3)
+        pool.preload()
+        pool.preload()
+        with pool.checkout():
+            pass
+        self.assertEqual(pool.loads, 3)
+        self.assertEqual(pool.stats()['idle'], 3)
+
+    def test_checkout_blocks_while_all_models_are_busy(self):
+        """Test a checkout waits for a busy model to come back, or times out."""
+        pool = StubModelPool(size=1)
+        checked_out = threading.Event()
+        checked_out_models = []
+
+        def wait_for_model():
+            with pool.checkout() as model:
+                checked_out_models.append(model)
+                checked_out.set()
+
+        with pool.checkout() as model:
+            with self.assertRaises(RuntimeError):
+                with pool.checkout(timeout=0.05):
+                    pass
+            thread = threading.Thread(target=wait_for_model)
+            thread.start()
+            self.assertFalse(checked_out.wait(0.1))
+        self.assertTrue(checked_out.wait(5))
+        thread.join(5)
+
+        self.assertEqual(checked_out_models, [model])
+        self.assertEqual(pool.loads, 1)
+
+    def test_model_is_returned_after_an_exception(self):
+        """Test a model goes back to the pool when the with block raises."""
+        pool = StubModelPool(size=1)
+        with self.assertRaises(ValueError):
+            with pool.checkout() as model:
+                raise ValueError('transcription failed')
+
+        self.assertEqual(pool.stats()['idle'], 1)
+        with pool.checkout(timeout=0.05) as again:
+            self.assertIs(again, model)
+
+    def test_failed_load_frees_its_place(self):
+        """Test a model that fails to load does not count toward the pool size."""
+        pool = StubModelPool(size=1)
+        pool.fail_next_load = True
+        with self.assertRaises(RuntimeError):
+            with pool.checkout():
+                pass
+
+        with pool.checkout(timeout=0.05) as model:
+            self.assertEqual(model.number, 1)
+        self.assertEqual(pool.stats()['loaded'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
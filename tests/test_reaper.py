@@ -0,0 +1,103 @@
+import unittest
+import os
+import tempfile
+import time
+from unittest import mock
+import reaper
+import storage
+from storage import FileRegistry
+
+class OutputReaperTestCase(unittest.TestCase):
+    def setUp(self):
+        """Run every test in an empty working directory with its own registry."""
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        os.makedirs('uploads')
+        os.makedirs('outputs')
+        self.registry = FileRegistry('registry.db')
+
+    def tearDown(self):
+        """Go back to the repository and drop the temporary directory."""
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def make_output(self, output_id, size, age, register=True, ttl=3600):
+        path = storage.output_path(output_id, create=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        if register:
+            self.registry.register(output_id, output_id, size=size, ttl=ttl)
+        return path
+
+    def test_output_path_is_sharded(self):
+        """Test outputs are placed in a subdirectory named after the start of their id."""
+        self.assertEqual(storage.output_path('abcdef.mp3'), os.path.join('outputs', 'ab', 'abcdef.mp3'))
+
+    def test_sweep_expires_outputs(self):
+        """Test outputs whose registry entry expired are deleted."""
+        expired = self.make_output('aa01.mp3', 10, age=7200, ttl=-1)
+        kept = self.make_output('bb01.mp3', 10, age=7200)
+
+        result = reaper.sweep(self.registry, budget_bytes=10 ** 9)
+
+        self.assertEqual(result['expired_files'], 1)
+        self.assertFalse(os.path.exists(expired))
+        self.assertTrue(os.path.exists(kept))
+        self.assertEqual(self.registry.get_counters()['output_files'], 1)
+
+    def test_sweep_enforces_budget(self):
+        """Test the budget is enforced evicting unreferenced outputs first, then the oldest ones."""
+        orphan = self.make_output('cc01.png', 100, age=3600, register=False)
+        oldest = self.make_output('dd01.png', 100, age=7200)
+        newer = self.make_output('ee01.png', 100, age=5400)
+        in_progress = self.make_output('ff01.png', 100, age=0, register=False)
+
+        result = reaper.sweep(self.registry, budget_bytes=200)
+
+        self.assertEqual(result['evicted_files'], 2)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertFalse(os.path.exists(oldest))
+        self.assertIsNone(self.registry.lookup('dd01.png'))
+        self.assertTrue(os.path.exists(newer))
+        self.assertTrue(os.path.exists(in_progress))
+        self.assertEqual(self.registry.get_counters()['reaper_evicted_bytes'], 200)
+
+    def test_sweep_removes_stale_uploads(self):
+        """Test uploads left behind by failed requests are removed."""
+        stale = os.path.join('uploads', 'stale.mp3')
+        open(stale, 'wb').close()
+        old = time.time() - reaper.UPLOAD_TTL_SECONDS - 1
+        os.utime(stale, (old, old))
+
+        reaper.sweep(self.registry)
+
+        self.assertFalse(os.path.exists(stale))
+
+    def test_sweep_keeps_inputs_of_pending_jobs(self):
+        """Test uploads still waiting for a queued job are kept past the TTL, and claimed chunked uploads are not forgotten."""
+        old = time.time() - reaper.UPLOAD_TTL_SECONDS - 1
+        queued, finished = os.path.join('uploads', 'queued.mp3'), os.path.join('uploads', 'finished.mp3')
+        for path in [queued, finished]:
+            open(path, 'wb').close()
+            os.utime(path, (old, old))
+        self.registry.save_job('job1', 'long', 'queued')
+        self.registry.save_job_inputs('job1', [queued])
+        self.registry.save_job('job2', 'short', 'done')
+        self.registry.save_job_inputs('job2', [finished])
+        with mock.patch('storage.time.time', return_value=old):
+            self.registry.create_upload('up2', 'song.mp3', 10)
+            self.registry.create_upload('up3', 'song.mp3', 10)
+        self.registry.touch_upload('up2')
+
+        reaper.sweep(self.registry)
+
+        self.assertTrue(os.path.exists(queued))
+        self.assertFalse(os.path.exists(finished))
+        self.assertIsNotNone(self.registry.get_upload('up2'))
+        self.assertIsNone(self.registry.get_upload('up3'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from unittest import mock
+import storage
+import resources
+from resources import ResourceGovernor, with_threads, requested_threads, run_ffmpeg
+
+class ResourceGovernorTestCase(unittest.TestCase):
+    def setUp(self):
+        """Point the shared registry at a temporary database."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.registry_path = storage.FILE_REGISTRY_PATH
+        storage.FILE_REGISTRY_PATH = os.path.join(self.tmpdir.name, 'registry.db')
+        self.governor = ResourceGovernor(cores=4, overcommit=1.0, min_threads=1)
+
+    def tearDown(self):
+        """Restore the shared registry."""
+        storage.FILE_REGISTRY_PATH = self.registry_path
+        self.tmpdir.cleanup()
+
+    def test_allocations_share_the_budget(self):
+        """Test thread counts shrink as the budget is used up and grow back on release."""
+        first_id, first = self.governor.acquire('whisper', 3)
+        second_id, second = self.governor.acquire('ffmpeg', 4)
+        third_id, third = self.governor.acquire('ffmpeg', 4)
+
+        self.assertEqual((first, second, third), (3, 1, 1))
+        self.assertEqual(self.governor.stats()['in_use_by_kind'], {'whisper': 3, 'ffmpeg': 2})
+
+        for allocation_id in [first_id, second_id, third_id]:
+            self.governor.release(allocation_id)
+        with self.governor.allocate('ffmpeg', 4) as threads:
+            self.assertEqual(threads, 4)
+        self.assertEqual(self.governor.stats()['in_use'], 0)
+
+    def test_overcommit(self):
+        """Test the overcommit factor scales the budget."""
+        self.assertEqual(ResourceGovernor(cores=4, overcommit=1.5).budget, 6)
+
+    def test_with_threads(self):
+        """Test the -threads value of an ffmpeg command is replaced without touching the original."""
+        command = ["ffmpeg", "-i", "in.mp3", "-threads", "4", "out.wav"]
+
+        self.assertEqual(requested_threads(command), 4)
+        self.assertEqual(with_threads(command, 2), ["ffmpeg", "-i", "in.mp3", "-threads", "2", "out.wav"])
+        self.assertEqual(command[4], "4")
+
+class RunFfmpegTestCase(unittest.TestCase):
+    def setUp(self):
+        """Point the shared registry at a temporary database."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.registry_path = storage.FILE_REGISTRY_PATH
+        storage.FILE_REGISTRY_PATH = os.path.join(self.tmpdir.name, 'registry.db')
+        # reads its input in real time, so it runs until killed
+        self.command = ["ffmpeg", "-re", "-f", "lavfi", "-i", "sine", "-threads", "1", "-f", "null", "-"]
+
+    def tearDown(self):
+        """Restore the shared registry."""
+        storage.FILE_REGISTRY_PATH = self.registry_path
+        self.tmpdir.cleanup()
+
+    def test_timeout_kills_ffmpeg(self):
+        """Test a runaway ffmpeg is killed once the timeout is reached."""
+        start = time.monotonic()
+        with mock.patch('resources.FFMPEG_TIMEOUT_SECONDS', 0.5):
+            with self.assertRaises(subprocess.TimeoutExpired):
+                run_ffmpeg(self.command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(ResourceGovernor().stats()['in_use'], 0)
+
+    def test_child_cap(self):
+        """Test runs beyond the child cap wait for a slot, and give up after the queue timeout."""
+        with mock.patch('resources._children', threading.BoundedSemaphore(1)), \
+             mock.patch('resources.FFMPEG_QUEUE_SECONDS', 0.2):
+            with resources.child_slot():
+                with self.assertRaises(TimeoutError):
+                    run_ffmpeg(self.command, timeout=1)
+            result = run_ffmpeg(["ffmpeg", "-f", "lavfi", "-i", "sine=duration=0.1", "-f", "null", "-"],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(result.returncode, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+import os
+import tempfile
+import threading
+import time
+from storage import FileRegistry
+
+class FileRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up a registry in a temporary database."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'registry.db')
+        self.registry = FileRegistry(self.path)
+
+    def tearDown(self):
+        """Clean up the temporary database."""
+        self.tmpdir.cleanup()
+
+    def test_register_and_lookup(self):
+        """Test a registered output can be looked up with its metadata."""
+        self.registry.register('abc.mp3', 'song.mp3', size=42)
+        entry = self.registry.lookup('abc.mp3')
+
+        self.assertEqual(entry['original_name'], 'song.mp3')
+        self.assertEqual(entry['size'], 42)
+        self.assertEqual(entry['content_type'], 'audio/mpeg')
+        self.assertIsNone(self.registry.lookup('missing.mp3'))
+
+    def test_shared_between_threads_and_instances(self):
+        """Test entries written by one thread are visible to other threads and registry instances."""
+        thread = threading.Thread(target=self.registry.register, args=('abc.png', 'picture.png'))
+        thread.start()
+        thread.join()
+
+        self.assertEqual(self.registry.lookup('abc.png')['original_name'], 'picture.png')
+        self.assertEqual(FileRegistry(self.path).lookup('abc.png')['original_name'], 'picture.png')
+
+    def test_expire(self):
+        """Test expired entries are hidden from lookups and removed in batches."""
+        self.registry.register('old.wav', 'old.wav', ttl=-1)
+        self.registry.register('new.wav', 'new.wav')
+
+        self.assertIsNone(self.registry.lookup('old.wav'))
+        self.assertEqual(self.registry.expire(), ['old.wav'])
+        self.assertEqual(self.registry.expire(), [])
+        self.assertEqual(self.registry.expire(now=time.time() + 10 ** 9), ['new.wav'])
+
+    def test_jobs(self):
+        """Test job statuses round trip through the registry."""
+        self.registry.save_job('job1', 'short', 'queued')
+        self.registry.save_job('job1', 'short', 'done', result={'output_file': 'x.png'})
+        job = self.registry.get_job('job1')
+
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['result'], {'output_file': 'x.png'})
+        self.registry.prune_jobs(time.time() + 1)
+        self.assertIsNone(self.registry.get_job('job1'))
+
+    def test_result_cache_budget_is_shared(self):
+        """Test result cache entries put by several registry instances share one byte budget, least recently used evicted first."""
+        other = FileRegistry(self.path)
+        self.assertEqual(self.registry.put_cached_output('a', 'a.mp3', 40, 100), [])
+        self.assertEqual(other.put_cached_output('b', 'b.mp3', 40, 100), [])
+        self.assertEqual(other.get_cached_output('a'), 'a.mp3')
+
+        self.assertEqual(self.registry.put_cached_output('c', 'c.mp3', 40, 100), ['b.mp3'])
+        self.assertIsNone(other.get_cached_output('b'))
+        self.assertEqual(other.result_cache_usage(), (2, 80))
+
+        self.registry.remove('a.mp3')
+        self.assertIsNone(other.get_cached_output('a'))
+
+    def test_transcripts(self):
+        """Test transcripts and their translations round trip, and unused transcripts are pruned with them."""
+        segments = [{'text': 'Hello.', 'start': 0.0, 'end': 1.0}]
+        self.registry.save_transcript('t1', 'digest', 'base', 'en', segments)
+        self.registry.save_transcript_translation('t1', 'fr', 'Bonjour.')
+
+        self.assertEqual(self.registry.get_transcript('t1')['segments'], segments)
+        self.assertEqual(self.registry.get_transcript_translation('t1', 'fr'), 'Bonjour.')
+        self.assertIsNone(self.registry.get_transcript_translation('t1', 'de'))
+        self.registry.prune_transcripts(time.time() + 1)
+        self.assertIsNone(self.registry.get_transcript('t1'))
+        self.assertIsNone(self.registry.get_transcript_translation('t1', 'fr'))
+
+if __name__ == '__main__':
+    unittest.main()
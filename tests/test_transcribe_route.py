@@ -0,0 +1,172 @@
+import unittest
+from io import BytesIO
+from unittest import mock
+from app import app
+from storage import FileRegistry
+import json
+import os
+import tempfile
+
+def fake_transcribe_segments(audio, language=None, on_segment=None, should_abort=None):
+    """Stand-in for Whisper producing two segments."""
+    segments = [{'text': 'Hello there.', 'start': 0.0, 'end': 1.5}, {'text': 'General Kenobi.', 'start': 1.5, 'end': 3.0}]
+    for segment in segments:
+        if on_segment:
+            on_segment(segment)
+    return segments
+
+def parse_events(body):
+    events = []
+    for block in body.decode().split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in block.splitlines() if line and not line.startswith(':'))
+        if lines:
+            events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+class TranscriptionStreamTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment."""
+        self.app = app.test_client()
+        self.app.testing = True
+        os.makedirs('uploads', exist_ok=True)
+        self.test_audio_path = 'tests/test.mp3'
+
+    def post(self, url, **form):
+        with open(self.test_audio_path, 'rb') as f:
+            form['file'] = (BytesIO(f.read()), 'test.mp3')
+        return self.app.post(url, data=form, content_type='multipart/form-data')
+
+    @mock.patch('routes.transcribe.transcribe_segments', side_effect=fake_transcribe_segments)
+    def test_stream_audio_segments(self, _):
+        """Test every segment is sent as its own event, followed by a done event."""
+        response = self.post('/transcribe/stream_audio', input_language='en', output_language='en')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual(parse_events(response.data), [
+            ('segment', {'text': 'Hello there.', 'start': 0.0, 'end': 1.5}),
+            ('segment', {'text': 'General Kenobi.', 'start': 1.5, 'end': 3.0}),
+            ('done', {}),
+        ])
+        self.assertEqual(os.listdir('uploads'), [])
+
+    @mock.patch('routes.transcribe.translate_text', side_effect=lambda text, from_code, to_code: text.upper())
+    @mock.patch('routes.transcribe.transcribe_segments', side_effect=fake_transcribe_segments)
+    def test_stream_audio_translates_segments(self, _, translate):
+        """Test segments are translated one by one when another output language is requested."""
+        response = self.post('/transcribe/stream_audio', input_language='en', output_language='fr')
+
+        texts = [data['text'] for event, data in parse_events(response.data) if event == 'segment']
+        self.assertEqual(texts, ['HELLO THERE.', 'GENERAL KENOBI.'])
+        translate.assert_called_with('General Kenobi.', 'en', 'fr')
+
+    @mock.patch('routes.transcribe.transcribe_segments', side_effect=RuntimeError('model unavailable'))
+    def test_stream_audio_error(self, _):
+        """Test a failing transcription ends the stream with an error event."""
+        response = self.post('/transcribe/stream_audio', input_language='en', output_language='en')
+
+        self.assertEqual(parse_events(response.data), [('error', {'error': 'Failed to transcribe: model unavailable'})])
+
+    def test_stream_audio_invalid_language(self):
+        """Test unsupported languages are rejected before streaming starts."""
+        response = self.post('/transcribe/stream_audio', input_language='xx')
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_save_transcription_streams_file(self):
+        """Test saved transcriptions are streamed back as attachments in every format."""
+        for save_format, mimetype in [('txt', 'text/plain'), ('json', 'application/json'), ('pdf', 'application/pdf'),
+                                      ('docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document')]:
+            response = self.app.post('/transcribe/save_transcription', json={'text': 'Hello there.\nGeneral Kenobi.', 'format': save_format})
+
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_streamed)
+            self.assertTrue(response.mimetype.startswith(mimetype))
+            self.assertIn(f'filename="transcription.{save_format}"', response.headers['Content-Disposition'])
+            self.assertTrue(response.data)
+
+    def test_save_transcription_invalid_format(self):
+        """Test unsupported save formats are rejected."""
+        response = self.app.post('/transcribe/save_transcription', json={'text': 'Hello', 'format': 'odt'})
+
+        self.assertEqual(response.status_code, 400)
+
+class TranscriptStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment with transcripts stored in a temporary database."""
+        self.app = app.test_client()
+        self.app.testing = True
+        os.makedirs('uploads', exist_ok=True)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.registry = FileRegistry(os.path.join(self.tmpdir.name, 'registry.db'))
+        patcher = mock.patch('storage.get_file_registry', return_value=self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """Clean up the temporary database."""
+        self.tmpdir.cleanup()
+
+    def post(self, **form):
+        with open('tests/test.mp3', 'rb') as f:
+            form['file'] = (BytesIO(f.read()), 'test.mp3')
+        return self.app.post('/transcribe/transcribe_audio', data=form, content_type='multipart/form-data')
+
+    @mock.patch('routes.transcribe.translate_text', side_effect=lambda text, from_code, to_code: f'[{to_code}] {text}')
+    @mock.patch('routes.transcribe.transcribe_segments', side_effect=fake_transcribe_segments)
+    def test_same_media_is_transcribed_once(self, transcribe, translate):
+        """Test the same media is served from the store, and each translation is computed once."""
+        first = self.post(input_language='en', output_language='en')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json['transcribed_text'], 'Hello there. General Kenobi.')
+
+        for _ in range(2):
+            response = self.post(input_language='en', output_language='fr')
+            self.assertEqual(response.json['transcript_id'], first.json['transcript_id'])
+            self.assertEqual(response.json['transcribed_text'], '[fr] Hello there. General Kenobi.')
+        self.assertEqual(transcribe.call_count, 1)
+        self.assertEqual(translate.call_count, 1)
+        self.assertEqual(os.listdir('uploads'), [])
+
+        # another input language is another transcript
+        self.post(input_language='de', output_language='de')
+        self.assertEqual(transcribe.call_count, 2)
+
+    @mock.patch('transcript_store.TRANSCRIPT_STORE', False)
+    @mock.patch('routes.transcribe.TRANSCRIPT_STORE', False)
+    @mock.patch('routes.transcribe.translate_text', side_effect=lambda text, from_code, to_code: f'[{to_code}] {text}')
+    @mock.patch('routes.transcribe.transcribe_segments', side_effect=fake_transcribe_segments)
+    def test_store_disabled(self, transcribe, translate):
+        """Test every request is transcribed and translated again without the store, under the same transcript id."""
+        first = self.post(input_language='en', output_language='fr')
+        second = self.post(input_language='en', output_language='fr')
+        self.assertEqual(second.json['transcript_id'], first.json['transcript_id'])
+        self.assertEqual(second.json['transcribed_text'], '[fr] Hello there. General Kenobi.')
+        self.assertEqual(transcribe.call_count, 2)
+        self.assertEqual(translate.call_count, 2)
+
+        response = self.app.get(f"/transcribe/transcripts/{first.json['transcript_id']}")
+        self.assertEqual(response.status_code, 200)
+
+    @mock.patch('routes.transcribe.translate_text', side_effect=lambda text, from_code, to_code: f'[{to_code}] {text}')
+    @mock.patch('routes.transcribe.transcribe_segments', side_effect=fake_transcribe_segments)
+    def test_render_stored_transcript(self, transcribe, translate):
+        """Test a stored transcript is rendered in other formats and languages without posting the text back."""
+        stored_id = self.post(input_language='en', output_language='en').json['transcript_id']
+
+        response = self.app.post('/transcribe/save_transcription', json={'transcript_id': stored_id, 'format': 'txt', 'language': 'es'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Transcript-ID'], stored_id)
+        # one paragraph per segment
+        self.assertEqual(response.get_data(as_text=True), '[es] Hello there.\nGeneral Kenobi.')
+
+        response = self.app.get(f'/transcribe/transcripts/{stored_id}?language=es')
+        self.assertEqual(response.json['segments'][1], {'text': 'General Kenobi.', 'start': 1.5, 'end': 3.0})
+        self.assertEqual(response.json['transcribed_text'], '[es] Hello there. General Kenobi.')
+        self.assertEqual(translate.call_count, 1)
+
+        response = self.app.post('/transcribe/save_transcription', json={'transcript_id': 'missing', 'format': 'txt'})
+        self.assertEqual(response.status_code, 404)
+
+if __name__ == '__main__':
+    unittest.main()
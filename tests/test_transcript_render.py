@@ -0,0 +1,111 @@
+import unittest
+import json
+import os
+import re
+import zipfile
+from io import BytesIO
+from unittest import mock
+from xml.etree import ElementTree
+import reportlab
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from transcript_render import GlyphMetrics, render_transcript, wrap_paragraph
+
+# fonts shipped with reportlab: a Khmer test font, and Vera
+REPORTLAB_FONTS = os.path.join(os.path.dirname(reportlab.__file__), 'fonts')
+
+WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+PARAGRAPHS = ['Hello (there) \\ café', 'word ' * 5000, '', 'General "Kenobi" <3 & more']
+
+def render(save_format, paragraphs=PARAGRAPHS):
+    chunks, _, _ = render_transcript(paragraphs, save_format)
+    return b''.join(chunks)
+
+def xref_offsets(data):
+    xref_position = int(re.search(rb'startxref\n(\d+)', data).group(1))
+    xref = data[xref_position:].split(b'trailer')[0].splitlines()
+    return [int(entry.split()[0]) for entry in xref[3:]]
+
+class TranscriptRenderTestCase(unittest.TestCase):
+    def test_glyph_metrics(self):
+        """Test cached glyph widths add up to the width reportlab measures."""
+        metrics = GlyphMetrics()
+        self.assertAlmostEqual(metrics.width('Hello, World!'), stringWidth('Hello, World!', 'Helvetica', 12))
+
+    def test_wrap_paragraph(self):
+        """Test lines are filled greedily and never exceed the width, words wider than a line are broken."""
+        metrics = GlyphMetrics()
+        lines = list(wrap_paragraph('lorem ipsum dolor sit amet ' * 200, 300, metrics))
+
+        self.assertEqual(' '.join(lines).split(), ('lorem ipsum dolor sit amet ' * 200).split())
+        for line, next_line in zip(lines, lines[1:]):
+            self.assertLessEqual(metrics.width(line), 300)
+            self.assertGreater(metrics.width(line + ' ' + next_line.split()[0]), 300)
+        self.assertEqual(list(wrap_paragraph('', 300, metrics)), [''])
+        lines = list(wrap_paragraph('x' * 200, 300, metrics))
+        self.assertEqual(''.join(lines), 'x' * 200)
+        self.assertGreater(len(lines), 1)
+        self.assertTrue(all(metrics.width(line) <= 300 for line in lines))
+
+    def test_render_txt_and_json(self):
+        """Test text formats hold every paragraph, one per line."""
+        text = '\n'.join(PARAGRAPHS)
+        self.assertEqual(render('txt').decode('utf-8'), text)
+        self.assertEqual(json.loads(render('json')), {'transcribed_text': text})
+
+    def test_render_pdf(self):
+        """Test the streamed PDF has every page and a cross-reference table pointing at its objects."""
+        data = render('pdf')
+
+        self.assertTrue(data.startswith(b'%PDF-1.4'))
+        self.assertTrue(data.endswith(b'%%EOF\n'))
+        self.assertIn(b'(Hello \\(there\\) \\\\ caf\xe9) Tj', data)
+        pages = re.search(rb'/Type /Pages /Kids \[[^\]]*\] /Count (\d+)', data)
+        self.assertGreater(int(pages.group(1)), 1)
+
+        for object_id, offset in enumerate(xref_offsets(data), start=1):
+            self.assertTrue(data[offset:].startswith(b'%d 0 obj' % object_id))
+
+    def test_render_pdf_non_latin(self):
+        """Test text WinAnsi cannot encode is written in the first embedded font having its glyphs."""
+        fonts = [os.path.join(REPORTLAB_FONTS, 'hb-test.ttf'), os.path.join(REPORTLAB_FONTS, 'Vera.ttf')]
+        with mock.patch('transcript_render.PDF_UNICODE_FONTS', fonts):
+            data = render('pdf', ['Hello \u1786\u17d2\u1793\u17b6\u17c6 \u0141\u00f3d\u017a \u4f60'])
+
+        # Khmer in the Khmer font, Polish in Helvetica and Vera, characters no font has replaced
+        self.assertIn(b'(Hello ) Tj\n/F2_0 12 Tf\n(\\001\\002\\003\\004\\005) Tj\n/F1 12 Tf\n( ) Tj\n/F3_0 12 Tf\n(\\001) Tj\n'
+                      b'/F1 12 Tf\n(\xf3d? ?) Tj', data)
+        self.assertIn(b'/Font << /F1 3 0 R /F2_0 ', data)
+        self.assertIn(b'+NotoSansKhmer-Regular /FirstChar 0 /LastChar 5', data)
+        self.assertIn(b'+BitstreamVeraSans-Roman /FirstChar 0 /LastChar 1', data)
+        self.assertIn(b'<01> <1786>\n<02> <17D2>', data)
+        self.assertIn(b'<01> <0141>', data)
+        self.assertEqual(data.count(b'/FontFile2'), 2)
+        for object_id, offset in enumerate(xref_offsets(data), start=1):
+            self.assertTrue(data[offset:].startswith(b'%d 0 obj' % object_id))
+
+    def test_render_pdf_control_codes(self):
+        """Test subset codes that are control bytes, CR and LF among them, are written as octal escapes."""
+        text = '\u0106\u0107\u010c\u010d\u010e\u010f\u0110\u0111\u011e\u011f\u0130\u0131\u0141\u0142\u015e\u015f'
+        with mock.patch('transcript_render.PDF_UNICODE_FONTS', [os.path.join(REPORTLAB_FONTS, 'Vera.ttf')]):
+            data = render('pdf', [text])
+
+        content = re.search(rb'/F2_0 12 Tf\n\((.*?)\) Tj', data).group(1)
+        self.assertEqual(content, b''.join(b'\\%03o' % code for code in range(1, 17)))
+        self.assertNotIn(b'\r', content)
+
+    def test_render_docx(self):
+        """Test the streamed DOCX is a valid package with one paragraph per line."""
+        with zipfile.ZipFile(BytesIO(render('docx'))) as archive:
+            self.assertIn('[Content_Types].xml', archive.namelist())
+            document = ElementTree.fromstring(archive.read('word/document.xml'))
+
+        paragraphs = document.iter(f'{WORD_NAMESPACE}p')
+        self.assertEqual([''.join(text.text or '' for text in paragraph.iter(f'{WORD_NAMESPACE}t')) for paragraph in paragraphs], PARAGRAPHS)
+
+    def test_render_unsupported_format(self):
+        """Test unsupported formats raise a ValueError."""
+        with self.assertRaises(ValueError):
+            render_transcript(['text'], 'odt')
+
+if __name__ == '__main__':
+    unittest.main()
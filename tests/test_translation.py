@@ -0,0 +1,124 @@
+import unittest
+import pathlib
+import re
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+import argostranslate.sbd
+from translation import TranslationEngine
+
+class FakeTranslator:
+    """Stand-in for a CTranslate2 model upper-casing every token, recording the batches it gets."""
+    def __init__(self):
+        self.batches = []
+
+    def translate_batch(self, tokenized, **kwargs):
+        self.batches.append(tokenized)
+        return [SimpleNamespace(hypotheses=[[token.upper() for token in tokens]]) for tokens in tokenized]
+
+def fake_translation():
+    return SimpleNamespace(
+        pkg=SimpleNamespace(
+            tokenizer=SimpleNamespace(encode=lambda text: text.split(' '), decode=lambda tokens: ' '.join(tokens)),
+            target_prefix='',
+        ),
+        sentencizer=SimpleNamespace(split_sentences=lambda text: re.findall(r'[^.!?]+[.!?]?\s*', text)),
+        translator=FakeTranslator(),
+    )
+
+class TranslationEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = TranslationEngine()
+        self.engine._index = {('es', 'en'): None, ('en', 'fr'): None, ('en', 'ja'): None}
+        self.translations = {}
+
+        def get_translation(pair):
+            return self.translations.setdefault(pair, fake_translation())
+        self.engine._get_translation = get_translation
+
+    def test_translates_sentences_in_one_batch(self):
+        """Test text is split into sentences, translated in one batch and put back together by paragraph."""
+        translated = self.engine.translate('Hola amigos. Bienvenidos!\nAdios.', 'es', 'en')
+
+        self.assertEqual(translated, 'HOLA AMIGOS. BIENVENIDOS!\nADIOS.')
+        batches = self.translations[('es', 'en')].translator.batches
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(sorted(' '.join(tokens) for tokens in batches[0]), ['Adios.', 'Bienvenidos!', 'Hola amigos.'])
+
+    def test_memo_skips_known_sentences(self):
+        """Test repeated sentences are translated only once, within a text and across calls."""
+        self.engine.translate('Welcome back. Welcome back. Today we talk.', 'es', 'en')
+        self.engine.translate('Welcome back. Something new.', 'es', 'en')
+
+        batches = self.translations[('es', 'en')].translator.batches
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        stats = self.engine.stats()
+        self.assertEqual((stats['memo_hits'], stats['memo_misses'], stats['memo_entries']), (1, 3, 3))
+
+    def test_memo_is_bounded(self):
+        """Test the memo forgets the least recently used sentences beyond its size."""
+        self.engine.memo_entries = 2
+        self.engine.translate('One. Two. Three.', 'es', 'en')
+
+        self.assertEqual(self.engine.stats()['memo_entries'], 2)
+
+    def test_pivot_and_no_space_languages(self):
+        """Test pivoted pairs go through both models and languages without spaces are joined without them."""
+        self.assertEqual(self.engine.translate('Uno. Dos.', 'es', 'fr'), 'UNO. DOS.')
+        self.assertEqual(len(self.translations[('en', 'fr')].translator.batches), 1)
+        self.assertEqual(self.engine.translate('One. Two.', 'en', 'ja'), 'ONE.TWO.')
+
+class FakeModel:
+    """Stand-in for ctranslate2.Translator: echoes the target prefix, then every source token upper-cased."""
+    instances = []
+
+    def __init__(self, model_path, **kwargs):
+        self.model_path = model_path
+        self.kwargs = kwargs
+        self.calls = []
+        FakeModel.instances.append(self)
+
+    def translate_batch(self, tokenized, target_prefix=None, **kwargs):
+        self.calls.append((tokenized, target_prefix))
+        prefixes = target_prefix or [[]] * len(tokenized)
+        return [SimpleNamespace(hypotheses=[prefix + [token.upper() for token in tokens]]) for tokens, prefix in zip(tokenized, prefixes)]
+
+class PackageWiringTestCase(unittest.TestCase):
+    """Run the real argostranslate PackageTranslation wiring, with only the model and the package stubbed."""
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        package_path = pathlib.Path(self.tmpdir.name)
+        (package_path / 'model').mkdir()
+        (package_path / 'model' / 'model.bin').write_bytes(b'x' * 10)
+        (package_path / 'minisbd').mkdir() # a local sentence boundary model, so nothing is downloaded
+        (package_path / 'minisbd' / 'es.onnx').write_bytes(b'')
+        self.pkg = SimpleNamespace(
+            type='translate', from_code='es', from_name='Spanish', to_code='en', to_name='English',
+            package_path=package_path, packaged_sbd_path=package_path / 'minisbd', target_prefix='__en__',
+            tokenizer=SimpleNamespace(encode=lambda text: ['\u2581' + word for word in text.split(' ')],
+                                      decode=lambda tokens: ''.join(tokens).replace('\u2581', ' ').strip()),
+        )
+        FakeModel.instances = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_package_translation(self):
+        """Test sentences are tokenized, sent with the target prefix, and decoded with the prefix stripped."""
+        engine = TranslationEngine()
+        engine._index = {('es', 'en'): self.pkg}
+        split = lambda sentencizer, text: re.findall(r'[^.!?]+[.!?]?\s*', text)
+        with mock.patch('translation.ctranslate2.Translator', FakeModel), \
+             mock.patch.object(argostranslate.sbd.MiniSBDSentencizer, 'split_sentences', split):
+            translated = engine.translate('Hola amigos. Adios.', 'es', 'en')
+
+        self.assertEqual(translated, 'HOLA AMIGOS. ADIOS.')
+        model, = FakeModel.instances
+        self.assertEqual(model.model_path, str(self.pkg.package_path / 'model'))
+        tokenized, target_prefix = model.calls[0]
+        self.assertEqual(sorted(tokenized), [['\u2581Adios.'], ['\u2581Hola', '\u2581amigos.']])
+        self.assertEqual(target_prefix, [['__en__']] * 2)
+        self.assertEqual(engine.stats()['cache_bytes'], 10)
+
+if __name__ == '__main__':
+    unittest.main()
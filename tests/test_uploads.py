@@ -0,0 +1,88 @@
+import unittest
+from unittest import mock
+from app import app
+import storage
+import os
+import shutil
+
+class ChunkedUploadTestCase(unittest.TestCase):
+    def setUp(self):
+        """Set up the test environment with small blocks so a small file spans several of them."""
+        self.app = app.test_client()
+        self.app.testing = True
+        os.makedirs('uploads', exist_ok=True)
+        os.makedirs('outputs', exist_ok=True)
+        patcher = mock.patch('storage.UPLOAD_BLOCK_SIZE', 128)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        with open('tests/test.png', 'rb') as f:
+            self.content = f.read()
+
+    def tearDown(self):
+        """Clean up after each test."""
+        for folder in ['uploads', 'outputs']:
+            for file in os.listdir(folder):
+                file_path = os.path.join(folder, file)
+                if os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+                else:
+                    os.remove(file_path)
+
+    def create(self):
+        response = self.app.post('/uploads', json={'filename': 'test.png', 'size': len(self.content)})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json['block_size'], 128)
+        return response.json['upload_id']
+
+    def test_resume_and_complete(self):
+        """Test an interrupted chunk keeps its complete blocks, and the rest can be sent from next_offset."""
+        upload_id = self.create()
+        # a connection dropped after 200 bytes: only the first block is complete
+        status = self.app.put(f'/uploads/{upload_id}?offset=0', data=self.content[:200]).json
+        self.assertEqual(status['received'], 128)
+        self.assertEqual(status['next_offset'], 128)
+        self.assertEqual(self.app.post(f'/uploads/{upload_id}/complete').status_code, 409)
+
+        # the rest in two chunks, out of order
+        self.app.put(f'/uploads/{upload_id}?offset=256', data=self.content[256:])
+        status = self.app.put(f'/uploads/{upload_id}?offset=128', data=self.content[128:256]).json
+        self.assertEqual(status['received'], len(self.content))
+        self.assertIsNone(status['next_offset'])
+
+        response = self.app.post(f'/uploads/{upload_id}/complete')
+        self.assertEqual(response.status_code, 200)
+        hasher = storage.BlockHasher()
+        hasher.update(self.content)
+        self.assertEqual(response.json['digest'], storage.combine_block_digests(hasher.finish()))
+        with open(os.path.join('uploads', f'{upload_id}.upload'), 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_invalid_chunks(self):
+        """Test chunks off a block boundary or past the end of the file are rejected."""
+        upload_id = self.create()
+        self.assertEqual(self.app.put(f'/uploads/{upload_id}?offset=10', data=b'x').status_code, 400)
+        self.assertEqual(self.app.put(f'/uploads/{upload_id}?offset=0', data=self.content + b'x').status_code, 400)
+        self.assertEqual(self.app.put('/uploads/missing?offset=0', data=b'x').status_code, 404)
+
+    def test_convert_upload_id(self):
+        """Test a completed upload can be converted several times by its upload_id, and deleted."""
+        upload_id = self.create()
+        self.app.put(f'/uploads/{upload_id}?offset=0', data=self.content)
+        self.app.post(f'/uploads/{upload_id}/complete')
+        completed_at = storage.get_file_registry().get_upload(upload_id)['updated_at']
+
+        for output_format in ['jpg', 'bmp']:
+            response = self.app.post('/image/convert_image', data={'upload_id': upload_id, 'output_format': output_format},
+                                     content_type='multipart/form-data')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.json['output_file'].endswith(output_format))
+        self.assertEqual(os.listdir('uploads'), [f'{upload_id}.upload'])
+        # every claim counts as a use, the reaper forgets uploads by their last use
+        self.assertGreater(storage.get_file_registry().get_upload(upload_id)['updated_at'], completed_at)
+
+        self.assertEqual(self.app.delete(f'/uploads/{upload_id}').status_code, 204)
+        self.assertEqual(os.listdir('uploads'), [])
+        response = self.app.post('/image/convert_image', data={'upload_id': upload_id, 'output_format': 'jpg'},
+                                 content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,390 @@
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfbase.ttfonts import FF_NONSYMBOLIC, FF_SYMBOLIC, TTFError, TTFontFace
+from threading import Lock
+from xml.sax.saxutils import escape
+import json
+import logging
+import os
+import re
+import zipfile
+import zlib
+from batch import ZipStream
+from instrumentation import timed_iter
+
+PDF_FONT = 'Helvetica'
+PDF_FONT_SIZE = 12
+PDF_LEADING = 15
+PDF_MARGIN = 40
+# text WinAnsi can encode is written in PDF_FONT, any other character in the first of PDF_UNICODE_FONTS
+# having a glyph for it, embedded in the PDF; characters no font has are replaced
+PDF_ENCODING = 'cp1252'
+# TrueType fonts or collections, comma separated
+PDF_UNICODE_FONTS = [path for path in os.environ.get('PDF_UNICODE_FONTS', ','.join([
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc',
+])).split(',') if path]
+# rendered output is handed out in pieces of about this size
+RENDER_CHUNK_SIZE = 64 * 1024
+
+WORD_PATTERN = re.compile(r'\S+')
+
+logger = logging.getLogger(__name__)
+
+_font_faces = {}
+_font_faces_lock = Lock()
+
+def load_font_face(path):
+    '''
+    Parse a TrueType font once per process, None if it is missing or may not be embedded
+    '''
+    with _font_faces_lock:
+        if path not in _font_faces:
+            face = None
+            if os.path.exists(path):
+                try:
+                    face = TTFontFace(path)
+                except TTFError as e:
+                    logger.warning("Cannot embed font %s: %s", path, e)
+            _font_faces[path] = face
+        return _font_faces[path]
+
+class EmbeddedFont:
+    '''
+    A TrueType font embedded in one PDF. Characters are given codes in subsets of up to 256 as the text is laid out,
+    every subset is written at the end as a simple TrueType font holding only its glyphs, like reportlab does.
+    The font file is only parsed once a character needs it.
+    '''
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index
+        self.subsets = []
+        self._codes = {}
+
+    @property
+    def face(self):
+        return load_font_face(self.path)
+
+    def has_glyph(self, char):
+        return self.face is not None and ord(char) in self.face.charToGlyph
+
+    def char_width(self, char, size):
+        return self.face.getCharWidth(ord(char)) * size / 1000
+
+    def encode(self, char):
+        '''
+        (subset index, code) of a character, added to the last subset the first time it is seen
+        '''
+        code_point = ord(char)
+        if code_point not in self._codes:
+            if not self.subsets or len(self.subsets[-1]) == 256:
+                self.subsets.append([0]) # code 0 is left to the missing glyph
+            self._codes[code_point] = (len(self.subsets) - 1, len(self.subsets[-1]))
+            self.subsets[-1].append(code_point)
+        return self._codes[code_point]
+
+class GlyphMetrics:
+    '''
+    Width of text in a font, measured glyph by glyph with every glyph width cached,
+    so measuring a word costs one dictionary lookup per character.
+    Characters the font's encoding lacks are measured in the first of unicode_fonts having them.
+    '''
+    def __init__(self, font=PDF_FONT, size=PDF_FONT_SIZE, unicode_fonts=()):
+        self.font = font
+        self.size = size
+        self.unicode_fonts = unicode_fonts
+        self._widths = {}
+        self._fonts = {}
+
+    def font_for(self, char):
+        '''
+        The embedded font a character is written in, None for the base font
+        '''
+        if char not in self._fonts:
+            font = None
+            try:
+                char.encode(PDF_ENCODING)
+            except UnicodeEncodeError:
+                font = next((font for font in self.unicode_fonts if font.has_glyph(char)), None)
+            self._fonts[char] = font
+        return self._fonts[char]
+
+    def glyph_width(self, char):
+        width = self._widths.get(char)
+        if width is None:
+            font = self.font_for(char)
+            if font:
+                width = font.char_width(char, self.size)
+            else:
+                width = stringWidth(char.encode(PDF_ENCODING, errors='replace').decode(PDF_ENCODING), self.font, self.size)
+            self._widths[char] = width
+        return width
+
+    def width(self, text):
+        return sum(self.glyph_width(char) for char in text)
+
+def _split_word(word, max_width, metrics):
+    # pieces of a word too wide for a line (Chinese or Japanese text has no spaces), with their widths
+    piece, piece_width = '', 0.0
+    for char in word:
+        char_width = metrics.glyph_width(char)
+        if piece and piece_width + char_width > max_width:
+            yield piece, piece_width
+            piece, piece_width = '', 0.0
+        piece += char
+        piece_width += char_width
+    yield piece, piece_width
+
+def wrap_paragraph(paragraph, max_width, metrics):
+    '''
+    Greedy word wrap of one paragraph, yielding its lines. Words wider than a line are broken between characters.
+    The width of the current line is kept as a running sum, so every word is measured once.
+    '''
+    space_width = metrics.glyph_width(' ')
+    words = []
+    line_width = 0.0
+    for match in WORD_PATTERN.finditer(paragraph):
+        word = match.group()
+        word_width = metrics.width(word)
+        pieces = _split_word(word, max_width, metrics) if word_width > max_width else [(word, word_width)]
+        for word, word_width in pieces:
+            if words and line_width + space_width + word_width > max_width:
+                yield ' '.join(words)
+                words, line_width = [], 0.0
+            line_width += word_width + (space_width if words else 0.0)
+            words.append(word)
+    yield ' '.join(words)
+
+def _buffered(pieces):
+    # group small pieces into chunks of about RENDER_CHUNK_SIZE bytes
+    buffer, size = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= RENDER_CHUNK_SIZE:
+            yield b''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+def render_txt(paragraphs):
+    for index, paragraph in enumerate(paragraphs):
+        yield (('\n' if index else '') + paragraph).encode('utf-8')
+
+def render_json(paragraphs):
+    yield b'{"transcribed_text": "'
+    for index, paragraph in enumerate(paragraphs):
+        # json.dumps escapes the paragraph, the quotes around it are dropped
+        yield (('\\n' if index else '') + json.dumps(paragraph)[1:-1]).encode('utf-8')
+    yield b'"}'
+
+def _pdf_string(data):
+    # control bytes (subset glyph codes) as octal escapes: readers turn a bare CR or CRLF of a string into LF
+    escaped = bytearray()
+    for byte in data:
+        if byte in b'\\()':
+            escaped += b'\\' + bytes([byte])
+        elif byte < 0x20:
+            escaped += b'\\%03o' % byte
+        else:
+            escaped.append(byte)
+    return bytes(escaped)
+
+def _pdf_runs(line, metrics):
+    # (font resource name, encoded text) runs of the characters of a line written in the same font
+    runs = []
+    for char in line:
+        font = metrics.font_for(char)
+        if font:
+            subset, code = font.encode(char)
+            name, data = b'F%d_%d' % (font.index, subset), bytes([code])
+        else:
+            name, data = b'F1', char.encode(PDF_ENCODING, errors='replace')
+        if runs and runs[-1][0] == name:
+            runs[-1][1].extend(data)
+        else:
+            runs.append((name, bytearray(data)))
+    return runs
+
+TO_UNICODE_START = (
+    b'/CIDInit /ProcSet findresource begin\n12 dict begin\nbegincmap\n'
+    b'/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def\n'
+    b'/CMapName /Adobe-Identity-UCS def\n/CMapType 2 def\n'
+    b'1 begincodespacerange\n<00> <FF>\nendcodespacerange'
+)
+TO_UNICODE_END = b'endcmap\nCMapName currentdict /CMap defineresource pop\nend\nend'
+
+def _subset_tag(number):
+    # six letter prefix of the name of an embedded subset
+    return bytes(ord('A') + number // 26 ** position % 26 for position in range(6))
+
+def _font_subset_objects(font, subset_index, first_id):
+    '''
+    (object id, body) of a font subset: font dictionary, font descriptor, font file and ToUnicode map
+    '''
+    face = font.face
+    subset = font.subsets[subset_index]
+    name = b'%s+%s' % (_subset_tag(font.index * 1000 + subset_index), face.name)
+    widths = b' '.join(b'%d' % (face.getCharWidth(code_point) if code else face.defaultWidth) for code, code_point in enumerate(subset))
+    flags = face.flags & ~FF_NONSYMBOLIC | FF_SYMBOLIC
+    font_file = face.makeSubset(subset)
+    compressed = zlib.compress(font_file)
+    mappings = [b'<%02X> <%s>' % (code, chr(code_point).encode('utf-16-be').hex().upper().encode())
+                for code, code_point in enumerate(subset) if code]
+    cmap = b'\n'.join([TO_UNICODE_START] + [
+        b'%d beginbfchar\n%s\nendbfchar' % (len(mappings[i:i + 100]), b'\n'.join(mappings[i:i + 100]))
+        for i in range(0, len(mappings), 100)
+    ] + [TO_UNICODE_END])
+    return [
+        (first_id, b'<< /Type /Font /Subtype /TrueType /BaseFont /%s /FirstChar 0 /LastChar %d /Widths [%s] '
+                   b'/FontDescriptor %d 0 R /ToUnicode %d 0 R >>' % (name, len(subset) - 1, widths, first_id + 1, first_id + 3)),
+        (first_id + 1, b'<< /Type /FontDescriptor /FontName /%s /Flags %d /FontBBox [%s] /ItalicAngle %g /Ascent %d '
+                       b'/Descent %d /CapHeight %d /StemV %d /MissingWidth %d /FontFile2 %d 0 R >>'
+                       % (name, flags, b' '.join(b'%d' % value for value in face.bbox), face.italicAngle, face.ascent,
+                          face.descent, face.capHeight, face.stemV, face.defaultWidth, first_id + 2)),
+        (first_id + 2, b'<< /Length %d /Length1 %d /Filter /FlateDecode >>\nstream\n%s\nendstream'
+                       % (len(compressed), len(font_file), compressed)),
+        (first_id + 3, b'<< /Length %d >>\nstream\n%s\nendstream' % (len(cmap), cmap)),
+    ]
+
+def _pdf_pages(paragraphs, page_width, page_height, metrics):
+    # yields the lines of every page, layout driven one paragraph at a time
+    lines_per_page = int((page_height - 2 * PDF_MARGIN) // PDF_LEADING) + 1
+    page = []
+    empty = True
+    for paragraph in paragraphs:
+        for line in wrap_paragraph(paragraph, page_width - 2 * PDF_MARGIN, metrics):
+            page.append(line)
+            if len(page) == lines_per_page:
+                yield page
+                page, empty = [], False
+    if page or empty:
+        yield page
+
+def render_pdf(paragraphs):
+    '''
+    Write a PDF one page at a time: every page is an independent content stream written as soon as it is laid out,
+    and only the object offsets are kept until the cross-reference table at the end.
+    The subsets of the embedded fonts are written at the end too, once every character they need is known.
+    '''
+    page_width, page_height = A4
+    unicode_fonts = [EmbeddedFont(path, index) for index, path in enumerate(PDF_UNICODE_FONTS, start=2)]
+    metrics = GlyphMetrics(unicode_fonts=unicode_fonts)
+    offsets = {}
+    position = 0
+    page_ids = []
+
+    def write_object(object_id, body):
+        nonlocal position
+        offsets[object_id] = position
+        data = b'%d 0 obj\n%s\nendobj\n' % (object_id, body)
+        position += len(data)
+        return data
+
+    header = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+    position += len(header)
+    yield header
+    # 1: catalog, 2: page tree (written last, once every page is known), 3: base font,
+    # 4: resources shared by every page (written last, once the embedded font subsets are known)
+    yield write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+    yield write_object(3, b'<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>' % PDF_FONT.encode())
+
+    next_id = 5
+    for lines in _pdf_pages(paragraphs, page_width, page_height, metrics):
+        content = [b'BT /F1 %d Tf %d TL %.2f %.2f Td' % (PDF_FONT_SIZE, PDF_LEADING, PDF_MARGIN, page_height - PDF_MARGIN)]
+        current_font = b'F1'
+        for line in lines:
+            for font_name, data in _pdf_runs(line, metrics):
+                if font_name != current_font:
+                    content.append(b'/%s %d Tf' % (font_name, PDF_FONT_SIZE))
+                    current_font = font_name
+                content.append(b'(%s) Tj' % _pdf_string(bytes(data)))
+            content.append(b'T*')
+        content.append(b'ET')
+        stream = b'\n'.join(content)
+        yield write_object(next_id, b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+        yield write_object(next_id + 1, b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.4f %.4f] '
+                                        b'/Resources 4 0 R /Contents %d 0 R >>'
+                                        % (page_width, page_height, next_id))
+        page_ids.append(next_id + 1)
+        next_id += 2
+
+    fonts = [b'/F1 3 0 R']
+    for font in unicode_fonts:
+        for subset_index in range(len(font.subsets)):
+            for object_id, body in _font_subset_objects(font, subset_index, next_id):
+                yield write_object(object_id, body)
+            fonts.append(b'/F%d_%d %d 0 R' % (font.index, subset_index, next_id))
+            next_id += 4
+    yield write_object(4, b'<< /Font << %s >> >>' % b' '.join(fonts))
+
+    kids = b' '.join(b'%d 0 R' % page_id for page_id in page_ids)
+    yield write_object(2, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(page_ids)))
+
+    xref_position = position
+    xref = [b'xref\n0 %d\n' % next_id, b'0000000000 65535 f \n']
+    xref.extend(b'%010d 00000 n \n' % offsets[object_id] for object_id in range(1, next_id))
+    yield b''.join(xref)
+    yield b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (next_id, xref_position)
+
+DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+DOCX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    '</Relationships>'
+)
+DOCX_DOCUMENT_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+)
+DOCX_DOCUMENT_END = '<w:sectPr/></w:body></w:document>'
+# characters XML 1.0 does not allow
+XML_INVALID_PATTERN = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def render_docx(paragraphs):
+    '''
+    Write a minimal DOCX package, streaming word/document.xml one paragraph at a time
+    '''
+    sink = ZipStream()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml', DOCX_CONTENT_TYPES)
+        archive.writestr('_rels/.rels', DOCX_RELS)
+        yield sink.drain()
+        with archive.open('word/document.xml', 'w') as document:
+            document.write(DOCX_DOCUMENT_START.encode('utf-8'))
+            for paragraph in paragraphs:
+                text = escape(XML_INVALID_PATTERN.sub('', paragraph))
+                document.write(f'<w:p><w:r><w:t xml:space="preserve">{text}</w:t></w:r></w:p>'.encode('utf-8'))
+                yield sink.drain()
+            document.write(DOCX_DOCUMENT_END.encode('utf-8'))
+    yield sink.drain()
+
+RENDERERS = {
+    'txt': (render_txt, 'transcription.txt', 'text/plain'),
+    'docx': (render_docx, 'transcription.docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+    'json': (render_json, 'transcription.json', 'application/json'),
+    'pdf': (render_pdf, 'transcription.pdf', 'application/pdf'),
+}
+
+def render_transcript(paragraphs, save_format):
+    '''
+    Render a transcript, given as an iterable of paragraphs (e.g. the text of every segment), in a save format.
+    Returns (chunks, download_name, mimetype), chunks being a generator of bytes produced in linear time
+    while the document is laid out, so it can be streamed to a response or a file.
+    Raises ValueError for an unsupported format.
+    '''
+    if save_format not in RENDERERS:
+        raise ValueError("Unsupported format")
+    renderer, download_name, mimetype = RENDERERS[save_format]
+    return timed_iter('render', _buffered(renderer(iter(paragraphs)))), download_name, mimetype
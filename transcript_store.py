@@ -0,0 +1,55 @@
+import hashlib
+import os
+import storage
+from model_pool import WHISPER_MODEL
+
+# 0 transcribes and translates every request again; results are still saved, so their transcript ids stay usable
+TRANSCRIPT_STORE = os.environ.get('TRANSCRIPT_STORE', '1') == '1'
+
+def transcript_id(media_digest, input_language, model=WHISPER_MODEL):
+    '''
+    Id of the transcript of some media: the same content, transcribed by the same model in the same
+    input language ('' = auto-detect), always gets the same id
+    '''
+    return hashlib.sha256(f"{media_digest}:{model}:{input_language or ''}".encode('utf-8')).hexdigest()[:32]
+
+def transcript_paragraphs(segments):
+    '''
+    Paragraphs of a transcript, one per segment
+    '''
+    return [segment['text'].strip() for segment in segments]
+
+def find_transcript(media_digest, input_language):
+    '''
+    Get the stored transcript of some media, or None if it was never transcribed with the current model
+    '''
+    return storage.get_file_registry().get_transcript(transcript_id(media_digest, input_language))
+
+def save_transcript(media_digest, input_language, segments):
+    '''
+    Store the segments ({'text', 'start', 'end'}) Whisper produced for some media, returns the transcript id
+    '''
+    stored_id = transcript_id(media_digest, input_language)
+    storage.get_file_registry().save_transcript(stored_id, media_digest, WHISPER_MODEL, input_language or '', segments)
+    return stored_id
+
+def get_transcript(stored_id):
+    return storage.get_file_registry().get_transcript(stored_id)
+
+def translated_paragraphs(transcript, output_language, translate):
+    '''
+    Paragraphs of a stored transcript in output_language, one per segment. Segments are translated as the lines
+    of one text, which the translation keeps apart. Translations are stored per language, so only a language
+    asked for the first time calls translate(text, from_code, to_code), or every call without TRANSCRIPT_STORE.
+    '''
+    paragraphs = transcript_paragraphs(transcript['segments'])
+    from_code = transcript['input_language'] or 'en'
+    if output_language == from_code:
+        return paragraphs
+
+    registry = storage.get_file_registry()
+    translation = registry.get_transcript_translation(transcript['transcript_id'], output_language) if TRANSCRIPT_STORE else None
+    if translation is None:
+        translation = translate('\n'.join(paragraphs), from_code, output_language)
+        registry.save_transcript_translation(transcript['transcript_id'], output_language, translation)
+    return translation.split('\n')
@@ -0,0 +1,226 @@
+from collections import OrderedDict
+from threading import Lock
+import logging
+import os
+import sys
+import zipfile
+import argostranslate.package
+import argostranslate.settings
+import argostranslate.translate
+import ctranslate2
+from resources import CPU_CORES
+
+TRANSLATION_CACHE_BYTES = int(os.environ.get('TRANSLATION_CACHE_BYTES', 2 * 1024 ** 3))
+# sentences already translated are remembered per (from_code, to_code, sentence), up to this many
+TRANSLATION_MEMO_ENTRIES = int(os.environ.get('TRANSLATION_MEMO_ENTRIES', 100000))
+# batches of sentences translated in parallel by each loaded model
+TRANSLATION_WORKERS = int(os.environ.get('TRANSLATION_WORKERS', max(1, CPU_CORES // 2)))
+# target languages written without spaces between sentences
+NO_SPACE_LANGUAGES = ['zh', 'ja']
+ARGOS_PACKAGE_DIR = os.environ.get('ARGOS_PACKAGE_DIR')
+PIVOT_LANGUAGE = 'en'
+
+logger = logging.getLogger(__name__)
+
+_engine = None
+_engine_lock = Lock()
+
+def _directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+class TranslationEngine:
+    '''
+    Translate between installed argostranslate language pairs without ever touching the package index.
+    Installed pairs are indexed once, and each pair's translator is loaded on first use and kept
+    in an LRU cache bounded by the on-disk size of the loaded models.
+    Text is translated sentence by sentence: sentences seen before come from a memo, the others
+    are translated together in one batch, split by the model into sub-batches run in parallel.
+    '''
+    def __init__(self, max_bytes=TRANSLATION_CACHE_BYTES, memo_entries=TRANSLATION_MEMO_ENTRIES):
+        self.max_bytes = max_bytes
+        self.memo_entries = memo_entries
+        self._index = None
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._memo = OrderedDict()
+        self._memo_hits = 0
+        self._memo_misses = 0
+        self._lock = Lock()
+
+    def refresh_index(self):
+        '''
+        Rebuild the index of installed (from_code, to_code) pairs from the local package directory
+        '''
+        packages = argostranslate.package.get_installed_packages()
+        index = {(pkg.from_code, pkg.to_code): pkg for pkg in packages if pkg.type == 'translate'}
+        with self._lock:
+            self._index = index
+            self._cache.clear()
+            self._cache_bytes = 0
+        return index
+
+    def installed_pairs(self):
+        if self._index is None:
+            self.refresh_index()
+        return sorted(self._index)
+
+    def _route(self, from_code, to_code):
+        '''
+        Find the chain of installed pairs to go from one language to another, pivoting through English if needed
+        '''
+        if self._index is None:
+            self.refresh_index()
+        if (from_code, to_code) in self._index:
+            return [(from_code, to_code)]
+        if (from_code, PIVOT_LANGUAGE) in self._index and (PIVOT_LANGUAGE, to_code) in self._index:
+            return [(from_code, PIVOT_LANGUAGE), (PIVOT_LANGUAGE, to_code)]
+        raise LookupError(f'No installed translation package for {from_code} -> {to_code}')
+
+    def _get_translation(self, pair):
+        with self._lock:
+            if pair in self._cache:
+                self._cache.move_to_end(pair)
+                return self._cache[pair][0]
+            pkg = self._index[pair]
+
+        from_lang = argostranslate.translate.Language(pkg.from_code, pkg.from_name)
+        to_lang = argostranslate.translate.Language(pkg.to_code, pkg.to_name)
+        translation = argostranslate.translate.PackageTranslation(from_lang, to_lang, pkg)
+        translation.translator = ctranslate2.Translator(
+            str(pkg.package_path / 'model'),
+            device=argostranslate.settings.device,
+            inter_threads=TRANSLATION_WORKERS,
+            intra_threads=max(1, CPU_CORES // TRANSLATION_WORKERS),
+            compute_type=argostranslate.settings.compute_type,
+        )
+        size = _directory_size(pkg.package_path / 'model')
+
+        with self._lock:
+            if pair in self._cache:  # loaded concurrently by another thread
+                return self._cache[pair][0]
+            self._cache[pair] = (translation, size)
+            self._cache_bytes += size
+            while self._cache_bytes > self.max_bytes and len(self._cache) > 1:
+                _, (_, evicted_size) = self._cache.popitem(last=False)
+                self._cache_bytes -= evicted_size
+        return translation
+
+    def _translate_batch(self, translation, sentences):
+        '''
+        Translate a list of sentences with one call to the model of a pair
+        '''
+        pkg = translation.pkg
+        tokenized = [pkg.tokenizer.encode(sentence) for sentence in sentences]
+        target_prefix = [[pkg.target_prefix]] * len(tokenized) if pkg.target_prefix else None
+        results = translation.translator.translate_batch(
+            tokenized,
+            target_prefix=target_prefix,
+            replace_unknowns=True,
+            max_batch_size=argostranslate.settings.batch_size,
+            batch_type='tokens',
+            beam_size=argostranslate.settings.beam_size,
+            num_hypotheses=1,
+            length_penalty=0.2,
+        )
+
+        translated = []
+        for result in results:
+            value = pkg.tokenizer.decode(result.hypotheses[0])
+            if pkg.target_prefix and value.startswith(pkg.target_prefix):
+                value = value[len(pkg.target_prefix):]
+            translated.append(value.strip())
+        return translated
+
+    def _translate_pair(self, pair, text):
+        translation = self._get_translation(pair)
+        from_code, to_code = pair
+        paragraphs = [
+            [sentence.strip() for sentence in translation.sentencizer.split_sentences(paragraph) if sentence.strip()]
+            if paragraph.strip() else []
+            for paragraph in text.split('\n')
+        ]
+
+        # every distinct sentence is translated once, and only if it is not in the memo yet
+        translated = {}
+        missing = []
+        with self._lock:
+            for sentence in {sentence for sentences in paragraphs for sentence in sentences}:
+                key = (from_code, to_code, sentence)
+                if key in self._memo:
+                    self._memo.move_to_end(key)
+                    translated[sentence] = self._memo[key]
+                    self._memo_hits += 1
+                else:
+                    missing.append(sentence)
+
+        if missing:
+            translated.update(zip(missing, self._translate_batch(translation, missing)))
+            with self._lock:
+                self._memo_misses += len(missing)
+                for sentence in missing:
+                    self._memo[(from_code, to_code, sentence)] = translated[sentence]
+                while len(self._memo) > self.memo_entries:
+                    self._memo.popitem(last=False)
+
+        separator = '' if to_code in NO_SPACE_LANGUAGES else ' '
+        return '\n'.join(separator.join(translated[sentence] for sentence in sentences) for sentences in paragraphs)
+
+    def translate(self, text, from_code, to_code):
+        if from_code == to_code or not text:
+            return text
+        for pair in self._route(from_code, to_code):
+            text = self._translate_pair(pair, text)
+        return text
+
+    def stats(self):
+        with self._lock:
+            return {
+                'installed_pairs': len(self._index or {}),
+                'loaded_pairs': [f'{f}-{t}' for f, t in self._cache],
+                'cache_bytes': self._cache_bytes,
+                'max_bytes': self.max_bytes,
+                'memo_entries': len(self._memo),
+                'memo_hits': self._memo_hits,
+                'memo_misses': self._memo_misses,
+            }
+
+def get_translation_engine():
+    '''
+    Get the translation engine of the current process, creating it on first use
+    '''
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = TranslationEngine()
+    return _engine
+
+def provision_from_directory(package_dir):
+    '''
+    Install every .argosmodel file found in a local directory, skipping packages that are already installed.
+    Runs fully offline, so nodes without outbound network can be provisioned from a mounted volume.
+    '''
+    installed = []
+    for name in sorted(os.listdir(package_dir)):
+        if not name.endswith('.argosmodel'):
+            continue
+        path = os.path.join(package_dir, name)
+        with zipfile.ZipFile(path) as archive:
+            top_level = archive.namelist()[0].split('/')[0]
+        if (argostranslate.settings.package_data_dir / top_level).exists():
+            continue
+        logger.info("Installing translation package %s", name)
+        argostranslate.package.install_from_path(path)
+        installed.append(name)
+
+    if _engine is not None:
+        _engine.refresh_index()
+    return installed
+
+if __name__ == '__main__':
+    # python translation.py /path/to/argosmodels
+    provision_from_directory(sys.argv[1] if len(sys.argv) > 1 else ARGOS_PACKAGE_DIR)